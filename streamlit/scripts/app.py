@@ -1,16 +1,21 @@
 import streamlit as st
-import streamlit.components.v1 as components
-from urllib.request import urlopen, Request
-from bs4 import BeautifulSoup
-import base64
 import bedrock
-import time
+import cascade
+import diff
+import gist
+import jobs
+import llm
+import mermaid
+import pipeline
+import ratelimit
+import render
+import retry
+import transforms
+import viewer
+import webpage
 import os
 import re
-import json
-import numpy as np
-from IPython.display import Image
-import datetime
+from IPython.display import SVG
 
 
 
@@ -18,18 +23,10 @@ import datetime
 
 # return the text from an html page
 def get_html_text(url, postprocess=False, print_text=False):
-    request = Request(
-        url , 
-        headers={"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36"}
-    )
-    rawpage = urlopen(request).read()
-    soup = BeautifulSoup(rawpage, features="html.parser")
-    # kill all script and style elements
-    for script in soup(["script", "style", "meta"]):
-        script.extract()    # rip it out
-    # get text
-    text = soup.get_text()
-    st.session_state.webpage_title = soup.title.text
+    # pages are cached on disk, so repeated visits skip both the download and the parsing
+    dc_page = webpage.fetch_page(url)
+    text = dc_page["text"]
+    st.session_state.webpage_title = dc_page["title"]
     
     if postprocess is True:
         # break into lines and remove leading and trailing space on each
@@ -55,24 +52,9 @@ def get_html_text(url, postprocess=False, print_text=False):
     
     
     
-def find_between( s, first, last ):
-    try:
-        ls_graphs = re.findall(r'<mermaid>(.*?)</mermaid>', s, re.DOTALL)
-        return ls_graphs
-    except ValueError:
-        return ""
-    
-    
-    
-
-def render_graph(graph, show_link=False):
-    graphbytes = graph.encode("utf8")
-    base64_bytes = base64.urlsafe_b64encode(graphbytes)
-    base64_string = base64_bytes.decode("ascii")
-    url_rendering = "https://mermaid.ink/img/" + base64_string
-    if show_link is True:
-        print(url_rendering)
-    rendered_graph = Image(url=url_rendering)
+def render_graph(graph, theme='default'):
+    # rendered in process (no mermaid.ink round trip), from the cache of rendered SVGs
+    rendered_graph = SVG(data=render.get_svg(graph, theme).decode("utf8"))
     
     return rendered_graph
 
@@ -80,27 +62,43 @@ def render_graph(graph, show_link=False):
     
     
 def check_graph_validity(graph):
-    # checks syntax validity of a mermaid graph
+    # checks syntax validity of a mermaid graph, offline (no round trip to mermaid.ink)
     # st.write("```" + graph)
-    graphbytes = graph.encode("utf8")
-    base64_bytes = base64.urlsafe_b64encode(graphbytes)
-    base64_string = base64_bytes.decode("ascii")
-    url = "https://mermaid.ink/img/" + base64_string
-    req = Request(url, headers={'User-Agent' : "Magic Browser"})
-    flag_valid = True
-    try: 
-        con = urlopen(req)
-    except:
-        flag_valid = False
+    flag_valid = len(mermaid.validate_graph(graph)) == 0
     return flag_valid
 
 
     
-def standardize_graph(graph):
-    # apply string transformation to fix some common mermaid mistakes
-    graph = graph.replace('subgraph ""', 'subgraph " "')
-    
-    return graph
+def get_retry_policy():
+    # limits of the retries of each run (variant, selection, refinement iteration)
+    return retry.RetryPolicy(
+        max_attempts=st.session_state.input_max_attempts,
+        time_budget=300,
+        token_budget=retry.token_budget(
+            st.session_state.input_budget_calls,
+            st.session_state.input_token_budget,  # longest text sent, see get_reference_text()
+            st.session_state.slider_max_tokens,
+        ),
+    )
+
+
+
+def get_response_cache():
+    # cache of LLM responses, unless the user asked to bypass it
+    if st.session_state.checkbox_bypass_cache is True:
+        return None
+    return llm.get_response_cache()
+
+
+
+def get_view(graph):
+    # the diagram with the current appearance settings (orientation, collapsed subgraphs),
+    # applied locally on the generated code: no model call, memoized
+    return transforms.apply_view(
+        graph,
+        st.session_state.selectbox_orientation,
+        st.session_state.checkbox_collapse,
+    )
 
 
 
@@ -125,26 +123,21 @@ def display_variants(
                 
                 if i == 0:  # display selected variant
                     st.markdown("**" + webpage_title + "**")
-                    html_code = f"""
-                                <html>
-                                  <body>
-                                    <pre class="mermaid">
-                                    {diagram["processed_graph"]}
-                                    </pre>
-                                    <script type="module">
-                                      import mermaid from 'https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.esm.min.mjs';
-                                      mermaid.initialize({{ startOnLoad: true, 'theme': '{theme}' }});
-                                    </script>
-                                  </body>
-                                </html>
-                                """
-                    html_code = html_code.replace("{{", "{")
-                    html_code = html_code.replace("}}", "}")
-                    components.html(
-                        html_code,
-                        height=window_hight,
-                        scrolling=True
+                    display_gallery(
+                        [diagram["processed_graph"]], 
+                        [None], 
+                        theme=theme, 
+                        window_hight=window_hight,
                     )
+                    try:
+                        st.download_button(
+                            label="Download SVG",
+                            data=render.get_svg(get_view(diagram["processed_graph"]), theme),
+                            file_name="visual_gist.svg",
+                            mime="image/svg+xml",
+                        )
+                    except ValueError:
+                        pass  # not renderable offline, the browser view above still shows it
                 
                 if i == 1:  # text summary
                     summary = re.findall(
@@ -162,44 +155,29 @@ def display_variants(
                 
 
 
-def display_diagram(dc_diagram, webpage_title, iteration, theme='default', window_hight=500):
+def display_diagram(dc_diagram, webpage_title, iteration, theme='default', window_hight=500, show_image=True):
+    # with show_image=False, only the code is displayed: the image is part of a gallery
+    # rendering all the variants at once (see display_gallery())
     
     with st.container(border=True):
         st.markdown("##### Visual gist variation " + str(iteration))
 
-        tab_image, tab_st_graph, tab_graph, tab_raw = st.tabs(
-            [
-                "Image", 
-                "Postprocessed", 
-                "Original", 
-                "Raw LLM output"
-            ]
-        )
-
-        with tab_image:
-            st.markdown("**" + webpage_title + "**")
-
-            html_code = f"""
-                        <html>
-                          <body>
-                            <pre class="mermaid">
-                            {dc_diagram["processed_graph"]}
-                            </pre>
-                            <script type="module">
-                              import mermaid from 'https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.esm.min.mjs';
-                              mermaid.initialize({{ startOnLoad: true, 'theme': '{theme}' }});
-                            </script>
-                          </body>
-                        </html>
-                        """
-
-            html_code = html_code.replace("{{", "{")
-            html_code = html_code.replace("}}", "}")
-            components.html(
-                html_code,
-                height=window_hight,
-                scrolling=True
-            )
+        ls_tabs = ["Image"] if show_image is True else []
+        ls_tabs += ["Postprocessed", "Original", "Raw LLM output"]
+        ls_tabs = st.tabs(ls_tabs)
+        if show_image is True:
+            tab_image = ls_tabs.pop(0)
+        tab_st_graph, tab_graph, tab_raw = ls_tabs
+
+        if show_image is True:
+            with tab_image:
+                st.markdown("**" + webpage_title + "**")
+                display_gallery(
+                    [dc_diagram["processed_graph"]], 
+                    [None], 
+                    theme=theme, 
+                    window_hight=window_hight,
+                )
 
         with tab_st_graph:
             st.markdown("```" + dc_diagram["processed_graph"] + "```")
@@ -209,399 +187,267 @@ def display_diagram(dc_diagram, webpage_title, iteration, theme='default', windo
             st.markdown(dc_diagram["raw"])
     
 
-    
-    
-    
-def refine_diagram(
-    diagram, 
-    iterations=3
-):
-    
-    html_text = st.session_state.text_content
-    theme=st.session_state.selectbox_color
-    system_prompt = st.session_state.prompt_template_system
-    modelId = st.session_state.model_reflect
-    window_hight=500
-    
-    prompt_template = """  
-    Here is a given text for you to reference for the following task. Read it carefully because it is necessary for the task that you will have to solve. 
 
-    <text>
-    {html_text}
-    </text>
-    
-    Here is a Mermaid diagram intented to summarize the content of the previous text. The intention is that someone who only viewed the given Mermaid diagram, would understand the main concepts of the text, without having to read it.
-
-    <diagram>
-    {diagram}
-    </diagram>
-
-    Evaluate whether the given Mermaid diagram is a good visual approximation of the given text.
-    Here are some points to consider:
-    1. What are the most important points of the text, that someone should know about?
-    2. Does the diagram mention all these points?
-    3. Does the diagram capture all the interactions between all the important points?
-    4. Does the diagram use different colors, shapes and arrows to capture the important points and their interactions?
-    5. Is the diagramm too simplistic? 
-    6. Is the diagram too complicated?
-    7. Is the diagram visually pleasing?
-    8. Do you think that the diagram can be improved?
-    
-    Think whether the given diagram can be improved or not, and explain your thought process inside <justification></justification> XML tags.
-    If you think that the given Mermaid diagram can be improved, refine it and include the new Mermaid code inside <new_diagram></new_diagram> XML tags.
-    If you think that the given Mermaid diagram can not be improved, include the original Mermaid code inside <new_diagram></new_diagram> XML tags.
-    Remember don't forget to "close" the new diagram XML tags with </new_diagram>.
-    """
-    
-    # prepare prompt
-    prompt = prompt_template.replace("{html_text}", st.session_state.text_content)
-    prompt = prompt.replace("{diagram}", diagram)
-    
-    for i in range(iterations):
-        st.write("Iteration " + str(i) + ":")
-        
-        response = st.session_state.bedrock_runtime.converse(
-            modelId=modelId,
-            inferenceConfig={
-                "temperature": 0.1,  # be more factual
-                "maxTokens": 2048,
-                "topP": 1,
-            },
-            system=[
-                {
-                    "text": system_prompt
-                }
-            ],
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "text": prompt
-                        }
-                    ]
-                }
-            ],
-        )
-        response_text = response["output"]["message"]["content"][0]["text"]
 
-        # parsing output
-        justification = re.findall(
-            r"<justification>(.*?)</justification>", 
-            response_text, 
-            re.DOTALL
-        )
-        
-        new_diagram = re.findall(
-            r"<new_diagram>(.*?)</new_diagram>", 
-            response_text, 
-            re.DOTALL
-        )
-        
-        # st.write(new_diagram)
-        
-        html_code = f"""
-                    <html>
-                      <body>
-                        <pre class="mermaid">
-                        {new_diagram[0]}
-                        </pre>
-                        <script type="module">
-                          import mermaid from 'https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.esm.min.mjs';
-                          mermaid.initialize({{ startOnLoad: true, 'theme': '{theme}' }});
-                        </script>
-                      </body>
-                    </html>
-                    """
-
-        html_code = html_code.replace("{{", "{")
-        html_code = html_code.replace("}}", "}")
-        components.html(
-            html_code,
-            height=window_hight,
-            scrolling=True
-        )
-        
-        # prepare prompt
-        prompt = prompt_template.replace("{html_text}", st.session_state.text_content)
-        prompt = prompt.replace("{diagram}", new_diagram[0])
-        
-    dc_output = {
-        'refined_diagram': new_diagram[0], 
-        'justification': justification[0],
-        'raw_output': response_text
-    }
-        
-    return dc_output
-        
 
-        
-        
-        
-    
-    
-    
-def select_diagram(   
-    ls_diagrams
-):
-    
-    num_of_diagrams = len(ls_diagrams)
-    html_text = st.session_state.text_content
-    modelId = st.session_state.model_reflect
-    system_prompt = st.session_state.prompt_template_system
-    
-    prompt = f"""
-    Here is a given text for you to reference for the following task. Read it carefully because it is necessary for the task that you will have to solve. 
-
-    <text>
-    {html_text}
-    </text>
-
-    Think step by step and select the most informative and visually pleasing Mermaid diagram among the following {num_of_diagrams}.
-    The candidate Mermaid diagrams are included inside XML tags, along with their corresponding index number. 
-    The most informative Mermaid diagram should be the one that includes the most details from the text and displays it in an easy to understand way.
-    Someone who would only view the selected Mermaid diagram, should understand the main concepts of the text, without having to read it.
-    Explain which of the Mermaid diagrams is the most informative and provide its index inside <selected_index></selected_index> XML tags.
-    """
+def display_gallery(ls_graphs, ls_titles, theme='default', window_hight=500):
+    ls_views = [get_view(graph) for graph in ls_graphs]
+    if st.session_state.selectbox_renderer == 'Static SVG':
+        # rendered on the server, and read from the cache of rendered SVGs after the first time
+        for view, title in zip(ls_views, ls_titles):
+            if title is not None:
+                st.markdown("**" + title + "**")
+            try:
+                st.image(render.get_svg(view, theme).decode("utf8"))
+            except ValueError as e:
+                st.write("Could not render the diagram: " + str(e))
+        return
+    # all the diagrams in one component: the Mermaid bundle is loaded and initialized once
+    viewer.render_diagrams(
+        ls_views,
+        theme=theme,
+        ls_titles=ls_titles,
+        height=window_hight,
+    )
     
-    # adding the candidate mermaid diagrams and their indices
-    for i,diagram in enumerate(ls_diagrams):
-        prompt += ("\n\n<diagram " + str(i) + ">\n")
-        prompt += diagram["processed_graph"]
-        prompt += ("\n</diagram " + str(i) + ">\n")  
     
     
-    response = st.session_state.bedrock_runtime.converse(
-        modelId=modelId,
-        inferenceConfig={
-            "temperature": 0.1,  # be more factual
-            "maxTokens": 2048,
-            "topP": 1,
-        },
-        system=[
-            {
-                "text": system_prompt
-            }
-        ],
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "text": prompt
-                    }
-                ]
-            }
-        ],
+def get_pipeline_config():
+    # the settings of the pipeline, as chosen in the parameters tab and the sidebar
+    return pipeline.PipelineConfig(
+        model_generate=st.session_state.model_generate,
+        model_reflect=st.session_state.model_reflect,
+        model_summarize=st.session_state.model_summarize,
+        system_prompt=st.session_state.prompt_template_system,
+        prompt_template=(
+            st.session_state.prompt_template_single if st.session_state.selectbox_technique == 'Generate separately'
+            else st.session_state.prompt_template_variants
+        ),
+        generate_at_once=st.session_state.selectbox_technique != 'Generate separately',
+        cascade_models=tuple(st.session_state.ls_cascade_models) if st.session_state.checkbox_cascade else None,
+        number_of_diagrams=st.session_state.input_number_of_diagrams,
+        orientation=st.session_state.selectbox_orientation,
+        token_budget=st.session_state.input_token_budget,
+        repeat_on_error=st.session_state.checkbox_repeat,
+        max_tokens_to_sample=st.session_state.slider_max_tokens,
+        temperature=st.session_state.slider_temperature,
+        top_p=st.session_state.slider_top_p,
+        stream=st.session_state.checkbox_stream,
+        select=st.session_state.checkbox_select_diag,
+        local_only=st.session_state.selectbox_selection == 'Local score only',
+        top_k=st.session_state.input_top_k,
+        refine_iterations=st.session_state.input_number_cycles if st.session_state.checkbox_refine_diag else 0,
+        multi_turn=st.session_state.checkbox_multi_turn,
+        max_workers=st.session_state.input_max_workers,
+        theme=st.session_state.selectbox_color,
     )
-    response_text = response["output"]["message"]["content"][0]["text"]
 
-    # parse index from the completion
-    indx_selected = re.findall(
-        r"<selected_index>(.*?)</selected_index>", 
-        response_text, 
-        re.DOTALL
-    )
-    indx_selected = int(indx_selected[0])
-    
-    dc_output = {'indx_selected': indx_selected, 'raw_output': response_text}
 
-    return dc_output
 
-    
-    
-    
-
-
-def generate_diagram_variants(
-    url,
-    prompt,
-    number_of_diagrams=1,
-    orientation="LR", # "LR" or "TD"
-    repeat_on_error=True,
-    max_tokens_to_sample=500,
-    temperature=0.9,
-    top_k=250,
-    top_p=1,
-):
-    
-    start_time = time.time()
-    
-    with st.status("Generating " + str(number_of_diagrams) + " visual gist variants at once...", expanded=True) as status:
+def display_generation(dc_view, event, payload, config):
+    # progress of the generate stage: all the variants are rendered together, above their code
+    if event == "start":
+        dc_view["start_time"] = dc_view["time"]
+        if config.generate_at_once is True:
+            dc_view["status"] = st.status("Generating " + str(config.number_of_diagrams) + " visual gist variants at once...", expanded=True)
+        else:
+            dc_view["status"] = st.status("Generating " + str(config.number_of_diagrams) + " visual gists...", expanded=True)
+        dc_view["variants"] = []
+        with dc_view["status"]:
+            if config.generate_at_once is False:
+                st.write(
+                    "Generating " + str(config.number_of_diagrams) + " variations (up to " + 
+                    str(min(config.max_workers, config.number_of_diagrams)) + " in parallel)"
+                )
+            if config.cascade_models is not None and config.generate_at_once is False:
+                st.write(
+                    "Model cascade: " + " > ".join(cascade.order_models(list(config.cascade_models), cascade.get_model_stats()))
+                )
+            dc_view["gallery"] = st.empty()
+        
+    elif event == "message":
+        with dc_view["status"]:
+            st.write(payload)
         
-        ls_diagrams = []
-        ls_valid_indx = []
-        key_count = 0
-        modelId = st.session_state.model_generate
-        system_prompt = st.session_state.prompt_template_system
-
-        while len(ls_valid_indx) == 0:
-            # generate graphs
-            response = st.session_state.bedrock_runtime.converse(
-                    modelId=modelId,
-                    inferenceConfig={
-                        "temperature": temperature,
-                        "maxTokens": max_tokens_to_sample,
-                        "topP": top_p,
-                        # "topK": top_k,
-                    },
-                    system=[
-                        {
-                            "text": system_prompt
-                        }
-                    ],
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "text": prompt
-                                }
-                            ]
-                        }
-                    ],
+    elif event == "variant":
+        # called as each variant completes, in the order in which they complete
+        d, dc_output, error = payload["variant"], payload["output"], payload["error"]
+        with dc_view["status"]:
+            if error is not None:
+                st.write("Variation " + str(d+1) + " failed: " + str(error))
+                return
+            for attempt, kind, message in dc_output["failures"]:
+                st.write("Variation " + str(d+1) + ", attempt " + str(attempt) + ": " + kind + " failure (" + message + ")")
+            if dc_output["valid"] is False:
+                st.write("Variation " + str(d+1) + " is not valid after " + str(len(dc_output["invalid_attempts"]) + 1) + " attempts: " + "; ".join(dc_output["errors"]))
+            if len(dc_output.get("escalated", [])) > 0:
+                st.write("Variation " + str(d+1) + " escalated from " + ", ".join(dc_output["escalated"]) + " to " + dc_output["model"])
+            if len(dc_output["local_fixes"]) > 0:
+                st.write("Variation " + str(d+1) + " was fixed locally: " + "; ".join(dc_output["local_fixes"]))
+            if dc_output["repaired"] is True:
+                st.write("Variation " + str(d+1) + " was repaired")
+            dc_view["variants"].append(dc_output)
+            if config.generate_at_once is False:
+                st.caption("Variation " + str(d+1) + ": " + llm.format_usage(dc_output["usage"]))
+
+            with dc_view["gallery"].container():
+                display_gallery(
+                    [dc_diagram["processed_graph"] for dc_diagram in dc_view["variants"]],
+                    ["Visual gist variation " + str(dc_diagram["variant"]+1) for dc_diagram in dc_view["variants"]],
+                    theme=st.session_state.selectbox_color,
                 )
-            response_text = response["output"]["message"]["content"][0]["text"]
-
-            # parse graphs from the completion
-            ls_str_mermaid_graph = find_between(
-                response_text, 
-                "<mermaid>", 
-                "</mermaid>"
+            display_diagram(
+                dc_diagram=dc_output, 
+                webpage_title=st.session_state.webpage_title,
+                iteration=d+1,
+                theme=st.session_state.selectbox_color,
+                show_image=False,
             )
-
-            # check validity of graphs and extract details
-            for d,str_mermaid_graph in enumerate(ls_str_mermaid_graph):
-                graph_validity = check_graph_validity(
-                        standardize_graph(str_mermaid_graph),
-                    )
-                if graph_validity is True:
-                    ls_valid_indx.append(d)
-                    dc_output = {}
-                    dc_output["raw"] = response_text
-                    dc_output["graph"] = str_mermaid_graph
-                    dc_output["processed_graph"] = standardize_graph(str_mermaid_graph)
-                    dc_output["valid"] = graph_validity
-                    ls_diagrams.append(dc_output)
-
-                    display_diagram(
-                        dc_diagram=dc_output, 
-                        webpage_title=st.session_state.webpage_title, 
-                        iteration=d+1,
-                        theme=st.session_state.selectbox_color
-                    )
-                else:
-                    st.write("Variant " + str(d) + " is not valid!")
-            if len(ls_valid_indx) == 0:
-                st.write("No valid candidate was found. Regenerating...")
-               
-        duration = time.time() - start_time
-        status.update(label="Visual gist completed! (in " + str(round(duration,1)) + " sec)", state="complete", expanded=True)
-    return ls_diagrams
-
-
+            
+    elif event in ("done", "error"):
+        duration = dc_view["time"] - dc_view["start_time"]
+        dc_view["status"].update(
+            label="Visual gist completed! (in " + str(round(duration,1)) + " sec)", 
+            state="complete" if event == "done" else "error", 
+            expanded=True
+        )
 
 
 
-def generate_diagram(
-    url,
-    prompt,
-    number_of_diagrams=1,
-    orientation="LR", # "LR" or "TD"
-    repeat_on_error=True,
-    max_tokens_to_sample=500,
-    temperature=0.9,
-    top_k=250,
-    top_p=1,
-):
-    
-    start_time = time.time()
-    
-    with st.status("Generating " + str(number_of_diagrams) + " visual gists...", expanded=True) as status:
+def display_selection(dc_view, event, payload, config):
+    # tournament: local pruning, then concurrent small-bracket comparisons by the model
+    if event == "done":
+        # kept even without a selection, the refinement view compares its result to it
+        dc_view["selected"] = payload["selected"]
+    if config.select is False:
+        return
+    if event == "start":
+        st.markdown("""---""") 
+        st.write("Selecting the best among " + str(len(dc_view["diagrams"])) + " diagrams...")
         
-        ls_diagrams=[]
-        key_count = 0
-        modelId = st.session_state.model_generate
-        system_prompt = st.session_state.prompt_template_system
-
-        for d in range(number_of_diagrams):
-
-            # generate graph
-            attempt = 1
-            graph_error = True
-            while graph_error == True:
-                key_count += 1
-                st.write("Generating variation " + str(d+1) + " out of " + str(number_of_diagrams) + " (attempt " + str(attempt) + ")")
-                
-                response = st.session_state.bedrock_runtime.converse(
-                    modelId=modelId,
-                    inferenceConfig={
-                        "temperature": temperature,
-                        "maxTokens": max_tokens_to_sample,
-                        "topP": top_p,
-                        # "topK": top_k,
-                    },
-                    system=[
-                        {
-                            "text": system_prompt
-                        }
-                    ],
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "text": prompt
-                                }
-                            ]
-                        }
-                    ],
+    elif event == "done":
+        dc_selection = payload["selection"]
+        if dc_selection is not None:
+            for i, dc_score in enumerate(dc_selection["scores"]):
+                st.caption(
+                    "Diagram " + str(i) + ": local score " + str(round(dc_score["score"], 2)) + 
+                    " (structure " + str(round(dc_score["structure"], 2)) + 
+                    ", term overlap " + str(round(dc_score["overlap"], 2)) + ")"
                 )
-                response_text = response["output"]["message"]["content"][0]["text"]
+            if dc_selection["pruned"] > 0:
+                st.write(str(dc_selection["pruned"]) + " diagrams were pruned by their local score")
+            st.write(
+                str(dc_selection["comparisons"]) + " comparisons in " + str(dc_selection["rounds"]) + " rounds"
+            )
+            if dc_selection["fallback"] > 0:
+                st.write(str(dc_selection["fallback"]) + " comparisons returned no valid index, the local score decided")
+            st.caption(llm.format_usage(dc_selection["usage"]))
+            with st.expander("How the other variants differ from the selected one"):
+                for d, dc_diagram in enumerate(dc_view["diagrams"]):
+                    if d != dc_selection["indx_selected"]:
+                        dc_changes = diff.diff_graphs(payload["selected"]["processed_graph"], dc_diagram["processed_graph"])
+                        st.markdown(
+                            "**Variant " + str(d+1) + "**: " + dc_changes.summary() + 
+                            " (" + str(round(100 * dc_changes.change_ratio())) + "% different)"
+                        )
 
-                # parse graphs from the completion
-                ls_mermaid_graph = find_between(
-                    response_text, 
-                    "<mermaid>", 
-                    "</mermaid>"
-                )
-                str_mermaid_graph = ls_mermaid_graph[0]
-                graph_validity = check_graph_validity(
-                    standardize_graph(str_mermaid_graph),
-                )
+        display_variants(
+            diagram = payload["selected"],
+            webpage_title=st.session_state.webpage_title, 
+            theme=st.session_state.selectbox_color
+        )
+        dc_view["displayed"] = True
 
-                if repeat_on_error is True:
-                    graph_error = not graph_validity
-                    attempt += 1
-                    if graph_error is True:
-                        st.write("Graph has errors! Reattempting...")
-                else:
-                    graph_error = False
-
-            # log outputs
-            dc_output = {}
-            dc_output["raw"] = response_text
-            dc_output["graph"] = str_mermaid_graph
-            dc_output["processed_graph"] = standardize_graph(str_mermaid_graph)
-            dc_output["valid"] = graph_validity
-            ls_diagrams.append(dc_output)
+
+
+def display_refinement(dc_view, event, payload, config):
+    # progress of the refine stage: the iterations so far, in a single component above the log
+    if config.refine_iterations <= 0:
+        return
+    if event == "start":
+        st.markdown("""---""") 
+        st.write("Refining diagram...")
+        dc_view["gallery"] = st.empty()
+        dc_view["iteration_graphs"] = []
+        
+    elif event == "iteration":
+        st.write("Iteration " + str(payload["iteration"]) + ":")
+        st.caption(llm.format_usage(payload["usage"]))
+        dc_view["iteration_graphs"].append(payload["graph"])
+        with dc_view["gallery"].container():
+            display_gallery(
+                dc_view["iteration_graphs"], 
+                ["Iteration " + str(j) for j in range(len(dc_view["iteration_graphs"]))],
+                theme=st.session_state.selectbox_color,
+            )
+        # what changed since the previous iteration
+        dc_changes = payload["changes"]
+        with st.expander(
+            "What changed: " + dc_changes.summary() + 
+            " (" + str(round(100 * dc_changes.change_ratio())) + "% of the diagram)"
+        ):
+            st.markdown(dc_changes.to_markdown())
+        if payload["stop_reason"] is not None:
+            st.write("Converged (" + payload["stop_reason"] + ")")
             
-            display_diagram(
-                dc_diagram=dc_output, 
-                webpage_title=st.session_state.webpage_title,
-                iteration=d+1,
-                theme=st.session_state.selectbox_color
+    elif event == "done":
+        dc_refined = payload["refinement"]
+        if dc_refined["iterations_skipped"] > 0:
+            st.write(
+                "Skipped " + str(dc_refined["iterations_skipped"]) + 
+                " iterations, saving about " + str(round(dc_refined["time_saved"], 1)) + " sec"
             )
-    
-        duration = time.time() - start_time
-        status.update(
-            label="Visual gist completed! (in " + str(round(duration,1)) + " sec)", 
-            state="complete", 
-            expanded=True
-        )
-    return ls_diagrams
+        st.caption("Refinement: " + str(dc_refined["usage"].get("inputTokens", 0)) + " uncached input tokens in total")
+        dc_changes = diff.diff_graphs(dc_view["selected"]["processed_graph"], dc_refined["refined_diagram"])
+        with st.expander("What the refinement changed: " + dc_changes.summary()):
+            st.markdown(dc_changes.to_markdown())
+
+
+
+def display_job(job):
+    # replays the events of the job recorded so far, then follows the new ones until it
+    # finishes. A rerun only interrupts this display: the job goes on in the background,
+    # and the next run attaches to it again. Returns the view, to tell what was displayed
+    config = job.config
+    dc_view = {}
+    progress = st.empty()
+    i_event = 0
+    while True:
+        ls_events = job.wait(i_event, timeout=0.5)
+        for stage, event, payload, event_time in ls_events:
+            dc_view["time"] = event_time  # when it happened, not when it is displayed
+            if event == "coalesced" and payload == "store":
+                st.info("An identical visual gist was generated recently, its result is reused.")
+            elif event == "coalesced":
+                st.info("An identical visual gist is being generated for another session, its result will be shared.")
+            elif stage == "generate":
+                display_generation(dc_view, event, payload, config)
+            elif stage == "validate" and event == "done":
+                dc_view["diagrams"] = payload["diagrams"]
+            elif stage == "select":
+                display_selection(dc_view, event, payload, config)
+            elif stage == "refine":
+                display_refinement(dc_view, event, payload, config)
+        i_event += len(ls_events)
+        if job.is_finished() and len(ls_events) == 0:
+            break
+        # also gives a rerun the chance to interrupt the display while waiting
+        if job.status == jobs.QUEUED:
+            progress.caption("Waiting for other visual gists to complete...")
+        else:
+            progress.caption("Running for " + str(round(job.duration())) + " sec")
+    progress.empty()
+    return dc_view
+
 
 
+def cancel_job():
+    # the job stops unless other sessions are attached to it (see jobs.Job.cancel())
+    job = jobs.get_job_runner().get(st.session_state.job_id)
+    if job is not None:
+        job.cancel()
+    st.session_state.job_id = None
+
 
 
 def text_url_changed():
@@ -620,6 +466,8 @@ def text_url_changed():
         
     else:
         st.session_state.text_content = None
+    st.session_state.visual_gist = None
+    st.session_state.job_id = None  # a job for the previous text goes on, but is not shown
         
         
         
@@ -629,6 +477,8 @@ def text_raw_changed():
         st.session_state.text_url = ""  # deactivate the URL input
     else:
         st.session_state.text_content = None
+    st.session_state.visual_gist = None
+    st.session_state.job_id = None
 
         
 def model_generate_changed():
@@ -637,11 +487,43 @@ def model_generate_changed():
 def model_reflect_changed():
     st.session_state.model_reflect = st.session_state.dc_available_model_ids[st.session_state.selectbox_model_reflect]
 
+def model_summarize_changed():
+    st.session_state.model_summarize = st.session_state.dc_available_model_ids[st.session_state.selectbox_model_summarize]
+
+
+def get_reference_text():
+    # the text given to the LLM stages: the full text, or a map-reduce summary of it if it
+    # exceeds the token budget (recomputed only when the text or the settings change)
+    key = (
+        st.session_state.text_content, 
+        st.session_state.input_token_budget, 
+        st.session_state.model_summarize
+    )
+    if st.session_state.text_reference_key != key:
+        with st.spinner("Condensing a long text..."):
+            dc_values = pipeline.Pipeline().run(
+                st.session_state.bedrock_runtime,
+                {"text": st.session_state.text_content},
+                config=pipeline.PipelineConfig(
+                    model_summarize=st.session_state.model_summarize,
+                    token_budget=st.session_state.input_token_budget,
+                    max_workers=st.session_state.input_max_workers,
+                ),
+                targets=("reference_text", "condensed"),
+                response_cache=get_response_cache(),
+            )
+        dc_condensed = dc_values["condensed"]
+        st.session_state.text_reference = dc_condensed["text"]
+        st.session_state.text_reference_info = dc_condensed
+        st.session_state.text_reference_key = key
+    return st.session_state.text_reference
+
 
 #----------------------------------------------------------- setting up environment
 
 if 'bedrock_runtime' not in st.session_state:
-    st.session_state.bedrock_runtime = bedrock.get_bedrock_client(
+    # shared by all the sessions of the process, with refreshed credentials
+    st.session_state.bedrock_runtime = bedrock.get_shared_bedrock_client(
         assumed_role = os.environ.get("BEDROCK_ASSUME_ROLE", None),
         region = os.environ.get("AWS_DEFAULT_REGION", None),
         runtime = True
@@ -683,43 +565,38 @@ if 'model_generate' not in st.session_state:
 if 'model_reflect' not in st.session_state:
     st.session_state.model_reflect = "anthropic.claude-3-5-sonnet-20240620-v1:0"
     
+if 'ls_cascade_models' not in st.session_state:
+    # from the fastest / cheapest to the most capable
+    st.session_state.ls_cascade_models = [
+        "anthropic.claude-3-haiku-20240307-v1:0",
+        "anthropic.claude-3-5-haiku-20241022-v1:0",
+        "anthropic.claude-3-5-sonnet-20241022-v2:0",
+    ]
+    
+if 'model_summarize' not in st.session_state:
+    st.session_state.model_summarize = "anthropic.claude-3-haiku-20240307-v1:0"
+    
 if 'text_content' not in st.session_state:
     st.session_state.text_content = None
     
+if 'text_reference' not in st.session_state:
+    st.session_state.text_reference = None
+    st.session_state.text_reference_info = None
+    st.session_state.text_reference_key = None
+    
 if 'diagrams' not in st.session_state:
     st.session_state.diagrams = []
     
+if 'visual_gist' not in st.session_state:
+    st.session_state.visual_gist = None  # last selected / refined diagram
+if 'job_id' not in st.session_state:
+    st.session_state.job_id = None  # background generation of this session, see jobs.py
+    
 if 'prompt_template_system' not in st.session_state:
-    st.session_state.prompt_template_system = """
-    You are a wise professor who can read any document, break it down to its essentials, and explain it visually to anyone, using Mermaid graphs.
-    """
+    st.session_state.prompt_template_system = gist.PROMPT_SYSTEM
     
 if 'prompt_template_variants' not in st.session_state:
-    st.session_state.prompt_template_variants = """         
-    Here is a given text for you to reference for the following task. Read it carefully because it is necessary for the task that you will have to solve. 
-
-    <text>
-    {html_text}
-    </text>
-
-    <task>
-    Summarize the given text and provide the summary inside <summary> tags. 
-    Then convert the summary to {how_many} diagrams using Mermaid notation. 
-    All Mermaid diagrams should capture the main gist of the summary. 
-    Someone who would only view the Mermaid diagrams, should understand the gist of the summary. 
-    The Mermaid diagrams should follow all the correct notation rules and should compile without any syntax errors.
-    Use the following specifications for the generated Mermaid diagrams:
-    </task>
-
-    <specifications>
-    1. Use different colors, node shapes (e.g. rectangle, circle, rhombus, hexagon, trapezoid, parallelogram etc.), and subgraphs to represent different concepts in the given text.
-    2. If you are using subgraphs, each subgraph should have its own indicative name inside quotes. 
-    3. Use "links with text" to indicate actions, relationships or influence between a source nodes and destination nodes.
-    4. The orientation of each of the {how_many} Mermaid diagrams should be {orientation}.
-    5. Include each of the {how_many} Mermaid diagrams inside <mermaid> </mermaid> tags.
-    6. Use only information from within the given text. Don't make up new information.
-    </specifications>
-    """
+    st.session_state.prompt_template_variants = gist.PROMPT_VARIANTS
     
     
 # if 'prompt_template_single' not in st.session_state:
@@ -752,33 +629,7 @@ if 'prompt_template_variants' not in st.session_state:
 
     
 if 'prompt_template_single' not in st.session_state:
-    st.session_state.prompt_template_single = """             
-    Here is a given text for you to reference for the following task. Read it carefully because it is necessary for the task that you will have to solve. 
-
-    <text>
-    {html_text}
-    </text>
-
-    <task>
-    Summarize the given text and provide the summary inside <summary> tags. 
-    Then convert the summary to a visually pleasing diagram using Mermaid notation. 
-    The diagram should capture the main gist of the summary, without too many low-level details. 
-    Someone who would only view the Mermaid diagram, should understand the gist of the summary. 
-    The Mermaid diagram should follow all the correct notation rules and should compile without any syntax errors.
-    Use the following specifications for the generated Mermaid diagram:
-    </task>
-
-    <specifications>
-    1. Use different colors, node shapes (e.g. rectangle, circle, rhombus, hexagon, trapezoid, parallelogram etc.), and subgraphs to represent different concepts and entities in the given text.
-    2. If you are using subgraphs, each subgraph should have its own indicative name inside quotes. 
-    3. Use "links with text" to indicate actions, relationships or influence between a source nodes and destination nodes.
-    4. The orientation of the Mermaid diagram should be {orientation}.
-    5. Include the Mermaid diagram inside <mermaid> </mermaid> tags.
-    6. Do not write anything after the </mermaid> tag.
-    7. Use only information from within the given text. Don't make up new information.
-    8. Before the output, check the result for any errors. 
-    </specifications>
-    """
+    st.session_state.prompt_template_single = gist.PROMPT_SINGLE
     
 
 #-------------------------------------------------------------------------------------------------------
@@ -857,6 +708,37 @@ with col1:
                             value=True,
                             key='checkbox_repeat',
                         )
+                        st.number_input(
+                            label='Max attempts per diagram', 
+                            key="input_max_attempts",
+                            min_value=1,
+                            max_value=10,
+                            step=1,
+                            value=4,
+                            help='Including repairs of invalid diagrams and retries after throttling or network errors'
+                        )
+                        st.number_input(
+                            label='Token budget per diagram, in calls', 
+                            key="input_budget_calls",
+                            min_value=1,
+                            max_value=10,
+                            step=1,
+                            value=4,
+                            help='Tokens a diagram may use over all its attempts, counted in calls with the whole text and the maximum output'
+                        )
+                        st.checkbox(
+                            'Stream responses',
+                            value=True,
+                            key='checkbox_stream',
+                        )
+                        st.number_input(
+                            label='Max parallel requests', 
+                            key="input_max_workers",
+                            min_value=1,
+                            max_value=10,
+                            step=1,
+                            value=5
+                        )
                         st.selectbox(
                             label='Model', 
                             key='selectbox_model_generate',
@@ -864,6 +746,24 @@ with col1:
                             index=2,
                             on_change=model_generate_changed
                         )
+                        st.checkbox(
+                            'Model cascade',
+                            value=False,
+                            key='checkbox_cascade',
+                            help=(
+                                'Generate with the fastest model first, and escalate to larger models only '
+                                'if the diagram is invalid or too small (only when generating separately)'
+                            )
+                        )
+                        dc_headroom = ratelimit.get_rate_limiter(st.session_state.model_generate).headroom()
+                        st.metric(
+                            label='Throttle headroom',
+                            value=str(round(100 * min(dc_headroom["requests"], dc_headroom["tokens"]))) + "%",
+                            help=(
+                                'Share of the requests and tokens per minute quota of the model currently '
+                                'available to this server (' + str(dc_headroom["queued"]) + ' requests queued)'
+                            )
+                        )
                         
                 with ccol1:  
                     with st.container(border=True):
@@ -880,7 +780,20 @@ with col1:
                             options=('default', 'neutral', 'dark', 'forest'),
                             index=0
                         )
-                        st.markdown(" \n\n\n\n\n\n")
+                        st.selectbox(
+                            label='Renderer', 
+                            key='selectbox_renderer',
+                            options=('Mermaid', 'Static SVG'),
+                            index=0,
+                            help='Static SVG diagrams are rendered on the server, without loading Mermaid in the browser'
+                        )
+                        st.checkbox(
+                            'Collapse subgraphs',
+                            value=False,
+                            key='checkbox_collapse',
+                            help='Show each subgraph as a single node'
+                        )
+                        st.caption('Appearance changes are applied to the last visual gist without regenerating it')
                         
                 with ccol2:  
                     with st.container(border=True):
@@ -890,6 +803,22 @@ with col1:
                             value=True,
                             key='checkbox_select_diag',
                         )
+                        st.selectbox(
+                            label='Selection', 
+                            key='selectbox_selection',
+                            options=('LLM tournament', 'Local score only'),
+                            index=0,
+                            help='The local score rates the structure of the diagrams and the overlap of their labels with the text, without calling a model'
+                        )
+                        st.number_input(
+                            label='Candidates compared by the LLM', 
+                            key="input_top_k",
+                            min_value=2,
+                            max_value=10,
+                            step=1,
+                            value=4,
+                            help='Only the best candidates by local score are compared by the LLM'
+                        )
                         st.checkbox(
                             'Refine diagram',
                             value=True,
@@ -901,6 +830,12 @@ with col1:
                         #     options=('Select best diagram', 'Select & refine best diagram'),
                         #     index=0
                         # )
+                        st.checkbox(
+                            'Multi-turn refinement',
+                            value=True,
+                            key='checkbox_multi_turn',
+                            help='Send the text once and continue the conversation, instead of a full prompt per cycle (only with the models supporting prompt caching)'
+                        )
                         st.number_input(
                             label='Number of reflection cycles', 
                             key="input_number_cycles",
@@ -951,6 +886,31 @@ with col1:
                     step=0.01,
                     key='slider_top_p',
                 )
+                ccol0, ccol1 = st.columns(2)
+                with ccol0:
+                    st.number_input(
+                        label='Token budget for the text',
+                        key='input_token_budget',
+                        min_value=1000,
+                        max_value=200000,
+                        step=1000,
+                        value=50000,
+                        help='Longer texts are split in chunks and summarized first'
+                    )
+                with ccol1:
+                    st.selectbox(
+                        label='Summarization model', 
+                        key='selectbox_model_summarize',
+                        options=(st.session_state.ls_available_models),
+                        index=0,
+                        on_change=model_summarize_changed
+                    )
+                st.checkbox(
+                    'Bypass response cache',
+                    value=False,
+                    key='checkbox_bypass_cache',
+                    help='Always call the model, even if the same request was answered before'
+                )
                 
         with tab_webpage_text:
             if st.session_state.text_content is None:
@@ -958,6 +918,14 @@ with col1:
             elif st.session_state.text_content == "":
                 st.markdown("There was a problem extracting text from the webpage!")
             else:
+                get_reference_text()
+                dc_condensed = st.session_state.text_reference_info
+                if dc_condensed is not None and dc_condensed["condensed"] is True:
+                    st.info(
+                        "The text has ~" + str(dc_condensed["tokens_before"]) + " tokens, more than the token budget. " +
+                        "The LLM stages use a summary of its " + str(dc_condensed["chunks"]) + " chunks (~" + 
+                        str(dc_condensed["tokens_after"]) + " tokens) instead."
+                    )
                 st.markdown(st.session_state.text_content)                
         
         with tab_prompt_template:
@@ -981,7 +949,7 @@ with col1:
                 else:
                     prompt = st.session_state.prompt_template_variants  # start from prompt template
 
-                prompt = prompt.replace("{html_text}", st.session_state.text_content)
+                prompt = prompt.replace("{html_text}", get_reference_text())
                 prompt = prompt.replace("{orientation}", orientation)
                 prompt = prompt.replace("{how_many}", str(number_of_diagrams))
                 
@@ -1000,8 +968,13 @@ with col2:
     with st.container(border=True):
         st.subheader("Visual gist")
 
+        # the generation of this session, running in the background (see jobs.py)
+        job = jobs.get_job_runner().get(st.session_state.job_id) if st.session_state.job_id is not None else None
+
         if (st.session_state.text_content is None) | (st.session_state.text_content == ""):
             button_disabled = True
+        elif job is not None and job.is_finished() is False:
+            button_disabled = True  # one generation at a time, a rerun attaches to it
         else:
             button_disabled = False
 
@@ -1010,66 +983,54 @@ with col2:
                 key='button_generate',
                 disabled=button_disabled,
             ):
-            
-            if st.session_state.selectbox_technique == 'Generate separately':
-                # individual graphs
-                ls_diagrams = generate_diagram(
-                    url=st.session_state.text_url,
-                    prompt=st.session_state.text_prompt,
-                    number_of_diagrams=st.session_state.input_number_of_diagrams,
-                    orientation=st.session_state.selectbox_orientation,
-                    repeat_on_error=st.session_state.checkbox_repeat,
-                    max_tokens_to_sample=st.session_state.slider_max_tokens,
-                    temperature=st.session_state.slider_temperature,
-                    top_p=st.session_state.slider_top_p,
-                )
-            else:
-                # variants and selecting the best
-                ls_diagrams = generate_diagram_variants(
-                    url=st.session_state.text_url,
-                    prompt=st.session_state.text_prompt,
-                    number_of_diagrams=st.session_state.input_number_of_diagrams,
-                    orientation=st.session_state.selectbox_orientation,
-                    repeat_on_error=st.session_state.checkbox_repeat,
-                    max_tokens_to_sample=st.session_state.slider_max_tokens,
-                    temperature=st.session_state.slider_temperature,
-                    top_p=st.session_state.slider_top_p,
-                )
-                
-            
-            #------
-            
-            
-            if st.session_state.checkbox_select_diag == True:
-                st.markdown("""---""") 
-                st.write("Selecting the best among " + str(str(len(ls_diagrams))) + " diagrams...")
-        
-                if len(ls_diagrams) > 1:
-                    dc_selection = select_diagram(ls_diagrams)
-                    selected_diagram = ls_diagrams[dc_selection["indx_selected"]]
-                    selected_diagram["justification"] = dc_selection["raw_output"]
-                else:
-                    selected_diagram = ls_diagrams[0]
-                    selected_diagram["justification"] = "This is the only available diagram"
+            # the whole pipeline from the edited prompt, in one job that survives reruns
+            job = jobs.get_job_runner().submit(
+                st.session_state.bedrock_runtime,
+                {
+                    "reference_text": get_reference_text(),
+                    "prompt": st.session_state.text_prompt,
+                },
+                config=get_pipeline_config(),
+                targets=("graph", "justification"),
+                response_cache=get_response_cache(),
+                retry_policy=get_retry_policy(),
+                # bypassing the cache also bypasses the results shared by identical requests
+                coalesce=st.session_state.checkbox_bypass_cache is False,
+            )
+            st.session_state.job_id = job.id
+            st.session_state.visual_gist = None
 
-                display_variants(
-                    diagram = selected_diagram,
-                    webpage_title=st.session_state.webpage_title, 
-                    theme=st.session_state.selectbox_color
-                )
+        if job is not None:
+            if job.is_finished() is False:
+                st.button(label='Cancel', key='button_cancel', on_click=cancel_job)
+            dc_view = display_job(job)
+            
+            if job.status == jobs.DONE:
+                # kept, so that appearance changes re-render it instead of regenerating
+                st.session_state.visual_gist = {
+                    **job.values["selected"],
+                    "processed_graph": job.values["graph"],
+                    "justification": job.values["justification"],
+                }
+                # a result shared by another run comes without the stage events that display it
+                if dc_view.get("displayed") is not True:
+                    display_variants(
+                        diagram=st.session_state.visual_gist,
+                        webpage_title=st.session_state.webpage_title, 
+                        theme=st.session_state.selectbox_color
+                    )
+            elif job.status == jobs.FAILED:
+                st.error("No visual gist could be generated (" + str(job.error) + "), please try again.")
             else:
-                selected_diagram = ls_diagrams[0]
-                selected_diagram["justification"] = "This is the only available diagram"
+                st.warning("The generation was cancelled.")
+            st.session_state.job_id = None
 
-                
-            if st.session_state.checkbox_refine_diag == True:
-                st.markdown("""---""") 
-                st.write("Refining diagram...")
-        
-                refined_diagram = refine_diagram(
-                    diagram=selected_diagram["processed_graph"], 
-                    iterations=st.session_state.input_number_cycles
-                )
+        elif st.session_state.visual_gist is not None:
+            display_variants(
+                diagram=st.session_state.visual_gist,
+                webpage_title=st.session_state.webpage_title, 
+                theme=st.session_state.selectbox_color
+            )
 
                 
                 
@@ -4,6 +4,7 @@ from urllib.request import urlopen, Request
 from bs4 import BeautifulSoup
 import base64
 import bedrock
+import mermaid
 import time
 import os
 import re
@@ -80,18 +81,9 @@ def render_graph(graph, show_link=False):
     
     
 def check_graph_validity(graph):
-    # checks syntax validity of a mermaid graph
+    # checks syntax validity of a mermaid graph, offline (no round trip to mermaid.ink)
     # st.write("```" + graph)
-    graphbytes = graph.encode("utf8")
-    base64_bytes = base64.urlsafe_b64encode(graphbytes)
-    base64_string = base64_bytes.decode("ascii")
-    url = "https://mermaid.ink/img/" + base64_string
-    req = Request(url, headers={'User-Agent' : "Magic Browser"})
-    flag_valid = True
-    try: 
-        con = urlopen(req)
-    except:
-        flag_valid = False
+    flag_valid = len(mermaid.validate_graph(graph)) == 0
     return flag_valid
 
 
@@ -0,0 +1,161 @@
+"""Headless batch generation of visual gists, e.g. to pre-generate thousands of them overnight
+
+Usage:
+
+    python batch.py urls.txt -o gists.jsonl --documents 4 --variants 3 --refine 1
+
+The input file has one document per line: a URL, or a plain text (with "\\n" for line
+breaks). A .jsonl input file has one JSON object per line, with a "url" or a "text" and an
+optional "id". Each result is appended to the output JSONL file as soon as it is ready;
+documents whose id is already in the output file are skipped, so an interrupted run can
+simply be started again.
+"""
+# Python Built-Ins:
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List
+
+# Local Dependencies:
+import bedrock
+import cache
+import gist
+import llm
+import pipeline
+import retry
+
+
+def read_documents(path: str) -> List[dict]:
+    """Documents of an input file, as dictionaries with an "id" and a "url" or a "text" """
+    ls_documents = []
+    with open(path, encoding="utf8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if line == "":
+                continue
+            if path.endswith(".jsonl"):
+                dc_document = json.loads(line)
+                if "url" not in dc_document and "text" not in dc_document:
+                    raise ValueError(f"line {line_number}: a 'url' or a 'text' is needed")
+            elif line.startswith(("http://", "https://")):
+                dc_document = {"url": line}
+            else:
+                dc_document = {"text": line.replace("\\n", "\n")}
+            if "id" not in dc_document:
+                dc_document["id"] = dc_document.get("url") or cache.hash_key("text", dc_document["text"])[:16]
+            ls_documents.append(dc_document)
+    return ls_documents
+
+
+def read_done_ids(path: str) -> set:
+    """Ids of the documents already in an output file"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            try:
+                dc_result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # truncated last line of an interrupted run
+            if dc_result.get("error") is None:
+                done.add(dc_result["id"])
+    return done
+
+
+def parse_arguments(ls_arguments=None):
+    parser = argparse.ArgumentParser(description="Generate visual gists for a list of URLs or texts")
+    parser.add_argument("input", help="file with one URL or text per line, or a .jsonl file")
+    parser.add_argument("-o", "--output", default="gists.jsonl", help="output JSONL file (appended)")
+    parser.add_argument("--documents", type=int, default=4, help="documents in the model stages at the same time, as many more are fetched ahead")
+    parser.add_argument("--workers", type=int, default=5, help="parallel LLM calls per document")
+    parser.add_argument("--variants", type=int, default=3, help="diagrams generated per document")
+    parser.add_argument("--at-once", action="store_true", help="generate all the diagrams in one completion")
+    parser.add_argument("--refine", type=int, default=1, help="refinement iterations (0 to skip)")
+    parser.add_argument("--orientation", default="LR", choices=("LR", "RL", "TD", "BT"))
+    parser.add_argument("--local-selection", action="store_true", help="select by local score only")
+    parser.add_argument("--cascade", action="store_true", help="generate with the model cascade")
+    parser.add_argument("--model-generate", default=gist.DEFAULT_MODEL_GENERATE)
+    parser.add_argument("--model-reflect", default=gist.DEFAULT_MODEL_REFLECT)
+    parser.add_argument("--model-summarize", default=gist.DEFAULT_MODEL_SUMMARIZE)
+    parser.add_argument("--token-budget", type=int, default=gist.DEFAULT_TOKEN_BUDGET)
+    parser.add_argument("--max-attempts", type=int, default=4, help="LLM attempts per run")
+    parser.add_argument("--budget-calls", type=float, default=4, help="token budget per run, in calls with the whole text and the maximum output")
+    parser.add_argument("--overwrite", action="store_true", help="also redo documents already in the output")
+    return parser.parse_args(ls_arguments)
+
+
+def main(ls_arguments=None):
+    args = parse_arguments(ls_arguments)
+    ls_documents = read_documents(args.input)
+    done = set() if args.overwrite else read_done_ids(args.output)
+    ls_pending = [dc_document for dc_document in ls_documents if dc_document["id"] not in done]
+    print(
+        f"{len(ls_documents)} documents, {len(ls_documents) - len(ls_pending)} already done, "
+        f"{len(ls_pending)} to generate ({args.documents} in parallel)",
+        file=sys.stderr
+    )
+
+    # one client for all the threads, with enough connections for all their calls
+    bedrock_runtime = bedrock.get_shared_bedrock_client(
+        assumed_role=os.environ.get("BEDROCK_ASSUME_ROLE", None),
+        region=os.environ.get("AWS_DEFAULT_REGION", None),
+        runtime=True,
+        max_pool_connections=max(bedrock.DEFAULT_MAX_POOL_CONNECTIONS, args.documents * args.workers),
+    )
+    config = pipeline.PipelineConfig(
+        model_generate=args.model_generate,
+        model_reflect=args.model_reflect,
+        model_summarize=args.model_summarize,
+        cascade_models=tuple(gist.DEFAULT_CASCADE_MODELS) if args.cascade else None,
+        number_of_diagrams=args.variants,
+        generate_at_once=args.at_once,
+        orientation=args.orientation,
+        token_budget=args.token_budget,
+        local_only=args.local_selection,
+        refine_iterations=args.refine,
+        max_workers=args.workers,
+    )
+
+    start = time.time()
+    failures = 0
+    # the pages of the next documents are fetched while the model works on the current ones
+    ls_inputs = [pipeline.document_inputs(dc_document.get("url"), dc_document.get("text")) for dc_document in ls_pending]
+    with open(args.output, "a", encoding="utf8") as output:
+        for i, (index, dc_values, error) in enumerate(pipeline.Pipeline().run_many(
+            bedrock_runtime,
+            ls_inputs,
+            config=config,
+            targets=("graph", "justification"),
+            max_documents=args.documents,
+            prefetch=args.documents,
+            response_cache=llm.get_response_cache(),
+            retry_policy=retry.RetryPolicy(
+                max_attempts=args.max_attempts,
+                token_budget=retry.token_budget(args.budget_calls, config.token_budget, config.max_tokens_to_sample),
+            ),
+            coalesce=True,  # identical documents, here or in the app, are generated once
+        ), start=1):
+            dc_document = ls_pending[index]
+            if error is None:
+                dc_result = {"id": dc_document["id"], **pipeline.gist_record(dc_values), "error": None}
+            else:
+                failures += 1
+                dc_result = {"id": dc_document["id"], "url": dc_document.get("url"), "error": repr(error)}
+            output.write(json.dumps(dc_result, ensure_ascii=False) + "\n")
+            output.flush()  # results survive an interrupted run
+            status = "failed: " + dc_result["error"] if dc_result["error"] else f"{dc_result['timings']['total']:.1f} sec"
+            print(f"[{i}/{len(ls_pending)}] {dc_document['id']}: {status}", file=sys.stderr)
+
+    print(
+        f"Done in {time.time() - start:.1f} sec, {len(ls_pending) - failures} gists written to "
+        f"{args.output}, {failures} failures",
+        file=sys.stderr
+    )
+    return 1 if failures > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,20 +3,37 @@
 """Helper utilities for working with Amazon Bedrock from Python notebooks"""
 # Python Built-Ins:
 import os
+import threading
 from typing import Optional
 
 # External Dependencies:
 import boto3
+import botocore.session
 from botocore.config import Config
+from botocore.credentials import CredentialProvider, RefreshableCredentials
+
+
+# size of the connection pool of a client: the default of botocore (10) is too small when
+# several browser sessions, each with several parallel requests, share the same client
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+ASSUMED_ROLE_DURATION = 3600  # seconds
+
+_clients = {}  # (region, assumed role, runtime) -> client shared by the whole process
+_clients_lock = threading.Lock()
 
 
 def get_bedrock_client(
     assumed_role: Optional[str] = None,
     region: Optional[str] = None,
     runtime: Optional[bool] = True,
+    max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS,
 ):
     """Create a boto3 client for Amazon Bedrock, with optional configuration overrides
 
+    The credentials of an assumed role are refreshed automatically before they expire, so
+    the client can be kept for the lifetime of the process. See get_shared_bedrock_client()
+    to reuse one client across sessions.
+
     Parameters
     ----------
     assumed_role :
@@ -27,6 +44,8 @@ def get_bedrock_client(
         If not specified, AWS_REGION or AWS_DEFAULT_REGION environment variable will be used.
     runtime :
         Optional choice of getting different client to perform operations with the Amazon Bedrock service.
+    max_pool_connections :
+        Maximum number of connections kept open by the client, i.e. of concurrent requests.
     """
     if region is None:
         target_region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION"))
@@ -34,34 +53,32 @@ def get_bedrock_client(
         target_region = region
 
     print(f"Create new client\n  Using region: {target_region}")
-    session_kwargs = {"region_name": target_region}
-    client_kwargs = {**session_kwargs}
 
     profile_name = os.environ.get("AWS_PROFILE")
     if profile_name:
         print(f"  Using profile: {profile_name}")
-        session_kwargs["profile_name"] = profile_name
 
     retry_config = Config(
         region_name=target_region,
+        max_pool_connections=max_pool_connections,
+        # a single transparent retry for connection blips: throttling is handled by the
+        # rate limiter and the retry policy of the app, not by blind immediate retries
         retries={
-            "max_attempts": 10,
+            "max_attempts": 2,
             "mode": "standard",
         },
     )
-    session = boto3.Session(**session_kwargs)
+    session = boto3.Session(botocore_session=_get_botocore_session(profile_name), region_name=target_region)
 
     if assumed_role:
         print(f"  Using role: {assumed_role}", end='')
-        sts = session.client("sts")
-        response = sts.assume_role(
-            RoleArn=str(assumed_role),
-            RoleSessionName="langchain-llm-1"
-        )
+        provider = _AssumedRoleProvider(session.client("sts"), assumed_role)
+        provider.load()  # assumes the role now, so that a failure shows here
         print(" ... successful!")
-        client_kwargs["aws_access_key_id"] = response["Credentials"]["AccessKeyId"]
-        client_kwargs["aws_secret_access_key"] = response["Credentials"]["SecretAccessKey"]
-        client_kwargs["aws_session_token"] = response["Credentials"]["SessionToken"]
+        # a session whose credentials are renewed by botocore shortly before they expire
+        botocore_session = _get_botocore_session(profile_name)
+        _add_credential_provider(botocore_session, provider)
+        session = boto3.Session(botocore_session=botocore_session, region_name=target_region)
 
     if runtime:
         service_name='bedrock-runtime'
@@ -71,9 +88,87 @@ def get_bedrock_client(
     bedrock_client = session.client(
         service_name=service_name,
         config=retry_config,
-        **client_kwargs
     )
 
     print("boto3 Bedrock client successfully created!")
     print(bedrock_client._endpoint)
     return bedrock_client
+
+
+def _get_botocore_session(profile_name: Optional[str]) -> botocore.session.Session:
+    # a new session, with the configuration (region, credentials...) of the profile if any
+    botocore_session = botocore.session.get_session()
+    if profile_name:
+        botocore_session.set_config_variable("profile", profile_name)
+    return botocore_session
+
+
+class _AssumedRoleProvider(CredentialProvider):
+    """Credentials of an assumed role, refreshed by botocore shortly before they expire"""
+
+    METHOD = "visual-gist-assume-role"
+
+    def __init__(self, sts, assumed_role: str):
+        super().__init__()
+        self.sts = sts
+        self.assumed_role = assumed_role
+        self._credentials = None
+
+    def load(self) -> RefreshableCredentials:
+        if self._credentials is None:
+            self._credentials = RefreshableCredentials.create_from_metadata(
+                metadata=_assume_role(self.sts, self.assumed_role),
+                refresh_using=lambda: _assume_role(self.sts, self.assumed_role),
+                method=self.METHOD,
+            )
+        return self._credentials
+
+
+def _add_credential_provider(botocore_session: botocore.session.Session, provider: CredentialProvider):
+    # first in the credential chain of the session, ahead of the environment and the profile
+    resolver = botocore_session.get_component("credential_provider")
+    if len(resolver.providers) == 0:
+        raise RuntimeError("The botocore session has no credential chain to add the assumed role to")
+    resolver.insert_before(resolver.providers[0].METHOD, provider)
+
+
+def _assume_role(sts, assumed_role: str) -> dict:
+    # credentials metadata in the format expected by RefreshableCredentials
+    response = sts.assume_role(
+        RoleArn=str(assumed_role),
+        RoleSessionName="langchain-llm-1",
+        DurationSeconds=ASSUMED_ROLE_DURATION,
+    )
+    return {
+        "access_key": response["Credentials"]["AccessKeyId"],
+        "secret_key": response["Credentials"]["SecretAccessKey"],
+        "token": response["Credentials"]["SessionToken"],
+        "expiry_time": response["Credentials"]["Expiration"].isoformat(),
+    }
+
+
+def get_shared_bedrock_client(
+    assumed_role: Optional[str] = None,
+    region: Optional[str] = None,
+    runtime: Optional[bool] = True,
+    max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS,
+):
+    """Return the process-wide Bedrock client for a region, role and service, creating it once
+
+    boto3 clients are thread-safe, so all the sessions of the app can share one client and
+    its connection pool, instead of each session assuming the role and opening its own
+    connections. Parameters are the same as for get_bedrock_client(); `max_pool_connections`
+    is only used when the client is created.
+    """
+    if region is None:
+        region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION"))
+    key = (region, assumed_role, bool(runtime))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = get_bedrock_client(
+                assumed_role=assumed_role,
+                region=region,
+                runtime=runtime,
+                max_pool_connections=max_pool_connections,
+            )
+        return _clients[key]
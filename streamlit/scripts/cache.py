@@ -0,0 +1,232 @@
+"""Persistent on-disk caches shared by all the Streamlit sessions of the app"""
+# Python Built-Ins:
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+
+def get_cache_dir() -> str:
+    """Return the directory holding the caches, creating it if needed
+
+    Defaults to ~/.cache/visual-gist, and can be overridden with the VISUAL_GIST_CACHE_DIR
+    environment variable.
+    """
+    cache_dir = os.environ.get(
+        "VISUAL_GIST_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "visual-gist")
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def hash_key(*parts) -> str:
+    """Return a stable sha256 hex digest of the given (JSON serializable) parts"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf8")).hexdigest()
+
+
+class CacheEntry(NamedTuple):
+    """A value read from a DiskCache"""
+    value: bytes
+    metadata: dict
+    created_at: float
+
+    def age(self) -> float:
+        return time.time() - self.created_at
+
+
+class DiskCache:
+    """Key/value store in a SQLite file, with TTL expiry and LRU eviction above a size cap
+
+    Values are raw bytes, stored along with a JSON serializable metadata dictionary. The
+    store can be used from several threads, and several processes can share the same file.
+
+    Parameters
+    ----------
+    name :
+        Name of the cache, used as the file name inside the cache directory.
+    max_size_bytes :
+        When the total size of the stored values exceeds this cap, the least recently used
+        entries are evicted.
+    ttl :
+        Optional time-to-live in seconds. Entries older than this are reported as expired
+        by get(), unless they are refreshed with touch().
+    cache_dir :
+        Optional directory of the cache file. Defaults to get_cache_dir().
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_size_bytes: int = 200 * 1024 * 1024,
+        ttl: Optional[float] = None,
+        cache_dir: Optional[str] = None,
+    ):
+        self.path = os.path.join(cache_dir or get_cache_dir(), name + ".sqlite")
+        self.max_size_bytes = max_size_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    metadata TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+            )
+
+    def get(self, key: str, include_expired: bool = False) -> Optional[CacheEntry]:
+        """Return the entry stored under `key`, or None if it is missing or expired
+
+        With include_expired=True, expired entries are returned too, e.g. so that they can
+        be revalidated against their source.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value, metadata, created_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+        entry = CacheEntry(value=row[0], metadata=json.loads(row[1]), created_at=row[2])
+        if include_expired is False and self.is_expired(entry):
+            return None
+        return entry
+
+    def is_expired(self, entry: CacheEntry) -> bool:
+        return self.ttl is not None and entry.age() > self.ttl
+
+    def put(self, key: str, value: bytes, metadata: Optional[dict] = None):
+        """Store a value under `key`, then evict LRU entries if the size cap is exceeded"""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, json.dumps(metadata or {}), len(value), now, now)
+            )
+            self._evict()
+
+    def touch(self, key: str, metadata: Optional[dict] = None):
+        """Mark an entry as fresh again (e.g. after a successful revalidation)"""
+        now = time.time()
+        with self._lock, self._connection:
+            if metadata is None:
+                self._connection.execute(
+                    "UPDATE entries SET created_at = ?, accessed_at = ? WHERE key = ?",
+                    (now, now, key)
+                )
+            else:
+                self._connection.execute(
+                    "UPDATE entries SET created_at = ?, accessed_at = ?, metadata = ? WHERE key = ?",
+                    (now, now, json.dumps(metadata), key)
+                )
+
+    def delete(self, key: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM entries")
+
+    def size(self) -> int:
+        """Total size in bytes of the stored values"""
+        with self._lock:
+            row = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return row[0]
+
+    def _evict(self):
+        # called with the lock held, inside a transaction
+        total_size = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        ls_rows = self._connection.execute(
+            "SELECT key, size FROM entries ORDER BY accessed_at ASC"
+        ).fetchall()
+        ls_evicted = []
+        for key, size in ls_rows:
+            if total_size <= self.max_size_bytes:
+                break
+            ls_evicted.append((key,))
+            total_size -= size
+        self._connection.executemany("DELETE FROM entries WHERE key = ?", ls_evicted)
+
+
+class TieredCache:
+    """Two-tier cache of JSON serializable values: an in-memory LRU in front of a DiskCache
+
+    Lookups are served from memory when possible, then from disk (promoting the value back
+    into memory). Writes go to both tiers.
+
+    Parameters
+    ----------
+    name :
+        Name of the disk tier, see DiskCache.
+    max_memory_entries :
+        Number of values kept in the in-memory LRU.
+    max_size_bytes, ttl, cache_dir :
+        Configuration of the disk tier, see DiskCache. The TTL applies to both tiers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_memory_entries: int = 256,
+        max_size_bytes: int = 100 * 1024 * 1024,
+        ttl: Optional[float] = None,
+        cache_dir: Optional[str] = None,
+    ):
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self.disk = DiskCache(name, max_size_bytes=max_size_bytes, ttl=ttl, cache_dir=cache_dir)
+        self._memory = OrderedDict()  # key -> (created_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Return the value stored under `key`, or None"""
+        with self._lock:
+            if key in self._memory:
+                created_at, value = self._memory[key]
+                if self.ttl is None or time.time() - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    return value
+                del self._memory[key]
+
+        entry = self.disk.get(key)
+        if entry is None:
+            return None
+        value = json.loads(entry.value)
+        self._remember(key, value, entry.created_at)
+        return value
+
+    def put(self, key: str, value):
+        self.disk.put(key, json.dumps(value).encode("utf8"))
+        self._remember(key, value, time.time())
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        self.disk.clear()
+
+    def _remember(self, key: str, value, created_at: float):
+        with self._lock:
+            self._memory[key] = (created_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
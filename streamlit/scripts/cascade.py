@@ -0,0 +1,125 @@
+"""Model cascade: try the fastest model first, and escalate to larger models only on failure"""
+# Python Built-Ins:
+import json
+import threading
+import time
+from typing import Callable, List, Optional
+
+# Local Dependencies:
+import cache
+import mermaid
+
+
+MIN_LINKS = 3  # a diagram with fewer links is considered too poor to keep
+MIN_SAMPLES = 5  # number of attempts before the success rate of a model is trusted
+MIN_SUCCESS_RATE = 0.5  # models below this rate are tried after the others
+
+_model_stats = None
+
+
+class ModelStats:
+    """Success rates and latencies of the models of the cascade, persisted on disk
+
+    Shared by all the sessions (and processes) using the same cache directory, so that the
+    cascade order adapts to how each model actually performs on the documents of the app.
+    """
+
+    def __init__(self, disk_cache: Optional[cache.DiskCache] = None):
+        self.disk = disk_cache or cache.DiskCache("model_stats", max_size_bytes=1024 * 1024)
+        self._lock = threading.Lock()
+
+    def get(self, model_id: str) -> dict:
+        entry = self.disk.get(model_id)
+        if entry is None:
+            return {"attempts": 0, "successes": 0, "latency": 0.0}
+        return json.loads(entry.value)
+
+    def record(self, model_id: str, success: bool, latency: float):
+        with self._lock:
+            dc_stats = self.get(model_id)
+            dc_stats["attempts"] += 1
+            dc_stats["successes"] += int(success)
+            dc_stats["latency"] += latency
+            self.disk.put(model_id, json.dumps(dc_stats).encode("utf8"))
+
+    def success_rate(self, model_id: str) -> Optional[float]:
+        """Smoothed success rate of a model, or None until it has MIN_SAMPLES attempts"""
+        dc_stats = self.get(model_id)
+        if dc_stats["attempts"] < MIN_SAMPLES:
+            return None
+        return (dc_stats["successes"] + 1) / (dc_stats["attempts"] + 2)
+
+
+def get_model_stats() -> ModelStats:
+    """Return the process-wide ModelStats"""
+    global _model_stats
+    if _model_stats is None:
+        _model_stats = ModelStats()
+    return _model_stats
+
+
+def order_models(ls_model_ids: List[str], stats: ModelStats) -> List[str]:
+    """Order the cascade: the configured order (fastest first), except that models whose
+    success rate is below MIN_SUCCESS_RATE are moved to the end, so they are skipped as long
+    as a later model succeeds"""
+    def is_unreliable(model_id):
+        rate = stats.success_rate(model_id)
+        return rate is not None and rate < MIN_SUCCESS_RATE
+    return sorted(ls_model_ids, key=is_unreliable)  # stable: keeps the configured order
+
+
+def is_acceptable(dc_output: dict, min_links: int = MIN_LINKS) -> bool:
+    """Default acceptance test of a generated diagram: valid, and not trivially small"""
+    return dc_output["valid"] is True and mermaid.count_links(dc_output["processed_graph"]) >= min_links
+
+
+def run_cascade(
+    ls_model_ids: List[str],
+    generate: Callable[[str], dict],
+    accept: Callable[[dict], bool] = is_acceptable,
+    stats: Optional[ModelStats] = None,
+) -> dict:
+    """Generate with each model of the cascade in turn, until one output is accepted
+
+    Parameters
+    ----------
+    ls_model_ids :
+        Model ids, from the fastest / cheapest to the most capable.
+    generate :
+        Function generating an output (a dictionary) with the given model id.
+    accept :
+        Function returning True if an output is good enough to stop the cascade.
+    stats :
+        Optional ModelStats recording the outcome of every model, and used to order them.
+
+    Returns
+    -------
+    The accepted output, or the output of the last model if none was accepted, with the
+    "model" that produced it and the list of models "escalated" from. Raises the last
+    exception if no model returned any output.
+    """
+    if stats is not None:
+        ls_model_ids = order_models(ls_model_ids, stats)
+    dc_output = None
+    last_error = None
+    ls_escalated = []
+    for model_id in ls_model_ids:
+        start_time = time.time()
+        try:
+            dc_candidate = generate(model_id)
+            success = accept(dc_candidate)
+        except Exception as e:
+            dc_candidate = None
+            success = False
+            last_error = e
+        if stats is not None:
+            stats.record(model_id, success, time.time() - start_time)
+        if dc_candidate is not None:
+            dc_output = {**dc_candidate, "model": model_id, "escalated": list(ls_escalated)}
+        if success:
+            return dc_output
+        ls_escalated.append(model_id)
+
+    if dc_output is None and last_error is not None:
+        raise last_error
+    return dc_output
@@ -0,0 +1,170 @@
+"""Map-reduce condensation of texts that are too long to be sent to the diagram stages as a whole"""
+# Python Built-Ins:
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+# Local Dependencies:
+import llm
+
+
+CHARS_PER_TOKEN = 4  # rough average for English text
+
+PROMPT_SUMMARIZE_CHUNK = """
+Here is part {index} out of {count} of a longer text.
+
+<text>
+{chunk}
+</text>
+
+Summarize this part of the text, keeping all its main points, concepts, entities and the relationships between them, as well as any important numbers or dates.
+Don't add any information that is not in the text.
+Provide the summary inside <summary></summary> XML tags.
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap estimate of the number of tokens of a text, without calling a tokenizer"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _split_block(block: str, max_chars: int) -> List[str]:
+    # splits a block that is too long on lines, then on sentences, then on whitespace
+    for pattern in (r"\n", r"(?<=[.!?])\s+", r"\s+"):
+        ls_parts = [part for part in re.split(pattern, block) if part.strip()]
+        if len(ls_parts) > 1:
+            return _pack(ls_parts, max_chars, separator="\n" if pattern == r"\n" else " ")
+    return [block[i:i + max_chars] for i in range(0, len(block), max_chars)]
+
+
+def _pack(ls_parts: List[str], max_chars: int, separator: str) -> List[str]:
+    # greedily packs consecutive parts into chunks of at most max_chars
+    ls_chunks = []
+    current = ""
+    for part in ls_parts:
+        if len(part) > max_chars:
+            if current:
+                ls_chunks.append(current)
+                current = ""
+            ls_chunks.extend(_split_block(part, max_chars))
+        elif current and len(current) + len(separator) + len(part) > max_chars:
+            ls_chunks.append(current)
+            current = part
+        else:
+            current = current + separator + part if current else part
+    if current:
+        ls_chunks.append(current)
+    return ls_chunks
+
+
+def split_text(text: str, max_tokens_per_chunk: int) -> List[str]:
+    """Split a text into chunks of at most `max_tokens_per_chunk` (estimated) tokens
+
+    Chunks follow the structure of the text: paragraphs (blocks separated by blank lines)
+    are kept together whenever possible, and only overly long paragraphs are split further
+    on lines, then on sentences.
+    """
+    max_chars = max_tokens_per_chunk * CHARS_PER_TOKEN
+    ls_paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+    return _pack(ls_paragraphs, max_chars, separator="\n\n")
+
+
+def summarize_chunks(
+    bedrock_runtime,
+    model_id: str,
+    ls_chunks: List[str],
+    max_tokens: int = 1024,
+    max_workers: int = 5,
+    response_cache=None,
+) -> List[str]:
+    """Summarize all the chunks in parallel, and return their summaries in the original order"""
+
+    def summarize(index):
+        prompt = PROMPT_SUMMARIZE_CHUNK.format(
+            index=index + 1,
+            count=len(ls_chunks),
+            chunk=ls_chunks[index]
+        )
+        dc_response = llm.converse(
+            bedrock_runtime,
+            model_id=model_id,
+            prompt=prompt,
+            temperature=0.1,  # be more factual
+            max_tokens=max_tokens,
+            top_p=1,
+            response_cache=response_cache,
+        )
+        ls_summary = re.findall(r"<summary>(.*?)</summary>", dc_response["text"], re.DOTALL)
+        return ls_summary[0].strip() if len(ls_summary) > 0 else dc_response["text"].strip()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(summarize, range(len(ls_chunks))))
+
+
+def condense_text(
+    bedrock_runtime,
+    text: str,
+    token_budget: int,
+    model_id: str,
+    max_workers: int = 5,
+    response_cache=None,
+    max_rounds: int = 3,
+):
+    """Return the text itself if it fits the token budget, otherwise a merged summary of its chunks
+
+    The text is split on structural boundaries into chunks of about half the budget, the
+    chunks are summarized in parallel (map) and the summaries are concatenated in order
+    (reduce). If the merged summary is still over budget, it is condensed again, up to
+    `max_rounds` times.
+
+    Parameters
+    ----------
+    bedrock_runtime :
+        A boto3 "bedrock-runtime" client.
+    text :
+        The full text.
+    token_budget :
+        Maximum number of (estimated) tokens of the text given to the diagram stages.
+    model_id :
+        Model used for summarizing the chunks, ideally a fast and cheap one.
+    max_workers :
+        Maximum number of chunks summarized at the same time.
+    response_cache :
+        Optional response cache, see llm.converse().
+    max_rounds :
+        Maximum number of map-reduce rounds.
+
+    Returns
+    -------
+    A dictionary with the resulting "text", whether it was "condensed", the number of
+    "chunks" of the first round, and the estimated "tokens_before" and "tokens_after".
+    """
+    tokens_before = estimate_tokens(text)
+    dc_output = {
+        "text": text,
+        "condensed": False,
+        "chunks": 1,
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_before,
+    }
+
+    for i_round in range(max_rounds):
+        if estimate_tokens(dc_output["text"]) <= token_budget:
+            break
+        ls_chunks = split_text(dc_output["text"], max(token_budget // 2, 256))
+        ls_summaries = summarize_chunks(
+            bedrock_runtime,
+            model_id,
+            ls_chunks,
+            max_tokens=min(max(token_budget // len(ls_chunks), 256), 2048),
+            max_workers=max_workers,
+            response_cache=response_cache,
+        )
+        if i_round == 0:
+            dc_output["chunks"] = len(ls_chunks)
+        dc_output["text"] = "\n\n".join(ls_summaries)
+        dc_output["condensed"] = True
+
+    dc_output["tokens_after"] = estimate_tokens(dc_output["text"])
+    return dc_output
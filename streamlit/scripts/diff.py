@@ -0,0 +1,309 @@
+"""Structural diff between two Mermaid diagrams, e.g. two refinement iterations or two variants
+
+Nodes are matched by id first, then the remaining ones by label: identical labels, then
+labels sharing enough terms (found through an inverted index, so that the matching stays
+near-linear on large diagrams). Links and subgraphs are compared through this matching,
+so that a node renamed by the model is reported as relabeled, not as removed and added.
+Appearance changes count too: node shapes, link arrows, the direction of the diagram and
+its classDef, class, style and linkStyle statements.
+"""
+# Python Built-Ins:
+from typing import Dict, List, Optional, Tuple, Union
+
+# Local Dependencies:
+import mermaid
+import scoring
+
+
+MIN_LABEL_SIMILARITY = 0.5  # Jaccard similarity of the label terms of two matched nodes
+MAX_CANDIDATES = 50  # nodes sharing a term beyond which the term is too common to index
+CONVERGENCE_THRESHOLD = 0.02  # change ratio under which another refinement is not worth it
+
+
+class GraphDiff:
+    """Differences between an old and a new diagram
+
+    Node and link changes refer to the ids of the new diagram, except for the removed
+    ones, which refer to the ids of the old diagram.
+    """
+    __slots__ = (
+        "matches", "added_nodes", "removed_nodes", "relabeled_nodes",
+        "added_edges", "removed_edges", "relabeled_edges",
+        "added_subgraphs", "removed_subgraphs", "retitled_subgraphs",
+        "reshaped_nodes", "rearrowed_edges", "restyled", "redirected", "total",
+    )
+
+    def __init__(self):
+        self.matches = {}  # old node id -> new node id
+        self.added_nodes = []  # node id
+        self.removed_nodes = []  # node id
+        self.relabeled_nodes = []  # (old id, new id, old label, new label)
+        self.added_edges = []  # (source, target, text)
+        self.removed_edges = []  # (source, target, text)
+        self.relabeled_edges = []  # (source, target, old text, new text)
+        self.added_subgraphs = []  # title
+        self.removed_subgraphs = []  # title
+        self.retitled_subgraphs = []  # (old title, new title)
+        self.reshaped_nodes = []  # (old id, new id, old shape, new shape)
+        self.rearrowed_edges = []  # (source, target, old arrow, new arrow)
+        self.restyled = []  # description of a changed classDef, class, style or linkStyle
+        self.redirected = None  # (old direction, new direction) of the diagram, if it changed
+        self.total = 0  # number of elements (nodes, links, subgraphs, styles) of both diagrams
+
+    def changes(self) -> int:
+        """Number of changed elements"""
+        return (
+            len(self.added_nodes) + len(self.removed_nodes) + len(self.relabeled_nodes)
+            + len(self.added_edges) + len(self.removed_edges) + len(self.relabeled_edges)
+            + len(self.added_subgraphs) + len(self.removed_subgraphs) + len(self.retitled_subgraphs)
+            + len(self.reshaped_nodes) + len(self.rearrowed_edges) + len(self.restyled)
+            + (1 if self.redirected is not None else 0)
+        )
+
+    def is_empty(self) -> bool:
+        return self.changes() == 0
+
+    def change_ratio(self) -> float:
+        """Share of the elements of the two diagrams that changed, between 0 and 1"""
+        return min(1.0, 2 * self.changes() / self.total) if self.total > 0 else 0.0
+
+    def converged(self, threshold: float = CONVERGENCE_THRESHOLD) -> bool:
+        """True if the diagram changed too little for another refinement to be worth it"""
+        return self.change_ratio() < threshold
+
+    def summary(self) -> str:
+        """One line summary, e.g. "+2 nodes, -1 link, 1 relabeled node" """
+        ls_parts = []
+        for count, what in (
+            (len(self.added_nodes), "+{} node"), (len(self.removed_nodes), "-{} node"),
+            (len(self.relabeled_nodes), "{} relabeled node"),
+            (len(self.added_edges), "+{} link"), (len(self.removed_edges), "-{} link"),
+            (len(self.relabeled_edges), "{} relabeled link"),
+            (len(self.added_subgraphs), "+{} subgraph"), (len(self.removed_subgraphs), "-{} subgraph"),
+            (len(self.retitled_subgraphs), "{} retitled subgraph"),
+            (len(self.reshaped_nodes), "{} reshaped node"), (len(self.rearrowed_edges), "{} changed arrow"),
+            (len(self.restyled), "{} style change"), (1 if self.redirected is not None else 0, "{} new direction"),
+        ):
+            if count > 0:
+                ls_parts.append(what.format(count) + ("s" if count > 1 else ""))
+        return ", ".join(ls_parts) if ls_parts else "no change"
+
+    def to_markdown(self) -> str:
+        """Bullet list of the changes, for display"""
+        ls_lines = []
+        for node_id in self.added_nodes:
+            ls_lines.append(f"- added node `{node_id}`")
+        for node_id in self.removed_nodes:
+            ls_lines.append(f"- removed node `{node_id}`")
+        for old_id, new_id, old_label, new_label in self.relabeled_nodes:
+            name = f"`{old_id}`" if old_id == new_id else f"`{old_id}` → `{new_id}`"
+            ls_lines.append(f"- node {name}: \"{old_label}\" → \"{new_label}\"")
+        for source, target, text in self.added_edges:
+            ls_lines.append(f"- added link `{source}` → `{target}`" + (f" \"{text}\"" if text else ""))
+        for source, target, text in self.removed_edges:
+            ls_lines.append(f"- removed link `{source}` → `{target}`" + (f" \"{text}\"" if text else ""))
+        for source, target, old_text, new_text in self.relabeled_edges:
+            ls_lines.append(f"- link `{source}` → `{target}`: \"{old_text or ''}\" → \"{new_text or ''}\"")
+        for title in self.added_subgraphs:
+            ls_lines.append(f"- added subgraph \"{title}\"")
+        for title in self.removed_subgraphs:
+            ls_lines.append(f"- removed subgraph \"{title}\"")
+        for old_title, new_title in self.retitled_subgraphs:
+            ls_lines.append(f"- subgraph \"{old_title}\" → \"{new_title}\"")
+        for old_id, new_id, old_shape, new_shape in self.reshaped_nodes:
+            name = f"`{old_id}`" if old_id == new_id else f"`{old_id}` → `{new_id}`"
+            ls_lines.append(f"- node {name}: {old_shape} → {new_shape}")
+        for source, target, old_arrow, new_arrow in self.rearrowed_edges:
+            ls_lines.append(f"- link `{source}` → `{target}`: `{old_arrow}` → `{new_arrow}`")
+        for description in self.restyled:
+            ls_lines.append(f"- changed {description}")
+        if self.redirected is not None:
+            ls_lines.append(f"- direction {self.redirected[0]} → {self.redirected[1]}")
+        return "\n".join(ls_lines) if ls_lines else "No change"
+
+
+def _label(node: mermaid.Node) -> str:
+    return node.label if node.label is not None else node.id
+
+
+def _normalize(label: str) -> str:
+    return " ".join(label.lower().split())
+
+
+def _shape(node: mermaid.Node) -> str:
+    return node.shape if node.shape is not None else "rectangle"
+
+
+def _direction(graph: mermaid.Graph) -> str:
+    # TD is an alias of TB, the default
+    return "TB" if graph.direction in (None, "TD") else graph.direction
+
+
+def _styles(styles: str) -> str:
+    return ",".join(part.strip() for part in styles.strip().rstrip(";").split(",") if part.strip())
+
+
+def match_nodes(old: mermaid.Graph, new: mermaid.Graph) -> Dict[str, str]:
+    """Match the nodes of two diagrams: by id, then by identical label, then by similar label
+
+    Returns the matching, as old node id -> new node id.
+    """
+    dc_matches = {node_id: node_id for node_id in old.nodes if node_id in new.nodes}
+    ls_old = [node for node_id, node in old.nodes.items() if node_id not in dc_matches]
+    dc_new = {node_id: node for node_id, node in new.nodes.items() if node_id not in dc_matches}
+
+    # identical labels
+    dc_by_label = {}
+    for node in dc_new.values():
+        dc_by_label.setdefault(_normalize(_label(node)), []).append(node.id)
+    ls_remaining = []
+    for node in ls_old:
+        ls_candidates = dc_by_label.get(_normalize(_label(node)))
+        if ls_candidates:
+            new_id = ls_candidates.pop(0)
+            dc_matches[node.id] = new_id
+            del dc_new[new_id]
+        else:
+            ls_remaining.append(node)
+
+    # similar labels: candidates share at least one term, best pairs first
+    dc_terms = {node_id: set(scoring.terms(_label(node))) for node_id, node in dc_new.items()}
+    dc_index = {}
+    for node_id, terms in dc_terms.items():
+        for term in terms:
+            dc_index.setdefault(term, []).append(node_id)
+    ls_pairs = []
+    for node in ls_remaining:
+        terms = set(scoring.terms(_label(node)))
+        candidates = set()
+        for term in terms:
+            ls_posting = dc_index.get(term, [])
+            if len(ls_posting) <= MAX_CANDIDATES:
+                candidates.update(ls_posting)
+        for new_id in candidates:
+            similarity = len(terms & dc_terms[new_id]) / len(terms | dc_terms[new_id])
+            if similarity >= MIN_LABEL_SIMILARITY:
+                ls_pairs.append((similarity, node.id, new_id))
+    matched_new = set()
+    for similarity, old_id, new_id in sorted(ls_pairs, key=lambda pair: -pair[0]):
+        if old_id not in dc_matches and new_id not in matched_new:
+            dc_matches[old_id] = new_id
+            matched_new.add(new_id)
+    return dc_matches
+
+
+def _edge_map(
+    graph: mermaid.Graph, dc_ids: Optional[Dict[str, str]] = None
+) -> Dict[Tuple[str, str], List[Tuple[Optional[str], str]]]:
+    # (source, target) -> (text, arrow) of the links between them, with the node ids renamed
+    dc_edges = {}
+    for edge in graph.edges:
+        source, target = edge.source, edge.target
+        if dc_ids is not None:
+            source, target = dc_ids.get(source, source), dc_ids.get(target, target)
+        dc_edges.setdefault((source, target), []).append((edge.text, edge.arrow))
+    return dc_edges
+
+
+def _diff_styles(old: mermaid.Graph, new: mermaid.Graph, dc_matches: Dict[str, str]) -> List[str]:
+    # changed classDef, class, style and linkStyle statements, with the node ids renamed
+    ls_changes = []
+    for name in list(old.class_defs) + [name for name in new.class_defs if name not in old.class_defs]:
+        old_styles, new_styles = old.class_defs.get(name), new.class_defs.get(name)
+        if old_styles is None or new_styles is None or _styles(old_styles) != _styles(new_styles):
+            ls_changes.append(f"classDef `{name}`")
+    for attribute, what, normalize in (("classes", "class", str), ("styles", "style", _styles)):
+        dc_old = {dc_matches.get(node_id, node_id): value for node_id, value in getattr(old, attribute).items()}
+        dc_new = getattr(new, attribute)
+        for node_id in list(dc_old) + [node_id for node_id in dc_new if node_id not in dc_old]:
+            old_value, new_value = dc_old.get(node_id), dc_new.get(node_id)
+            if old_value is None or new_value is None or normalize(old_value) != normalize(new_value):
+                ls_changes.append(f"{what} of node `{node_id}`")
+    set_old = {(indices.replace(" ", ""), _styles(styles)) for indices, styles in old.link_styles}
+    set_new = {(indices.replace(" ", ""), _styles(styles)) for indices, styles in new.link_styles}
+    for indices, styles in sorted(set_old ^ set_new):
+        ls_changes.append(f"linkStyle `{indices}`")
+    return ls_changes
+
+
+def diff_graphs(old: Union[str, mermaid.Graph], new: Union[str, mermaid.Graph]) -> GraphDiff:
+    """Structural diff between two diagrams (Mermaid code or parsed Graphs)
+
+    Runs in near-linear time in the size of the diagrams.
+    """
+    old = mermaid.parse(old) if isinstance(old, str) else old
+    new = mermaid.parse(new) if isinstance(new, str) else new
+    output = GraphDiff()
+    output.matches = match_nodes(old, new)
+    output.total = sum(
+        len(graph.nodes) + len(graph.edges) + len(graph.subgraphs)
+        + len(graph.class_defs) + len(graph.classes) + len(graph.styles) + len(graph.link_styles)
+        for graph in (old, new)
+    )
+    if _direction(old) != _direction(new):
+        output.redirected = (_direction(old), _direction(new))
+
+    matched_new = set(output.matches.values())
+    output.removed_nodes = [node_id for node_id in old.nodes if node_id not in output.matches]
+    output.added_nodes = [node_id for node_id in new.nodes if node_id not in matched_new]
+    for old_id, new_id in output.matches.items():
+        old_label, new_label = _label(old.nodes[old_id]), _label(new.nodes[new_id])
+        if _normalize(old_label) != _normalize(new_label):
+            output.relabeled_nodes.append((old_id, new_id, old_label, new_label))
+        if _shape(old.nodes[old_id]) != _shape(new.nodes[new_id]):
+            output.reshaped_nodes.append((old_id, new_id, _shape(old.nodes[old_id]), _shape(new.nodes[new_id])))
+
+    # links, with the old node ids renamed to the ids of their matches
+    dc_old_edges = _edge_map(old, output.matches)
+    dc_new_edges = _edge_map(new)
+    for pair in list(dc_old_edges) + [pair for pair in dc_new_edges if pair not in dc_old_edges]:
+        ls_old_links = list(dc_old_edges.get(pair, []))
+        ls_new_links = list(dc_new_edges.get(pair, []))
+        for link in list(ls_old_links):
+            if link in ls_new_links:
+                ls_old_links.remove(link)
+                ls_new_links.remove(link)
+        # same nodes and text, other arrow
+        for text, arrow in list(ls_old_links):
+            for new_text, new_arrow in ls_new_links:
+                if new_text == text:
+                    output.rearrowed_edges.append((pair[0], pair[1], arrow, new_arrow))
+                    ls_old_links.remove((text, arrow))
+                    ls_new_links.remove((new_text, new_arrow))
+                    break
+        # same nodes, other text: relabeled, as many as possible
+        while ls_old_links and ls_new_links:
+            (old_text, old_arrow), (new_text, new_arrow) = ls_old_links.pop(0), ls_new_links.pop(0)
+            output.relabeled_edges.append((pair[0], pair[1], old_text, new_text))
+            if old_arrow != new_arrow:
+                output.rearrowed_edges.append((pair[0], pair[1], old_arrow, new_arrow))
+        output.removed_edges.extend((pair[0], pair[1], text) for text, arrow in ls_old_links)
+        output.added_edges.extend((pair[0], pair[1], text) for text, arrow in ls_new_links)
+
+    output.restyled = _diff_styles(old, new, output.matches)
+
+    # subgraphs, matched by id, then by title
+    dc_new_subgraphs = {}
+    for subgraph in new.subgraphs:
+        dc_new_subgraphs.setdefault(("id", subgraph.id) if subgraph.id else ("title", subgraph.title), []).append(subgraph)
+    ls_unmatched = []
+    for subgraph in old.subgraphs:
+        key = ("id", subgraph.id) if subgraph.id else ("title", subgraph.title)
+        if dc_new_subgraphs.get(key):
+            match = dc_new_subgraphs[key].pop(0)
+            if match.title != subgraph.title:
+                output.retitled_subgraphs.append((subgraph.title, match.title))
+        else:
+            ls_unmatched.append(subgraph)
+    ls_new_remaining = [subgraph for ls_subgraphs in dc_new_subgraphs.values() for subgraph in ls_subgraphs]
+    dc_by_title = {}
+    for subgraph in ls_new_remaining:
+        dc_by_title.setdefault(_normalize(subgraph.title), []).append(subgraph)
+    for subgraph in ls_unmatched:
+        ls_candidates = dc_by_title.get(_normalize(subgraph.title))
+        if ls_candidates:
+            ls_new_remaining.remove(ls_candidates.pop(0))
+        else:
+            output.removed_subgraphs.append(subgraph.title or subgraph.id)
+    output.added_subgraphs = [subgraph.title or subgraph.id for subgraph in ls_new_remaining]
+    return output
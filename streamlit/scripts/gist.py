@@ -0,0 +1,744 @@
+"""Building blocks of the visual gist pipeline, without any Streamlit dependency
+
+Prompts, generation (with validation and repair), selection and refinement, configured
+only through their arguments, and reporting progress through optional callbacks. They can
+run in worker threads, and they are the building blocks of the stages of pipeline.py.
+"""
+# Python Built-Ins:
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Optional
+
+# Local Dependencies:
+import cascade
+import diff
+import llm
+import mermaid
+import repair
+import retry
+import selection
+
+
+DEFAULT_MODEL_GENERATE = "anthropic.claude-3-sonnet-20240229-v1:0"
+DEFAULT_MODEL_REFLECT = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+DEFAULT_MODEL_SUMMARIZE = "anthropic.claude-3-haiku-20240307-v1:0"
+# from the fastest / cheapest to the most capable
+DEFAULT_CASCADE_MODELS = [
+    "anthropic.claude-3-haiku-20240307-v1:0",
+    "anthropic.claude-3-5-haiku-20241022-v1:0",
+    "anthropic.claude-3-5-sonnet-20241022-v2:0",
+]
+DEFAULT_TOKEN_BUDGET = 50000
+
+
+
+#----------------------------------------------------------- prompts
+
+# the document block shared by all the prompts: keeping it identical, and at the start of
+# every prompt, lets Bedrock prompt caching reuse it across generation, selection and refinement
+PROMPT_TEXT_BLOCK = """
+    Here is a given text for you to reference for the following task. Read it carefully because it is necessary for the task that you will have to solve. 
+
+    <text>
+    {html_text}
+    </text>
+"""
+
+# phrases of a refinement justification meaning that the diagram was kept as it is
+RE_NO_IMPROVEMENT = re.compile(
+    r"(can ?not|could not|can't|cannot) be (significantly |further |meaningfully )?improved"
+    r"|no (further |significant |meaningful )?(improvements?|changes?) (is |are )?(needed|necessary|required)"
+    r"|does not need (to be |any )?(improv|chang)",
+    re.IGNORECASE
+)
+
+PROMPT_SYSTEM = """
+    You are a wise professor who can read any document, break it down to its essentials, and explain it visually to anyone, using Mermaid graphs.
+    """
+
+PROMPT_SINGLE = PROMPT_TEXT_BLOCK + """
+
+    <task>
+    Summarize the given text and provide the summary inside <summary> tags. 
+    Then convert the summary to a visually pleasing diagram using Mermaid notation. 
+    The diagram should capture the main gist of the summary, without too many low-level details. 
+    Someone who would only view the Mermaid diagram, should understand the gist of the summary. 
+    The Mermaid diagram should follow all the correct notation rules and should compile without any syntax errors.
+    Use the following specifications for the generated Mermaid diagram:
+    </task>
+
+    <specifications>
+    1. Use different colors, node shapes (e.g. rectangle, circle, rhombus, hexagon, trapezoid, parallelogram etc.), and subgraphs to represent different concepts and entities in the given text.
+    2. If you are using subgraphs, each subgraph should have its own indicative name inside quotes. 
+    3. Use "links with text" to indicate actions, relationships or influence between a source nodes and destination nodes.
+    4. The orientation of the Mermaid diagram should be {orientation}.
+    5. Include the Mermaid diagram inside <mermaid> </mermaid> tags.
+    6. Do not write anything after the </mermaid> tag.
+    7. Use only information from within the given text. Don't make up new information.
+    8. Before the output, check the result for any errors. 
+    </specifications>
+    """
+
+PROMPT_VARIANTS = PROMPT_TEXT_BLOCK + """
+
+    <task>
+    Summarize the given text and provide the summary inside <summary> tags. 
+    Then convert the summary to {how_many} diagrams using Mermaid notation. 
+    All Mermaid diagrams should capture the main gist of the summary. 
+    Someone who would only view the Mermaid diagrams, should understand the gist of the summary. 
+    The Mermaid diagrams should follow all the correct notation rules and should compile without any syntax errors.
+    Use the following specifications for the generated Mermaid diagrams:
+    </task>
+
+    <specifications>
+    1. Use different colors, node shapes (e.g. rectangle, circle, rhombus, hexagon, trapezoid, parallelogram etc.), and subgraphs to represent different concepts in the given text.
+    2. If you are using subgraphs, each subgraph should have its own indicative name inside quotes. 
+    3. Use "links with text" to indicate actions, relationships or influence between a source nodes and destination nodes.
+    4. The orientation of each of the {how_many} Mermaid diagrams should be {orientation}.
+    5. Include each of the {how_many} Mermaid diagrams inside <mermaid> </mermaid> tags.
+    6. Use only information from within the given text. Don't make up new information.
+    </specifications>
+    """
+
+PROMPT_REFINE = PROMPT_TEXT_BLOCK + """
+    
+    Here is a Mermaid diagram intented to summarize the content of the previous text. The intention is that someone who only viewed the given Mermaid diagram, would understand the main concepts of the text, without having to read it.
+
+    <diagram>
+    {diagram}
+    </diagram>
+
+    Evaluate whether the given Mermaid diagram is a good visual approximation of the given text.
+    Here are some points to consider:
+    1. What are the most important points of the text, that someone should know about?
+    2. Does the diagram mention all these points?
+    3. Does the diagram capture all the interactions between all the important points?
+    4. Does the diagram use different colors, shapes and arrows to capture the important points and their interactions?
+    5. Is the diagramm too simplistic? 
+    6. Is the diagram too complicated?
+    7. Is the diagram visually pleasing?
+    8. Do you think that the diagram can be improved?
+    
+    Think whether the given diagram can be improved or not, and explain your thought process inside <justification></justification> XML tags.
+    If you think that the given Mermaid diagram can be improved, refine it and include the new Mermaid code inside <new_diagram></new_diagram> XML tags.
+    If you think that the given Mermaid diagram can not be improved, include the original Mermaid code inside <new_diagram></new_diagram> XML tags.
+    Remember don't forget to "close" the new diagram XML tags with </new_diagram>.
+    """
+
+# later turns of a multi-turn refinement: the text, the instructions and the diagram are
+# already in the conversation
+PROMPT_REFINE_FOLLOWUP = """
+    Evaluate your new diagram again in the same way, against the text I gave you at the beginning.
+    Explain your thought process inside <justification></justification> XML tags, and include the refined Mermaid code, or the same code if it can not be improved, inside <new_diagram></new_diagram> XML tags.
+    """
+
+
+
+#----------------------------------------------------------- generation
+
+def find_between( s, first, last ):
+    try:
+        ls_graphs = re.findall(r'<mermaid>(.*?)</mermaid>', s, re.DOTALL)
+        return ls_graphs
+    except ValueError:
+        return ""
+
+
+
+def standardize_graph(graph):
+    # apply string transformation to fix some common mermaid mistakes
+    graph = graph.replace('subgraph ""', 'subgraph " "')
+    
+    return graph
+
+
+
+def fix_graph_locally(graph, ls_fixes):
+    # fixes the common mistakes of an invalid graph without calling a model, and returns
+    # the graph with its remaining errors; the fixes applied are appended to ls_fixes
+    graph = standardize_graph(graph)
+    ls_errors = mermaid.validate_graph(graph)
+    if len(ls_errors) == 0 or graph.strip() == "":
+        return graph, ls_errors
+    dc_fix = repair.fix_locally(graph)
+    if len(dc_fix["errors"]) < len(ls_errors):
+        ls_fixes.extend(dc_fix["fixes"])
+        return dc_fix["graph"], dc_fix["errors"]
+    return graph, ls_errors
+
+
+
+def request_variant(
+    bedrock_runtime,
+    modelId,
+    system_prompt,
+    prompt,
+    max_tokens_to_sample,
+    temperature,
+    top_p,
+    stream,
+    response_cache,
+    cache_salt,
+):
+    # one LLM call generating a single diagram
+    if stream is True:
+        # stop generating as soon as the diagram is closed
+        for event in llm.converse_stream(
+            bedrock_runtime,
+            model_id=modelId,
+            prompt=prompt,
+            system_prompt=system_prompt,
+            temperature=temperature,
+            max_tokens=max_tokens_to_sample,
+            top_p=top_p,
+            stop_after=1,
+            stop_sequences=["</mermaid>"],
+            response_cache=response_cache,
+            prompt_caching=True,
+            cache_salt=cache_salt,
+        ):
+            dc_response = event
+    else:
+        dc_response = llm.converse(
+            bedrock_runtime,
+            model_id=modelId,
+            prompt=prompt,
+            system_prompt=system_prompt,
+            temperature=temperature,
+            max_tokens=max_tokens_to_sample,
+            top_p=top_p,
+            response_cache=response_cache,
+            prompt_caching=True,
+            cache_salt=cache_salt,
+        )
+    return dc_response
+
+
+
+def generate_variant(
+    bedrock_runtime,
+    modelId,
+    system_prompt,
+    prompt,
+    repeat_on_error=True,
+    max_tokens_to_sample=500,
+    temperature=0.9,
+    top_p=1,
+    stream=False,
+    response_cache=None,
+    variant=0,
+    retry_policy=None,
+):
+    # generates one diagram (with its own retries), without touching the streamlit state
+    # so that it can run in a worker thread. Throttling and network errors are retried with
+    # backoff, an invalid diagram is first fixed locally, then sent to a short repair call,
+    # and only then regenerated
+    if retry_policy is None:
+        retry_policy = retry.RetryPolicy()
+    run = retry_policy.start()
+    ls_invalid_attempts = []
+    ls_local_fixes = []
+    repaired = False
+    attempt = 1
+    dc_response = run.call(
+        request_variant,
+        bedrock_runtime, modelId, system_prompt, prompt,
+        max_tokens_to_sample, temperature, top_p, stream, response_cache,
+        cache_salt=(variant, attempt),  # each variant and attempt is a distinct sample
+    )
+    response_text = dc_response["text"]
+    usage = dc_response["usage"]
+
+    # parse graphs from the completion
+    ls_mermaid_graph = find_between(
+        response_text, 
+        "<mermaid>", 
+        "</mermaid>"
+    )
+    str_mermaid_graph = ls_mermaid_graph[0] if len(ls_mermaid_graph) > 0 else ""
+    str_mermaid_graph, ls_errors = fix_graph_locally(str_mermaid_graph, ls_local_fixes)
+
+    while len(ls_errors) > 0 and repeat_on_error is True and not run.exhausted():
+        run.record_failure(retry.INVALID, str(ls_errors[0]))
+        ls_invalid_attempts.append(attempt)
+        attempt += 1
+        if repaired is False and str_mermaid_graph != "":
+            # last resort before regenerating: only the diagram and its errors, no source text
+            dc_fix = run.call(
+                repair.fix_with_llm,
+                bedrock_runtime,
+                model_id=modelId,
+                graph=standardize_graph(str_mermaid_graph),
+                ls_errors=ls_errors,
+                response_cache=response_cache,
+            )
+            str_mermaid_graph = dc_fix["graph"]
+            repaired = True
+        else:
+            # full regeneration
+            dc_response = run.call(
+                request_variant,
+                bedrock_runtime, modelId, system_prompt, prompt,
+                max_tokens_to_sample, temperature, top_p, stream, response_cache,
+                cache_salt=(variant, attempt),
+            )
+            response_text = dc_response["text"]
+            usage = dc_response["usage"]
+            ls_mermaid_graph = find_between(
+                response_text, 
+                "<mermaid>", 
+                "</mermaid>"
+            )
+            str_mermaid_graph = ls_mermaid_graph[0] if len(ls_mermaid_graph) > 0 else ""
+            repaired = False
+        str_mermaid_graph, ls_errors = fix_graph_locally(str_mermaid_graph, ls_local_fixes)
+
+    # log outputs
+    dc_output = {}
+    dc_output["raw"] = response_text
+    dc_output["graph"] = str_mermaid_graph
+    dc_output["processed_graph"] = standardize_graph(str_mermaid_graph)
+    dc_output["valid"] = len(ls_errors) == 0
+    dc_output["errors"] = [str(error) for error in ls_errors]
+    dc_output["repaired"] = repaired
+    dc_output["local_fixes"] = ls_local_fixes
+    dc_output["invalid_attempts"] = ls_invalid_attempts
+    dc_output["failures"] = run.ls_failures
+    dc_output["usage"] = usage
+    return dc_output
+
+
+
+def generate_variant_cascade(ls_model_ids, model_stats, **kwargs):
+    # generates one diagram with the fastest model of the cascade, escalating to the next
+    # models only if the diagram is invalid or too poor; kwargs are those of generate_variant
+    return cascade.run_cascade(
+        ls_model_ids,
+        generate=lambda model_id: generate_variant(modelId=model_id, **kwargs),
+        stats=model_stats,
+    )
+
+
+
+def build_prompt(template, text, orientation="LR", how_many=1):
+    # fills a generation prompt template (PROMPT_SINGLE or PROMPT_VARIANTS)
+    prompt = template.replace("{html_text}", text)
+    prompt = prompt.replace("{orientation}", orientation)
+    prompt = prompt.replace("{how_many}", str(how_many))
+    return prompt
+
+
+
+def extract_summary(response_text):
+    # the text summary written before the diagram, or "" if there is none
+    ls_summaries = re.findall(r"<summary>(.*?)</summary>", response_text, re.DOTALL)
+    return ls_summaries[0].strip() if len(ls_summaries) > 0 else ""
+
+
+
+def generate_diagrams(
+    bedrock_runtime,
+    prompt,
+    model_id=DEFAULT_MODEL_GENERATE,
+    system_prompt=PROMPT_SYSTEM,
+    number_of_diagrams=1,
+    max_workers=5,
+    repeat_on_error=True,
+    max_tokens_to_sample=2048,
+    temperature=0.15,
+    top_p=1,
+    stream=False,
+    response_cache=None,
+    retry_policy=None,
+    ls_cascade_models=None,
+    model_stats=None,
+    on_variant: Optional[Callable[[int, Optional[dict], Optional[Exception]], None]] = None,
+):
+    """Generate several diagrams in parallel, one LLM call (and its retries) per diagram
+
+    Parameters
+    ----------
+    ls_cascade_models :
+        Optional model cascade (see cascade.py), used instead of `model_id`.
+    on_variant :
+        Optional callback, called in the calling thread as each variant completes, with
+        the variant index and either its output or the exception that stopped it.
+
+    Returns
+    -------
+    The outputs of generate_variant() that completed, in order of completion.
+    """
+    if ls_cascade_models is not None:
+        # each variant starts with the fastest model and escalates only if needed
+        dc_model_args = {
+            "ls_model_ids": ls_cascade_models,
+            "model_stats": model_stats or cascade.get_model_stats(),
+        }
+        target = generate_variant_cascade
+    else:
+        dc_model_args = {"modelId": model_id}
+        target = generate_variant
+
+    ls_diagrams = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dc_futures = {
+            executor.submit(
+                target,
+                bedrock_runtime=bedrock_runtime,
+                **dc_model_args,
+                system_prompt=system_prompt,
+                prompt=prompt,
+                repeat_on_error=repeat_on_error,
+                max_tokens_to_sample=max_tokens_to_sample,
+                temperature=temperature,
+                top_p=top_p,
+                stream=stream,
+                response_cache=response_cache,
+                variant=d,
+                retry_policy=retry_policy,
+            ): d
+            for d in range(number_of_diagrams)
+        }
+        for future in as_completed(dc_futures):
+            d = dc_futures[future]
+            try:
+                dc_output = future.result()
+            except Exception as e:
+                if on_variant is not None:
+                    on_variant(d, None, e)
+                continue
+            dc_output["variant"] = d
+            ls_diagrams.append(dc_output)
+            if on_variant is not None:
+                on_variant(d, dc_output, None)
+    return ls_diagrams
+
+
+
+def check_variant(str_mermaid_graph, d, response_text):
+    # one of the graphs of a multi-graph completion, with its common mistakes fixed locally,
+    # in the format of generate_variant(), or None if it is still not valid
+    ls_local_fixes = []
+    processed_graph, ls_errors = fix_graph_locally(str_mermaid_graph, ls_local_fixes)
+    if len(ls_errors) > 0:
+        return None
+    return {
+        "raw": response_text,
+        "graph": str_mermaid_graph,
+        "processed_graph": processed_graph,
+        "valid": True,
+        "errors": [],
+        "repaired": False,
+        "local_fixes": ls_local_fixes,
+        "invalid_attempts": [],
+        "failures": [],
+        "usage": {},
+        "variant": d,
+    }
+
+
+
+def request_variants(
+    bedrock_runtime,
+    model_id,
+    system_prompt,
+    prompt,
+    number_of_diagrams,
+    max_tokens_to_sample,
+    temperature,
+    top_p,
+    stream,
+    response_cache,
+    attempt,
+    on_variant=None,
+):
+    # one LLM call generating all the variants at once; valid variants are reported as soon
+    # as they are parsed, invalid ones are returned for repair
+    ls_diagrams = []
+    ls_invalid_graphs = []
+
+    if stream is True:
+        # report each graph as soon as its closing tag arrives, and stop reading once all
+        # the requested graphs have been received
+        d = 0
+        for event in llm.converse_stream(
+            bedrock_runtime,
+            model_id=model_id,
+            prompt=prompt,
+            system_prompt=system_prompt,
+            temperature=temperature,
+            max_tokens=max_tokens_to_sample,
+            top_p=top_p,
+            stop_after=number_of_diagrams,
+            response_cache=response_cache,
+            prompt_caching=True,
+            cache_salt=attempt,
+        ):
+            if event["type"] == "done":
+                dc_response = event
+            elif event["tag"] == "mermaid":
+                dc_output = check_variant(event["text"], d, "")
+                if dc_output is not None:
+                    dc_output["latency"] = event["latency"]
+                    ls_diagrams.append(dc_output)
+                    if on_variant is not None:
+                        on_variant(d, dc_output, None)
+                else:
+                    ls_invalid_graphs.append(event["text"])
+                d += 1
+        # the raw output is only complete once the stream has ended
+        for dc_output in ls_diagrams:
+            dc_output["raw"] = dc_response["text"]
+    else:
+        dc_response = llm.converse(
+            bedrock_runtime,
+            model_id=model_id,
+            prompt=prompt,
+            system_prompt=system_prompt,
+            temperature=temperature,
+            max_tokens=max_tokens_to_sample,
+            top_p=top_p,
+            response_cache=response_cache,
+            prompt_caching=True,
+            cache_salt=attempt,
+        )
+        ls_str_mermaid_graph = find_between(dc_response["text"], "<mermaid>", "</mermaid>")
+        for d, str_mermaid_graph in enumerate(ls_str_mermaid_graph):
+            dc_output = check_variant(str_mermaid_graph, d, dc_response["text"])
+            if dc_output is not None:
+                ls_diagrams.append(dc_output)
+                if on_variant is not None:
+                    on_variant(d, dc_output, None)
+            else:
+                ls_invalid_graphs.append(str_mermaid_graph)
+
+    return {
+        "text": dc_response["text"],
+        "usage": dc_response["usage"],
+        "diagrams": ls_diagrams,
+        "invalid_graphs": ls_invalid_graphs,
+    }
+
+
+
+def generate_diagrams_at_once(
+    bedrock_runtime,
+    prompt,
+    model_id=DEFAULT_MODEL_GENERATE,
+    system_prompt=PROMPT_SYSTEM,
+    number_of_diagrams=3,
+    repeat_on_error=True,
+    max_tokens_to_sample=2048,
+    temperature=0.15,
+    top_p=1,
+    stream=False,
+    response_cache=None,
+    retry_policy=None,
+    on_variant: Optional[Callable[[int, Optional[dict], Optional[Exception]], None]] = None,
+    on_message: Optional[Callable[[str], None]] = None,
+):
+    """Generate several diagrams in a single completion (prompt made from PROMPT_VARIANTS)
+
+    If none of the diagrams is valid, the first one is repaired, then the completion is
+    regenerated, within the limits of the retry policy.
+
+    Parameters
+    ----------
+    on_variant :
+        Optional callback, called as each valid variant is parsed, see generate_diagrams().
+    on_message :
+        Optional callback, called with a line of progress (repairs, regenerations, usage).
+
+    Returns
+    -------
+    The valid diagrams, in the format of generate_variant(). The summed token usage of the
+    completions is in the "usage" of the first one.
+    """
+    if retry_policy is None:
+        retry_policy = retry.RetryPolicy()
+    if on_message is None:
+        on_message = lambda message: None
+    ls_diagrams = []
+    ls_invalid_graphs = []
+    run = retry_policy.start()
+    attempt = 0
+    response_text = ""
+    usage = {}
+
+    while len(ls_diagrams) == 0:
+        try:
+            if len(ls_invalid_graphs) > 0:
+                # cheaper than regenerating: send only the first invalid graph and its errors
+                on_message("No valid candidate was found. Repairing variant...")
+                str_mermaid_graph, ls_errors = fix_graph_locally(ls_invalid_graphs[0], [])
+                ls_invalid_graphs = []
+                dc_fix = run.call(
+                    repair.fix_with_llm,
+                    bedrock_runtime,
+                    model_id=model_id,
+                    graph=str_mermaid_graph,
+                    ls_errors=ls_errors,
+                    response_cache=response_cache,
+                )
+                dc_output = check_variant(dc_fix["graph"], 0, response_text)
+                if dc_output is not None:
+                    dc_output["repaired"] = True
+                    ls_diagrams.append(dc_output)
+                    if on_variant is not None:
+                        on_variant(0, dc_output, None)
+            else:
+                if attempt > 0:
+                    on_message("No valid candidate was found. Regenerating...")
+                attempt += 1
+                dc_variants = run.call(
+                    request_variants,
+                    bedrock_runtime, model_id, system_prompt, prompt, number_of_diagrams,
+                    max_tokens_to_sample, temperature, top_p, stream, response_cache,
+                    attempt=attempt,
+                    on_variant=on_variant,
+                )
+                on_message("Completion " + str(attempt) + ": " + llm.format_usage(dc_variants["usage"]))
+                usage = selection.add_usage(usage, dc_variants["usage"])
+                response_text = dc_variants["text"]
+                ls_diagrams = dc_variants["diagrams"]
+                ls_invalid_graphs = dc_variants["invalid_graphs"]
+        except Exception as e:
+            on_message("Generation stopped: " + str(e))
+            break
+
+        if len(ls_diagrams) == 0:
+            run.record_failure(retry.INVALID, "no valid candidate")
+            if repeat_on_error is False:
+                break
+
+    if len(ls_diagrams) > 0:
+        ls_diagrams[0]["usage"] = usage
+    return ls_diagrams
+
+
+
+def refine_diagram(
+    bedrock_runtime,
+    text,
+    diagram,
+    model_id=DEFAULT_MODEL_REFLECT,
+    system_prompt=PROMPT_SYSTEM,
+    iterations=3,
+    multi_turn=True,
+    response_cache=None,
+    retry_policy=None,
+    on_iteration: Optional[Callable[[int, dict], None]] = None,
+):
+    """Refine a diagram by asking the model to critique and improve it, several times
+
+    Stops early once the model converged: the diagram (almost) did not change (see
+    diff.GraphDiff.converged()), or the model found no further improvement. In multi-turn
+    mode, later iterations continue the conversation instead of resending the text. It
+    only applies to the models with prompt caching (see llm.supports_prompt_caching()):
+    without a cached prefix, the growing conversation costs more input tokens than a
+    full prompt per iteration.
+
+    Parameters
+    ----------
+    on_iteration :
+        Optional callback, called after each iteration with its index and a dictionary with
+        the new "graph", its "justification", the "usage", the "changes" (diff.GraphDiff)
+        since the previous iteration, its "duration" and the "stop_reason" (None if the
+        refinement goes on).
+
+    Returns
+    -------
+    A dictionary with the "refined_diagram", its "justification", the "raw_output" of the
+    last iteration, the number of "iterations_skipped" by the early stop and the estimated
+    "time_saved", the "change_ratios" of the iterations and the summed "usage".
+    """
+    if retry_policy is None:
+        retry_policy = retry.RetryPolicy()
+    multi_turn = multi_turn is True and llm.supports_prompt_caching(model_id)
+    prompt = PROMPT_REFINE.replace("{html_text}", text)
+    prompt = prompt.replace("{diagram}", diagram)
+
+    ls_durations = []
+    ls_change_ratios = []  # share of the diagram changed by each iteration
+    iterations_skipped = 0
+    time_saved = 0.0
+    ls_history = []  # conversation so far, in multi-turn mode
+    usage = {}
+    response_text = ""
+    refined, justification = diagram, ""
+    for i in range(iterations):
+        iteration_start = time.time()
+        dc_response = retry_policy.start().call(
+            llm.converse,
+            bedrock_runtime,
+            model_id=model_id,
+            prompt=prompt,
+            system_prompt=system_prompt,
+            temperature=0.1,  # be more factual
+            max_tokens=2048,
+            top_p=1,
+            response_cache=response_cache,
+            prompt_caching=True,
+            history=ls_history,
+        )
+        response_text = dc_response["text"]
+        usage = selection.add_usage(usage, dc_response["usage"])
+
+        # parsing output
+        ls_justifications = re.findall(r"<justification>(.*?)</justification>", response_text, re.DOTALL)
+        ls_new_diagrams = re.findall(r"<new_diagram>(.*?)</new_diagram>", response_text, re.DOTALL)
+        justification = ls_justifications[0] if len(ls_justifications) > 0 else ""
+        refined = ls_new_diagrams[0] if len(ls_new_diagrams) > 0 else diagram
+        ls_durations.append(time.time() - iteration_start)
+
+        # stop early once the model converged: (almost) the same diagram again, or no improvement
+        dc_changes = diff.diff_graphs(diagram, refined)
+        ls_change_ratios.append(dc_changes.change_ratio())
+        if dc_changes.is_empty():
+            stop_reason = "the diagram did not change"
+        elif dc_changes.converged():
+            stop_reason = "the diagram changed by less than " + str(round(100 * diff.CONVERGENCE_THRESHOLD)) + "%"
+        elif RE_NO_IMPROVEMENT.search(justification) is not None:
+            stop_reason = "the model found no further improvement"
+        else:
+            stop_reason = None
+        if i == iterations - 1:
+            stop_reason = None  # the last iteration stops anyway
+        if on_iteration is not None:
+            on_iteration(i, {
+                "graph": refined,
+                "justification": justification,
+                "usage": dc_response["usage"],
+                "changes": dc_changes,
+                "duration": ls_durations[-1],
+                "stop_reason": stop_reason,
+            })
+        if stop_reason is not None:
+            iterations_skipped = iterations - 1 - i
+            time_saved = iterations_skipped * sum(ls_durations) / len(ls_durations)
+            break
+
+        # prepare prompt
+        if multi_turn is True:
+            # keep the first exchange (text, instructions, first critique) and the latest one
+            ls_exchange = [
+                llm.user_message(prompt, model_id, prompt_caching=True),
+                llm.assistant_message(response_text),
+            ]
+            ls_history = ls_exchange if i == 0 else ls_history[:2] + ls_exchange
+            prompt = PROMPT_REFINE_FOLLOWUP
+        else:
+            prompt = PROMPT_REFINE.replace("{html_text}", text)
+            prompt = prompt.replace("{diagram}", refined)
+        diagram = refined
+
+    return {
+        "refined_diagram": refined,
+        "justification": justification,
+        "raw_output": response_text,
+        "iterations_skipped": iterations_skipped,
+        "time_saved": time_saved,
+        "change_ratios": ls_change_ratios,
+        "usage": usage,
+    }
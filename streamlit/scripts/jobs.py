@@ -0,0 +1,207 @@
+"""Background pipeline runs, owned by the server process instead of a script run
+
+A Streamlit rerun (any widget interaction) stops the script where it is, so work done
+inside the script is abandoned, and done again by the next click. Jobs run the pipeline
+(see pipeline.py) in threads of the process instead, and record its events. A session only
+keeps the id of its job, and each run of the script attaches to it: it replays the events
+recorded so far, then follows the new ones until the job finishes, while the model calls
+go on undisturbed by reruns.
+
+Identical requests (see singleflight.request_key()) submitted while a job runs attach to
+that job, so that all their sessions follow the same progress, and the pipeline shares
+the results of identical requests with the other runs of the process too.
+"""
+# Python Built-Ins:
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+# Local Dependencies:
+import pipeline
+import retry
+import singleflight
+
+
+MAX_RUNNING_JOBS = 4  # jobs running at the same time, the next ones are queued
+JOB_TTL = 3600  # seconds a finished job is kept for its session to attach to
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """One pipeline run in the background, with the log of its events
+
+    The events are (stage, event, payload, time) tuples, see pipeline.Pipeline.run_many().
+    """
+
+    def __init__(self, dc_inputs: dict, config: pipeline.PipelineConfig, key: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.dc_inputs = dc_inputs
+        self.config = config
+        self.key = key  # request key, shared by the identical requests
+        self.subscribers = 1  # sessions attached to the job
+        self.status = QUEUED
+        self.ls_events = []
+        self.values = None  # values of the document, once done
+        self.error = None  # exception that stopped the job, once failed
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel_requested = False
+        self._condition = threading.Condition()
+
+    def is_finished(self) -> bool:
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def cancel(self):
+        """Detach a session from the job, and stop the job at its next event if no other is left
+
+        The stages already running finish, unused.
+        """
+        with self._condition:
+            self.subscribers -= 1
+            if self.subscribers > 0:
+                return
+            self._cancel_requested = True
+            if self.status == QUEUED:
+                self._finish(CANCELLED)
+
+    def wait(self, after: int = 0, timeout: Optional[float] = None) -> List[Tuple[str, str, object, float]]:
+        """The events after the first `after` ones, waiting up to `timeout` seconds for one
+
+        Returns an empty list if there is no new event after the timeout, or if the job is
+        finished and all its events were already read.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self.ls_events) > after or self.is_finished(), timeout)
+            return self.ls_events[after:]
+
+    def duration(self) -> float:
+        """Seconds since the job started, or that it ran for if it is finished"""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def _add_event(self, stage: str, event: str, payload):
+        with self._condition:
+            if self._cancel_requested:
+                raise JobCancelled()
+            self.ls_events.append((stage, event, payload, time.time()))
+            self._condition.notify_all()
+
+    def _finish(self, status: str, values: Optional[dict] = None, error: Optional[Exception] = None):
+        with self._condition:
+            if self.is_finished():
+                return
+            self.status = status
+            self.values = values
+            self.error = error
+            self.finished_at = time.time()
+            self._condition.notify_all()
+
+
+class JobRunner:
+    """Runs jobs in the background and keeps them for a while after they finish
+
+    Parameters
+    ----------
+    max_running_jobs :
+        Jobs running at the same time; each one runs its own model calls in parallel too.
+    ttl :
+        Seconds a finished job is kept, after which get() no longer finds it.
+    """
+
+    def __init__(self, max_running_jobs: int = MAX_RUNNING_JOBS, ttl: float = JOB_TTL):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_running_jobs, thread_name_prefix="visual-gist-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        bedrock_runtime,
+        dc_inputs: dict,
+        config: pipeline.PipelineConfig,
+        targets: Optional[Iterable[str]] = None,
+        response_cache=None,
+        retry_policy: Optional[retry.RetryPolicy] = None,
+        coalesce: bool = True,
+    ) -> Job:
+        """Start running the pipeline on one document, see pipeline.Pipeline.run()
+
+        Returns the job of an identical request instead if one is still running. Without
+        `coalesce` (e.g. when the response cache is bypassed), the job neither attaches to
+        another one nor shares results with other runs, so that the model is always called.
+        """
+        key = None
+        if coalesce is True:
+            key = singleflight.request_key(dc_inputs, config, targets if targets is not None else pipeline.Pipeline().outputs())
+        with self._lock:
+            self._prune()
+            for job in self._jobs.values():
+                if key is not None and job.key == key and not job.is_finished():
+                    with job._condition:
+                        if job._cancel_requested is False:
+                            job.subscribers += 1
+                            return job
+            job = Job(dc_inputs, config, key)
+            self._jobs[job.id] = job
+        self._executor.submit(
+            self._run, job, bedrock_runtime,
+            targets=targets, response_cache=response_cache, retry_policy=retry_policy, coalesce=coalesce,
+        )
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.is_finished() and now - job.finished_at > self.ttl]:
+            del self._jobs[job_id]
+
+    def _run(self, job: Job, bedrock_runtime, **kwargs):
+        with job._condition:
+            if job.is_finished():  # cancelled while queued
+                return
+            job.status = RUNNING
+            job.started_at = time.time()
+        try:
+            # the events are recorded in this thread, which raises JobCancelled to stop the run
+            dc_values = pipeline.Pipeline().run(
+                bedrock_runtime,
+                job.dc_inputs,
+                config=job.config,
+                on_event=lambda index, stage, event, payload: job._add_event(stage, event, payload),
+                **kwargs
+            )
+        except JobCancelled:
+            job._finish(CANCELLED)
+        except Exception as e:
+            job._finish(FAILED, error=e)
+        else:
+            job._finish(DONE, values=dc_values)
+
+
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+
+def get_job_runner() -> JobRunner:
+    """Return the process-wide job runner, shared by all the sessions"""
+    global _job_runner
+    with _job_runner_lock:
+        if _job_runner is None:
+            _job_runner = JobRunner()
+    return _job_runner
@@ -0,0 +1,416 @@
+"""Helper utilities for calling LLMs through the Amazon Bedrock Converse API"""
+# Python Built-Ins:
+import time
+from typing import List, Optional
+
+# Local Dependencies:
+import cache
+import ratelimit
+import retry
+
+
+# models supporting a prompt cache checkpoint ("cachePoint") in the Converse API
+PROMPT_CACHING_MODELS = (
+    "anthropic.claude-3-5-haiku-20241022",
+    "anthropic.claude-3-7-sonnet",
+    "anthropic.claude-sonnet-4",
+    "anthropic.claude-opus-4",
+    "amazon.nova-micro",
+    "amazon.nova-lite",
+    "amazon.nova-pro",
+    "amazon.nova-premier",
+)
+CACHE_PREFIX_END = "</text>"  # the stable document block of the prompts ends with this tag
+
+_response_cache = None
+
+
+def get_response_cache() -> cache.TieredCache:
+    """Return the process-wide cache of model responses (memory LRU + 100 MB on disk, 7 days TTL)"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = cache.TieredCache(
+            "responses",
+            max_memory_entries=256,
+            max_size_bytes=100 * 1024 * 1024,
+            ttl=7 * 24 * 3600
+        )
+    return _response_cache
+
+
+def supports_prompt_caching(model_id: str) -> bool:
+    """Return True if the model accepts prompt cache checkpoints (also for inference profiles)"""
+    return any(model in model_id for model in PROMPT_CACHING_MODELS)
+
+
+def build_content(prompt: str, model_id: str, prompt_caching: bool = False):
+    """Return the content blocks of a user message
+
+    With prompt caching, the prompt is split right after the document block (up to and
+    including the first "</text>" tag) and a cache checkpoint is inserted there. As long as
+    the system prompt and this prefix stay identical, the following requests (other
+    variants, selection, refinement) read the document from the cache.
+    """
+    position = prompt.find(CACHE_PREFIX_END)
+    if prompt_caching is False or position == -1 or not supports_prompt_caching(model_id):
+        return [{"text": prompt}]
+    position += len(CACHE_PREFIX_END)
+    return [
+        {"text": prompt[:position]},
+        {"cachePoint": {"type": "default"}},
+        {"text": prompt[position:]},
+    ]
+
+
+def format_usage(usage: dict) -> str:
+    """Human readable summary of the token usage of a response, including prompt cache hits"""
+    text = (
+        str(usage.get("inputTokens", 0)) + " input tokens, " +
+        str(usage.get("outputTokens", 0)) + " output tokens"
+    )
+    if usage.get("cacheReadInputTokens") or usage.get("cacheWriteInputTokens"):
+        text += (
+            " (prompt cache: " + str(usage.get("cacheReadInputTokens", 0)) + " tokens read, " +
+            str(usage.get("cacheWriteInputTokens", 0)) + " tokens written)"
+        )
+    return text
+
+
+def user_message(prompt: str, model_id: str, prompt_caching: bool = False) -> dict:
+    """A user message of a conversation, see build_content() for prompt caching"""
+    return {"role": "user", "content": build_content(prompt, model_id, prompt_caching)}
+
+
+def assistant_message(text: str) -> dict:
+    """An assistant message of a conversation, e.g. a previous completion"""
+    return {"role": "assistant", "content": [{"text": text}]}
+
+
+def _history_text(history) -> str:
+    # concatenated text of the previous messages, to estimate their tokens
+    if not history:
+        return ""
+    return "".join(
+        block.get("text", "") for message in history for block in message["content"]
+    )
+
+
+def _build_request(model_id, prompt, system_prompt, inference_config, prompt_caching=False, history=None):
+    # keyword arguments of a Converse / ConverseStream request
+    request = {
+        "modelId": model_id,
+        "inferenceConfig": inference_config,
+        "messages": list(history or []) + [user_message(prompt, model_id, prompt_caching)],
+    }
+    if system_prompt is not None:
+        request["system"] = [{"text": system_prompt}]
+    return request
+
+
+def response_cache_key(request: dict, cache_salt=None) -> str:
+    """Key of a request in the response cache
+
+    Covers the model id, the system prompt, the full messages and the inference parameters
+    (temperature, topP, maxTokens, stop sequences). `cache_salt` distinguishes requests that
+    are identical on purpose, e.g. several variants sampled from the same prompt.
+    """
+    return cache.hash_key(
+        "converse",
+        request["modelId"],
+        request.get("system"),
+        request["messages"],
+        request["inferenceConfig"],
+        cache_salt,
+    )
+
+
+def _report_error(limiter, error):
+    # a throttling error means the shared quota is exhausted, whatever the local estimate says
+    if limiter is not None and retry.classify_error(error) == retry.THROTTLING:
+        limiter.report_throttling()
+
+
+def _settle(limiter, reserved_tokens, usage):
+    # replaces the reserved tokens (input estimate + max output) with the actual usage
+    if limiter is not None and usage:
+        limiter.settle(reserved_tokens, usage.get("inputTokens", 0) + usage.get("outputTokens", 0))
+
+
+def _estimate_usage(prompt, system_prompt, text):
+    # usage of a stream closed before its metadata event, which carries the actual usage
+    return {
+        "inputTokens": ratelimit.estimate_request_tokens(prompt, system_prompt, 0),
+        "outputTokens": ratelimit.estimate_request_tokens(text, None, 0),
+    }
+
+
+def converse(
+    bedrock_runtime,
+    model_id: str,
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    temperature: float = 0.9,
+    max_tokens: int = 2048,
+    top_p: float = 1,
+    response_cache: Optional[cache.TieredCache] = None,
+    cache_salt=None,
+    prompt_caching: bool = False,
+    rate_limit: bool = True,
+    history: Optional[List[dict]] = None,
+):
+    """Send a prompt to a Bedrock model and return the completion
+
+    The Bedrock runtime client is thread-safe, so this function can be called from worker
+    threads. It does not touch any Streamlit state.
+
+    Parameters
+    ----------
+    bedrock_runtime :
+        A boto3 "bedrock-runtime" client, as returned by bedrock.get_bedrock_client().
+    model_id :
+        Bedrock model id (e.g. "anthropic.claude-3-haiku-20240307-v1:0").
+    prompt :
+        Text of the user message.
+    system_prompt :
+        Optional system prompt.
+    temperature, max_tokens, top_p :
+        Inference parameters passed to the Converse API.
+    response_cache :
+        Optional cache of responses (e.g. get_response_cache()). Identical requests are then
+        answered from the cache. Pass None to bypass it.
+    cache_salt :
+        Optional value added to the cache key, see response_cache_key().
+    prompt_caching :
+        If True, put a Bedrock prompt cache checkpoint after the document block of the
+        prompt (on models that support it), see build_content().
+    rate_limit :
+        If True, wait for the process-wide rate limiter of the model before calling it (see
+        ratelimit.get_rate_limiter()). Answers from the response cache are not limited.
+    history :
+        Optional previous messages of a multi-turn conversation, alternating user and
+        assistant messages (see user_message() and assistant_message()), to which the
+        prompt is appended as the next user message. With prompt caching, a checkpoint in
+        the first user message lets the following turns read the document from the cache.
+
+    Returns
+    -------
+    A dictionary with the completion "text", the token "usage", the "stop_reason", the
+    wall-clock "latency" of the call in seconds, and whether it was "cached".
+    """
+    request = _build_request(
+        model_id,
+        prompt,
+        system_prompt,
+        {
+            "temperature": temperature,
+            "maxTokens": max_tokens,
+            "topP": top_p,
+        },
+        prompt_caching,
+        history,
+    )
+    if response_cache is not None:
+        key = response_cache_key(request, cache_salt)
+        dc_cached = response_cache.get(key)
+        if dc_cached is not None:
+            return {**dc_cached, "cached": True}
+
+    limiter = ratelimit.get_rate_limiter(model_id) if rate_limit else None
+    reserved_tokens = ratelimit.estimate_request_tokens(
+        _history_text(history) + prompt, system_prompt, max_tokens
+    )
+    if limiter is not None:
+        limiter.acquire(reserved_tokens)
+
+    start_time = time.time()
+    try:
+        response = bedrock_runtime.converse(**request)
+    except Exception as e:
+        _report_error(limiter, e)
+        _settle(limiter, reserved_tokens, {"inputTokens": 0, "outputTokens": 0})  # nothing generated
+        raise
+
+    dc_output = {
+        "text": response["output"]["message"]["content"][0]["text"],
+        "usage": response.get("usage", {}),
+        "stop_reason": response.get("stopReason"),
+        "latency": time.time() - start_time,
+    }
+    _settle(limiter, reserved_tokens, dc_output["usage"])
+    if response_cache is not None:
+        response_cache.put(key, dc_output)
+    return {**dc_output, "cached": False}
+
+
+class TagStreamParser:
+    """Incrementally extract <tag>...</tag> blocks from a streamed completion
+
+    Text chunks are fed as they arrive, and every block is returned as soon as its closing
+    tag has been received, without waiting for the rest of the completion.
+    """
+
+    def __init__(self, tags=("summary", "mermaid")):
+        self.tags = tuple(tags)
+        self.text = ""
+        self._pos = 0  # where to continue scanning for an opening tag
+        self._current_tag = None  # tag of the block currently open
+        self._max_tag_len = max(len(f"<{tag}>") for tag in self.tags)
+
+    def feed(self, chunk: str):
+        """Add a chunk of text and return the list of (tag, content) blocks it completed"""
+        self.text += chunk
+        ls_blocks = []
+        while True:
+            if self._current_tag is None:
+                # look for the earliest opening tag
+                ls_found = [
+                    (self.text.find(f"<{tag}>", self._pos), tag) for tag in self.tags
+                ]
+                ls_found = [(i, tag) for i, tag in ls_found if i != -1]
+                if len(ls_found) == 0:
+                    # keep the tail, it may hold the beginning of a tag split across chunks
+                    self._pos = max(self._pos, len(self.text) - self._max_tag_len)
+                    break
+                i, tag = min(ls_found)
+                self._current_tag = tag
+                self._pos = i + len(f"<{tag}>")
+            else:
+                closing = f"</{self._current_tag}>"
+                i = self.text.find(closing, self._pos)
+                if i == -1:
+                    break
+                ls_blocks.append((self._current_tag, self.text[self._pos:i]))
+                self._current_tag = None
+                self._pos = i + len(closing)
+        return ls_blocks
+
+
+def _replay_stream(dc_cached, tags, stop_after):
+    # yields the events of a cached streamed completion, as if it was streamed again
+    parser = TagStreamParser(tags)
+    blocks_counted = 0
+    for tag, text in parser.feed(dc_cached["text"]):
+        yield {"type": "block", "tag": tag, "text": text, "latency": 0.0}
+        if tag == tags[-1]:
+            blocks_counted += 1
+        if stop_after is not None and blocks_counted >= stop_after:
+            break
+    yield {"type": "done", **dc_cached, "cached": True}
+
+
+def converse_stream(
+    bedrock_runtime,
+    model_id: str,
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    temperature: float = 0.9,
+    max_tokens: int = 2048,
+    top_p: float = 1,
+    tags=("summary", "mermaid"),
+    stop_after: Optional[int] = None,
+    stop_sequences: Optional[List[str]] = None,
+    response_cache: Optional[cache.TieredCache] = None,
+    cache_salt=None,
+    prompt_caching: bool = False,
+    rate_limit: bool = True,
+):
+    """Stream a completion from a Bedrock model, yielding tagged blocks as soon as they close
+
+    Parameters
+    ----------
+    bedrock_runtime, model_id, prompt, system_prompt, temperature, max_tokens, top_p :
+        Same as for converse().
+    tags :
+        Names of the XML tags whose blocks should be yielded.
+    stop_after :
+        Optional number of blocks of the last tag in `tags` (e.g. "mermaid") after which the
+        stream is closed, so that nothing generated afterwards is waited for. The usage of
+        a stream closed before the model stops is estimated from the lengths of the texts.
+    stop_sequences :
+        Optional stop sequences sent to the model, so that it does not spend tokens after
+        them. If a single stop sequence is given and the model stops on it, it is appended
+        back to the text (e.g. a closing "</mermaid>" tag), so that the last block closes.
+    response_cache, cache_salt, prompt_caching, rate_limit :
+        Same as for converse(). Cached completions are replayed block by block.
+
+    Yields
+    ------
+    {"type": "block", "tag": ..., "text": ..., "latency": ...} for every completed block, and
+    finally {"type": "done", "text": ..., "usage": ..., "stop_reason": ..., "latency": ...,
+    "cached": ...} with the full completion.
+    """
+    inference_config = {
+        "temperature": temperature,
+        "maxTokens": max_tokens,
+        "topP": top_p,
+    }
+    if stop_sequences:
+        inference_config["stopSequences"] = list(stop_sequences)
+    request = _build_request(model_id, prompt, system_prompt, inference_config, prompt_caching)
+
+    if response_cache is not None:
+        key = response_cache_key(request, cache_salt)
+        dc_cached = response_cache.get(key)
+        if dc_cached is not None:
+            yield from _replay_stream(dc_cached, tags, stop_after)
+            return
+
+    limiter = ratelimit.get_rate_limiter(model_id) if rate_limit else None
+    reserved_tokens = ratelimit.estimate_request_tokens(prompt, system_prompt, max_tokens)
+    if limiter is not None:
+        limiter.acquire(reserved_tokens)
+
+    start_time = time.time()
+    try:
+        response = bedrock_runtime.converse_stream(**request)
+    except Exception as e:
+        _report_error(limiter, e)
+        _settle(limiter, reserved_tokens, {"inputTokens": 0, "outputTokens": 0})  # nothing generated
+        raise
+
+    parser = TagStreamParser(tags)
+    stream = response["stream"]
+    usage = {}
+    stop_reason = None
+    blocks_counted = 0
+    try:
+        for event in stream:
+            ls_blocks = []
+            if "contentBlockDelta" in event:
+                ls_blocks = parser.feed(event["contentBlockDelta"]["delta"].get("text", ""))
+            elif "messageStop" in event:
+                stop_reason = event["messageStop"].get("stopReason")
+                if stop_reason == "stop_sequence" and stop_sequences and len(stop_sequences) == 1:
+                    ls_blocks = parser.feed(stop_sequences[0])
+            elif "metadata" in event:
+                usage = event["metadata"].get("usage", {})
+
+            for tag, text in ls_blocks:
+                yield {"type": "block", "tag": tag, "text": text, "latency": time.time() - start_time}
+                if tag == tags[-1]:
+                    blocks_counted += 1
+
+            if stop_after is not None and blocks_counted >= stop_after and stop_reason is None:
+                # all the needed blocks have arrived while the model goes on: don't wait for the
+                # rest of the completion, and estimate the usage its metadata would have given.
+                # If the model stopped (e.g. on the stop sequence), the metadata comes next
+                stream.close()
+                stop_reason = "early_stop"
+                usage = _estimate_usage(prompt, system_prompt, parser.text)
+                break
+    except Exception as e:
+        # throttling and other errors may also come in the middle of the stream
+        _report_error(limiter, e)
+        _settle(limiter, reserved_tokens, _estimate_usage(prompt, system_prompt, parser.text))
+        raise
+
+    dc_output = {
+        "text": parser.text,
+        "usage": usage,
+        "stop_reason": stop_reason,
+        "latency": time.time() - start_time,
+    }
+    _settle(limiter, reserved_tokens, usage)
+    if response_cache is not None:
+        response_cache.put(key, dc_output)
+    yield {"type": "done", **dc_output, "cached": False}
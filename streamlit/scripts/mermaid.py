@@ -0,0 +1,640 @@
+"""Offline syntax validation for the Mermaid flowchart subset generated by the visual gist prompts"""
+# Python Built-Ins:
+import re
+from typing import List, NamedTuple, Optional, Tuple
+
+
+DIRECTIONS = ("TB", "TD", "BT", "RL", "LR")
+
+# node shapes as (opening delimiter, [(closing delimiter, shape name)]), longest openers first
+SHAPES = (
+    ("(((", ((")))", "double_circle"),)),
+    ("((", (("))", "circle"),)),
+    ("([", (("])", "stadium"),)),
+    ("[[", (("]]", "subroutine"),)),
+    ("[(", ((")]", "cylinder"),)),
+    ("{{", (("}}", "hexagon"),)),
+    ("[/", (("/]", "parallelogram"), ("\\]", "trapezoid"))),
+    ("[\\", (("\\]", "parallelogram_alt"), ("/]", "trapezoid_alt"))),
+    ("[", (("]", "rectangle"),)),
+    ("(", ((")", "round"),)),
+    ("{", (("}", "rhombus"),)),
+    (">", (("]", "asymmetric"),)),
+)
+
+# characters that break the Mermaid lexer when they appear in an unquoted label
+FORBIDDEN_LABEL_CHARS = set('()[]{}"')
+RESERVED_IDS = {"end", "subgraph"}
+
+_RE_HEADER = re.compile(r"^(graph|flowchart)(?:\s+(\S+))?\s*$")
+_RE_ID = re.compile(r"[A-Za-z0-9_](?:\w|-(?=\w))*")
+_RE_CLASS_SUFFIX = re.compile(r":::([A-Za-z_][\w-]*)")
+_RE_AMPERSAND = re.compile(r"\s*&\s*")
+_RE_LINK = re.compile(
+    r"\s*(?:[xo<]?-{2,}[->xo]|[xo<]?={2,}[=>xo]|[xo<]?-?\.+-[>xo]?|~{3,})\s*"
+)
+_RE_LINK_START = re.compile(r"\s*([xo<]?)(--|==|-\.)\s*")  # no space needed: A--text-->B
+_RE_LINK_END = {
+    "--": re.compile(r"\s*(?:-{2,}[>xo]|-{3,})\s*"),
+    "==": re.compile(r"\s*(?:={2,}[>xo]|={3,})\s*"),
+    "-.": re.compile(r"\s*(?:\.+-[>xo]?)\s*"),
+}
+_RE_PIPE_TEXT = re.compile(r"\|([^|]*)\|\s*")
+_RE_STYLE_PROPERTY = re.compile(r"^\s*[A-Za-z-]+\s*:\s*[^=:{}\[\]]+$")
+_RE_CLASS_DEF = re.compile(r"^classDef\s+([\w-]+(?:\s*,\s*[\w-]+)*)\s+(.+)$")
+_RE_CLASS = re.compile(r"^class\s+([\w-]+(?:\s*,\s*[\w-]+)*)\s+([\w-]+)\s*$")
+_RE_STYLE = re.compile(r"^style\s+([\w-]+)\s+(.+)$")
+_RE_LINK_STYLE = re.compile(r"^linkStyle\s+(default|\d+(?:\s*,\s*\d+)*)\s+(.+)$")
+_RE_DIRECTION = re.compile(r"^direction\s+(\S+)\s*$")
+
+
+class MermaidError(NamedTuple):
+    """A syntax error in a Mermaid graph, located by 1-based line and column"""
+    line: int
+    column: int
+    message: str
+
+    def __str__(self):
+        return f"line {self.line}, column {self.column}: {self.message}"
+
+
+class Vertex(NamedTuple):
+    """A node as written in a statement; shape, label and class are None when omitted"""
+    id: str
+    shape: Optional[str]
+    label: Optional[str]
+    class_name: Optional[str]
+
+
+class Node:
+    """A node of a Graph, with the subgraph (index in Graph.subgraphs) it belongs to"""
+    __slots__ = ("id", "shape", "label", "subgraph")
+
+    def __init__(self, id: str, shape: Optional[str] = None, label: Optional[str] = None,
+                 subgraph: Optional[int] = None):
+        self.id = id
+        self.shape = shape
+        self.label = label
+        self.subgraph = subgraph
+
+    def __repr__(self):
+        return f"Node({self.id!r}, {self.shape!r}, {self.label!r}, {self.subgraph!r})"
+
+
+class Edge:
+    """A link between two nodes, with its arrow (e.g. "-->", or "<-->" with a start marker) and optional text"""
+    __slots__ = ("source", "target", "arrow", "text")
+
+    def __init__(self, source: str, target: str, arrow: str = "-->", text: Optional[str] = None):
+        self.source = source
+        self.target = target
+        self.arrow = arrow
+        self.text = text
+
+    def key(self) -> Tuple[str, str, str, str]:
+        return (self.source, self.target, self.arrow, self.text or "")
+
+    def __eq__(self, other):
+        return isinstance(other, Edge) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return f"Edge({self.source!r}, {self.target!r}, {self.arrow!r}, {self.text!r})"
+
+
+class Subgraph:
+    """A subgraph of a Graph, with its own node ids and the indices of its child subgraphs"""
+    __slots__ = ("id", "title", "parent", "direction", "nodes", "children")
+
+    def __init__(self, id: Optional[str], title: str, parent: Optional[int] = None):
+        self.id = id
+        self.title = title
+        self.parent = parent
+        self.direction = None
+        self.nodes = []
+        self.children = []
+
+    def __repr__(self):
+        return f"Subgraph({self.id!r}, {self.title!r}, parent={self.parent!r}, nodes={self.nodes!r})"
+
+
+class Graph:
+    """In-memory representation of a Mermaid flowchart, as returned by parse()
+
+    Nodes are kept in order of first appearance, edges in order of declaration (a statement
+    with "&" is expanded into one edge per pair of nodes). Statements that are not valid
+    are not part of the structure, they are reported in `errors`.
+    """
+    __slots__ = (
+        "keyword", "direction", "nodes", "edges", "subgraphs",
+        "class_defs", "classes", "styles", "link_styles", "raw_statements", "errors",
+    )
+
+    def __init__(self, keyword: str = "graph", direction: Optional[str] = None):
+        self.keyword = keyword
+        self.direction = direction
+        self.nodes = {}  # node id -> Node
+        self.edges = []  # Edge
+        self.subgraphs = []  # Subgraph, parents before their children
+        self.class_defs = {}  # class name -> styles
+        self.classes = {}  # node id -> class name
+        self.styles = {}  # node id -> styles
+        self.link_styles = []  # (link indices, styles)
+        self.raw_statements = []  # click and accessibility statements, kept as written
+        self.errors = []  # MermaidError
+
+    def is_valid(self) -> bool:
+        return len(self.errors) == 0
+
+    def add_vertex(self, vertex: Vertex, subgraph: Optional[int] = None):
+        """Add a node occurrence: the first shape and label given to a node id are kept"""
+        node = self.nodes.get(vertex.id)
+        if node is None:
+            self.nodes[vertex.id] = Node(vertex.id, vertex.shape, vertex.label, subgraph)
+            if subgraph is not None:
+                self.subgraphs[subgraph].nodes.append(vertex.id)
+        elif node.shape is None and vertex.shape is not None:
+            node.shape = vertex.shape
+            node.label = vertex.label
+        if vertex.class_name is not None:
+            self.classes.setdefault(vertex.id, vertex.class_name)
+
+    def to_mermaid(self, sort: bool = False) -> str:
+        """Serialize the graph to Mermaid code, in a canonical layout
+
+        One statement per line: header, nodes (nested in their subgraphs), edges, then the
+        classDef, class, style and linkStyle statements, and the click and accessibility
+        statements as written. Labels are quoted only when needed.
+        With sort=True, nodes and edges are sorted, so that two graphs with the same
+        structure serialize identically, whatever the order of their statements.
+        """
+        ls_lines = [self.keyword + (" " + self.direction if self.direction else "")]
+        ls_top_nodes = [node_id for node_id, node in self.nodes.items() if node.subgraph is None]
+        ls_top_subgraphs = [i for i, subgraph in enumerate(self.subgraphs) if subgraph.parent is None]
+
+        def write_container(ls_node_ids, ls_children, indent):
+            for node_id in (sorted(ls_node_ids) if sort else ls_node_ids):
+                ls_lines.append(indent + _format_node(self.nodes[node_id]))
+            ls_children = [self.subgraphs[i] for i in ls_children]
+            if sort:
+                ls_children = sorted(ls_children, key=lambda subgraph: (subgraph.id or "", subgraph.title))
+            for subgraph in ls_children:
+                ls_lines.append(indent + _format_subgraph(subgraph))
+                if subgraph.direction:
+                    ls_lines.append(indent + "    direction " + subgraph.direction)
+                write_container(subgraph.nodes, subgraph.children, indent + "    ")
+                ls_lines.append(indent + "end")
+
+        write_container(ls_top_nodes, ls_top_subgraphs, "    ")
+        ls_edges = sorted(self.edges, key=Edge.key) if sort else self.edges
+        for edge in ls_edges:
+            text = "|" + _format_label(edge.text) + "|" if edge.text is not None else ""
+            ls_lines.append("    " + edge.source + " " + edge.arrow + text + " " + edge.target)
+        for name, styles in self.class_defs.items():
+            ls_lines.append("    classDef " + name + " " + styles)
+        dc_members = {}
+        for node_id, name in self.classes.items():
+            dc_members.setdefault(name, []).append(node_id)
+        for name, ls_node_ids in dc_members.items():
+            ls_lines.append("    class " + ",".join(ls_node_ids) + " " + name)
+        for node_id, styles in self.styles.items():
+            ls_lines.append("    style " + node_id + " " + styles)
+        for indices, styles in self.link_styles:
+            ls_lines.append("    linkStyle " + indices + " " + styles)
+        for statement in self.raw_statements:
+            ls_lines.append("    " + statement)
+        return "\n".join(ls_lines)
+
+
+class _StatementError(Exception):
+    """Raised while scanning a statement, with the offset of the offending character"""
+    def __init__(self, offset: int, message: str):
+        super().__init__(message)
+        self.offset = offset
+        self.message = message
+
+
+def split_statements(line: str) -> List[Tuple[int, str]]:
+    """Split one line into `;` separated statements, ignoring `;` inside quotes or brackets
+
+    Returns a list of (offset within the line, statement text) tuples, with surrounding
+    whitespace removed and empty statements dropped.
+    """
+    ls_statements = []
+    start = 0
+    depth = 0
+    in_quotes = False
+    for i, char in enumerate(line):
+        if char == '"':
+            in_quotes = not in_quotes
+        elif in_quotes:
+            continue
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth = max(depth - 1, 0)
+        elif char == ";" and depth == 0:
+            ls_statements.append((start, line[start:i]))
+            start = i + 1
+    ls_statements.append((start, line[start:]))
+
+    ls_output = []
+    for offset, statement in ls_statements:
+        stripped = statement.strip()
+        if stripped:
+            ls_output.append((offset + len(statement) - len(statement.lstrip()), stripped))
+    return ls_output
+
+
+def _check_label(text: str, offset: int, quoted: bool):
+    # unquoted labels may not contain characters that the Mermaid lexer treats as delimiters
+    if quoted:
+        return
+    if text.strip() == "":
+        raise _StatementError(offset, "empty label")
+    for i, char in enumerate(text):
+        if char in FORBIDDEN_LABEL_CHARS:
+            raise _StatementError(
+                offset + i,
+                f"unquoted label contains '{char}', wrap the label in double quotes"
+            )
+
+
+def _scan_label(statement: str, pos: int, closers) -> Tuple[int, str, str, bool]:
+    """Scan a label up to one of the closing delimiters
+
+    Returns (position after the closer, closer, label text, whether the label was quoted).
+    """
+    start = pos
+    while pos < len(statement) and statement[pos] == " ":
+        pos += 1
+    if pos < len(statement) and statement[pos] == '"':
+        end_quote = statement.find('"', pos + 1)
+        if end_quote == -1:
+            raise _StatementError(pos, "unterminated quoted label")
+        text = statement[pos + 1:end_quote]
+        pos = end_quote + 1
+        while pos < len(statement) and statement[pos] == " ":
+            pos += 1
+        for closer in closers:
+            if statement.startswith(closer, pos):
+                return pos + len(closer), closer, text, True
+        raise _StatementError(pos, "expected " + " or ".join(f"'{c}'" for c in closers) + " after quoted label")
+
+    pos = start
+    while pos < len(statement):
+        for closer in closers:
+            if statement.startswith(closer, pos):
+                text = statement[start:pos]
+                _check_label(text, start, quoted=False)
+                return pos + len(closer), closer, text, False
+        pos += 1
+    raise _StatementError(start, "label is never closed with " + " or ".join(f"'{c}'" for c in closers))
+
+
+def _scan_vertex(statement: str, pos: int) -> Tuple[int, Vertex]:
+    # vertex := ID shape? (":::" class)?
+    match = _RE_ID.match(statement, pos)
+    if match is None:
+        found = statement[pos] if pos < len(statement) else "end of statement"
+        raise _StatementError(pos, f"expected a node id, found '{found}'")
+    if match.group(0) in RESERVED_IDS:
+        raise _StatementError(pos, f"'{match.group(0)}' is a reserved word and can not be used as a node id")
+    node_id = match.group(0)
+    pos = match.end()
+
+    # optional shape, possibly separated from the id by spaces
+    shape = None
+    label = None
+    shape_pos = pos
+    while shape_pos < len(statement) and statement[shape_pos] == " ":
+        shape_pos += 1
+    for opener, shapes in SHAPES:
+        if statement.startswith(opener, shape_pos):
+            closers = [closer for closer, _ in shapes]
+            pos, closer, label, _ = _scan_label(statement, shape_pos + len(opener), closers)
+            shape = dict(shapes)[closer]
+            break
+
+    class_name = None
+    match = _RE_CLASS_SUFFIX.match(statement, pos)
+    if match is not None:
+        class_name = match.group(1)
+        pos = match.end()
+    return pos, Vertex(node_id, shape, label, class_name)
+
+
+def _scan_vertex_group(statement: str, pos: int) -> Tuple[int, List[Vertex]]:
+    # vertex_group := vertex ("&" vertex)*
+    pos, vertex = _scan_vertex(statement, pos)
+    ls_vertices = [vertex]
+    while True:
+        match = _RE_AMPERSAND.match(statement, pos)
+        if match is None:
+            return pos, ls_vertices
+        pos, vertex = _scan_vertex(statement, match.end())
+        ls_vertices.append(vertex)
+
+
+def _unquote(text: str) -> str:
+    stripped = text.strip()
+    if len(stripped) >= 2 and stripped[0] == stripped[-1] == '"':
+        return stripped[1:-1]
+    return stripped
+
+
+def _scan_link(statement: str, pos: int) -> Optional[Tuple[int, str, Optional[str]]]:
+    # link := LINK ("|" text "|")? | START_LINK text LINK_END
+    # returns (position after the link, arrow, link text) or None if there is no link
+    match = _RE_LINK.match(statement, pos)
+    if match is not None:
+        arrow = match.group(0).strip()
+        pos = match.end()
+        text = None
+        if statement.startswith("|", pos):
+            pipe = _RE_PIPE_TEXT.match(statement, pos)
+            if pipe is None:
+                raise _StatementError(pos, "link text is never closed with '|'")
+            text = pipe.group(1)
+            stripped = text.strip()
+            quoted = len(stripped) >= 2 and stripped[0] == stripped[-1] == '"'
+            _check_label(text, pos + 1, quoted=quoted)
+            text = _unquote(text)
+            pos = pipe.end()
+        return pos, arrow, text
+
+    match = _RE_LINK_START.match(statement, pos)
+    if match is not None:
+        re_end = _RE_LINK_END[match.group(2)]
+        text_start = match.end()
+        for end in re_end.finditer(statement, text_start):
+            text = statement[text_start:end.start()]
+            stripped = text.strip()
+            quoted = len(stripped) >= 2 and stripped[0] == stripped[-1] == '"'
+            _check_label(text, text_start, quoted=quoted)
+            # the start marker is kept in the arrow: A x-- text --x B is A x--x|text| B, and
+            # dotted links get their leading dash back: A -. text .-> B is A -.->|text| B
+            arrow = match.group(1) + ("-" if match.group(2) == "-." else "") + end.group(0).strip()
+            return end.end(), arrow, _unquote(text)
+        raise _StatementError(pos, "link text is never closed with an arrow")
+    return None
+
+
+def _parse_node_statement(statement: str) -> Tuple[List[Vertex], List[Edge]]:
+    # statement := vertex_group (link vertex_group)*
+    pos, ls_group = _scan_vertex_group(statement, 0)
+    ls_vertices = list(ls_group)
+    ls_links = []
+    while pos < len(statement):
+        link = _scan_link(statement, pos)
+        if link is None:
+            raise _StatementError(pos, f"unexpected '{statement[pos]}'")
+        link_end, arrow, text = link
+        if link_end >= len(statement):
+            raise _StatementError(pos, "link has no target node")
+        pos, ls_targets = _scan_vertex_group(statement, link_end)
+        for source in ls_group:
+            for target in ls_targets:
+                ls_links.append(Edge(source.id, target.id, arrow, text))
+        ls_vertices.extend(ls_targets)
+        ls_group = ls_targets
+    return ls_vertices, ls_links
+
+
+def _check_styles(styles: str, offset: int):
+    # styles := property ("," property)*, commas inside parentheses (e.g. rgb(...)) do not split
+    depth = 0
+    start = 0
+    ls_properties = []
+    for i, char in enumerate(styles):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth = max(depth - 1, 0)
+        elif char == "," and depth == 0:
+            ls_properties.append((start, styles[start:i]))
+            start = i + 1
+    ls_properties.append((start, styles[start:]))
+    for start, prop in ls_properties:
+        if _RE_STYLE_PROPERTY.match(prop) is None:
+            raise _StatementError(
+                offset + start,
+                f"invalid style '{prop.strip()}', expected 'property:value'"
+            )
+
+
+def _scan_subgraph(rest: str, offset: int) -> Tuple[Optional[str], str]:
+    # subgraph := "subgraph" (ID ("[" text "]")? | '"' title '"' | title)
+    # returns the (id, title) of the subgraph
+    if rest == "":
+        raise _StatementError(offset, "subgraph needs an id or a title")
+    if rest[0] == '"':
+        end_quote = rest.find('"', 1)
+        if end_quote == -1:
+            raise _StatementError(offset, "unterminated quoted subgraph title")
+        if rest[1:end_quote].strip() == "":
+            raise _StatementError(offset, "subgraph title is empty")
+        if rest[end_quote + 1:].strip() != "":
+            raise _StatementError(offset + end_quote + 1, "unexpected text after subgraph title")
+        return None, rest[1:end_quote]
+    match = _RE_ID.match(rest)
+    if match is not None:
+        if match.end() == len(rest):
+            return rest, rest
+        bracket = match.end()
+        while bracket < len(rest) and rest[bracket] == " ":
+            bracket += 1
+        if rest.startswith("[", bracket):
+            pos, _, title, _ = _scan_label(rest, bracket + 1, ["]"])
+            if rest[pos:].strip() != "":
+                raise _StatementError(offset + pos, "unexpected text after subgraph title")
+            return match.group(0), title
+    for i, char in enumerate(rest):
+        if char in FORBIDDEN_LABEL_CHARS:
+            raise _StatementError(
+                offset + i,
+                f"unquoted subgraph title contains '{char}', wrap the title in double quotes"
+            )
+    return None, rest
+
+
+# delimiters of each node shape, for serialization
+SHAPE_DELIMITERS = {
+    name: (opener, closer) for opener, shapes in SHAPES for closer, name in shapes
+}
+_RE_PLAIN_LABEL = re.compile(r"^[\w][\w .,:;!?'/+*#&%-]*$")
+
+
+def _format_label(text: str) -> str:
+    # the label as is when it is safe unquoted, otherwise in double quotes
+    if _RE_PLAIN_LABEL.match(text) and not text.endswith(" "):
+        return text
+    return '"' + text.replace('"', "#quot;") + '"'
+
+
+def _format_node(node: Node) -> str:
+    if node.shape is None:
+        return node.id
+    opener, closer = SHAPE_DELIMITERS[node.shape]
+    return node.id + opener + _format_label(node.label or "") + closer
+
+
+def _format_subgraph(subgraph: Subgraph) -> str:
+    if subgraph.id is None:
+        return "subgraph " + _format_label(subgraph.title)
+    if subgraph.title == subgraph.id:
+        return "subgraph " + subgraph.id
+    return "subgraph " + subgraph.id + "[" + _format_label(subgraph.title) + "]"
+
+
+def parse(graph: str) -> Graph:
+    """Parse a Mermaid flowchart into a Graph, checking its syntax at the same time
+
+    Covers the subset of the flowchart grammar used by the prompts: graph/flowchart header,
+    nodes and shapes, links (with text), subgraphs, classDef/class/style/linkStyle
+    statements. The text is scanned once, in linear time.
+
+    Parameters
+    ----------
+    graph :
+        Mermaid code, as extracted from the <mermaid></mermaid> tags of a completion.
+
+    Returns
+    -------
+    A Graph. Its `errors` list holds one MermaidError per invalid statement, and the
+    invalid statements are left out of the structure.
+    """
+    parsed = Graph()
+    ls_errors = parsed.errors
+    ls_open_subgraphs = []  # (index, line, column) of each subgraph waiting for its "end"
+    header_found = False
+
+    for line_number, line in enumerate(graph.splitlines(), start=1):
+        stripped = line.strip()
+        if stripped == "" or stripped.startswith("%%"):
+            continue
+
+        for offset, statement in split_statements(line):
+            column = offset + 1
+
+            if header_found is False:
+                if statement.startswith("```"):
+                    ls_errors.append(MermaidError(line_number, column, "stray markdown fence"))
+                    return parsed
+                match = _RE_HEADER.match(statement)
+                if match is None:
+                    ls_errors.append(MermaidError(
+                        line_number, column,
+                        "expected a 'graph' or 'flowchart' header, found '" + statement.split()[0] + "'"
+                    ))
+                    return parsed
+                if match.group(2) is not None and match.group(2) not in DIRECTIONS:
+                    ls_errors.append(MermaidError(
+                        line_number, column + match.start(2),
+                        f"unknown direction '{match.group(2)}', expected one of " + ", ".join(DIRECTIONS)
+                    ))
+                else:
+                    parsed.direction = match.group(2)
+                parsed.keyword = match.group(1)
+                header_found = True
+                continue
+
+            keyword = statement.split(maxsplit=1)[0]
+            current = ls_open_subgraphs[-1][0] if len(ls_open_subgraphs) > 0 else None
+            try:
+                if statement.startswith("```"):
+                    raise _StatementError(0, "stray markdown fence")
+                elif keyword == "subgraph":
+                    # opened before checking the title, so that its "end" still matches
+                    subgraph = Subgraph(None, "", parent=current)
+                    parsed.subgraphs.append(subgraph)
+                    if current is not None:
+                        parsed.subgraphs[current].children.append(len(parsed.subgraphs) - 1)
+                    ls_open_subgraphs.append((len(parsed.subgraphs) - 1, line_number, column))
+                    rest = statement[len("subgraph"):]
+                    subgraph.id, subgraph.title = _scan_subgraph(
+                        rest.strip(), len(statement) - len(rest.lstrip())
+                    )
+                elif keyword == "end":
+                    if statement != "end":
+                        raise _StatementError(3, "unexpected text after 'end'")
+                    if len(ls_open_subgraphs) == 0:
+                        raise _StatementError(0, "'end' without a matching 'subgraph'")
+                    ls_open_subgraphs.pop()
+                elif keyword == "direction":
+                    match = _RE_DIRECTION.match(statement)
+                    if match is None or match.group(1) not in DIRECTIONS:
+                        raise _StatementError(0, "expected 'direction' followed by one of " + ", ".join(DIRECTIONS))
+                    if current is None:
+                        raise _StatementError(0, "'direction' is only allowed inside a subgraph")
+                    parsed.subgraphs[current].direction = match.group(1)
+                elif keyword == "classDef":
+                    match = _RE_CLASS_DEF.match(statement)
+                    if match is None:
+                        raise _StatementError(0, "expected 'classDef <name> <styles>'")
+                    _check_styles(match.group(2), match.start(2))
+                    for name in match.group(1).split(","):
+                        parsed.class_defs[name.strip()] = match.group(2).strip()
+                elif keyword == "class":
+                    match = _RE_CLASS.match(statement)
+                    if match is None:
+                        raise _StatementError(0, "expected 'class <node ids> <class name>'")
+                    for node_id in match.group(1).split(","):
+                        parsed.classes[node_id.strip()] = match.group(2)
+                elif keyword == "style":
+                    match = _RE_STYLE.match(statement)
+                    if match is None:
+                        raise _StatementError(0, "expected 'style <node id> <styles>'")
+                    _check_styles(match.group(2), match.start(2))
+                    parsed.styles[match.group(1)] = match.group(2).strip()
+                elif keyword == "linkStyle":
+                    match = _RE_LINK_STYLE.match(statement)
+                    if match is None:
+                        raise _StatementError(0, "expected 'linkStyle <link indices> <styles>'")
+                    _check_styles(match.group(2), match.start(2))
+                    parsed.link_styles.append((match.group(1), match.group(2).strip()))
+                elif keyword in ("click", "accTitle", "accTitle:", "accDescr", "accDescr:"):
+                    parsed.raw_statements.append(statement)
+                else:
+                    ls_vertices, ls_edges = _parse_node_statement(statement)
+                    for vertex in ls_vertices:
+                        parsed.add_vertex(vertex, current)
+                    parsed.edges.extend(ls_edges)
+            except _StatementError as e:
+                ls_errors.append(MermaidError(line_number, column + e.offset, e.message))
+
+    if header_found is False:
+        ls_errors.append(MermaidError(1, 1, "graph is empty"))
+    for _, line_number, column in ls_open_subgraphs:
+        ls_errors.append(MermaidError(line_number, column, "subgraph is never closed with 'end'"))
+    return parsed
+
+
+def validate_graph(graph: str) -> List[MermaidError]:
+    """Check the syntax of a Mermaid flowchart without rendering it
+
+    Returns a list of MermaidError, one per invalid statement (see parse()). An empty list
+    means the graph is valid.
+    """
+    return parse(graph).errors
+
+
+def is_valid_graph(graph: str) -> bool:
+    """Return True if the given Mermaid flowchart has no syntax errors"""
+    return len(validate_graph(graph)) == 0
+
+
+def count_links(graph: str) -> int:
+    """Number of links of a flowchart, e.g. to reject trivially small diagrams"""
+    return len(parse(graph).edges)
+
+
+def normalize_graph(graph: str) -> str:
+    """Canonical form of a flowchart, to compare two versions regardless of formatting
+
+    Two graphs differing only in comments, layout, quoting or statement order normalize
+    identically.
+    """
+    return parse(graph).to_mermaid(sort=True)
@@ -0,0 +1,606 @@
+"""Stage-based visual gist pipeline, with a scheduler running the stages of many documents
+
+A pipeline is a list of stages (fetch, extract, prompt, generate, validate, select, refine,
+render), each a function from named inputs to named outputs, configured only through a
+PipelineConfig. The stages to run are planned backwards from the wanted outputs, so that a
+document given with some intermediate values (e.g. its text, or an edited prompt) skips the
+stages producing them, and any stage can be replaced (see Pipeline.replace()).
+
+The scheduler runs every stage as soon as its inputs are available, in a thread pool per
+kind of work: fetches in the "io" pool, model calls in the "llm" pool, local computations
+in the "cpu" pool. Several documents are in flight at once, so that the pages of the next
+documents are fetched while the current ones wait for the model. Progress is reported
+through an `on_event` callback, called in the thread that consumes the results, which is
+how the Streamlit app and the batch CLI (see app.py and batch.py) follow a run.
+"""
+# Python Built-Ins:
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+# Local Dependencies:
+import chunking
+import gist
+import llm
+import mermaid
+import render
+import retry
+import selection
+import singleflight
+import webpage
+
+
+IO = "io"  # network access other than the model, e.g. fetching a webpage
+LLM = "llm"  # model calls
+CPU = "cpu"  # local computations, e.g. validating or rendering a diagram
+
+
+class PipelineConfig(NamedTuple):
+    """Settings of a pipeline run, the same for all its documents"""
+    model_generate: str = gist.DEFAULT_MODEL_GENERATE
+    model_reflect: str = gist.DEFAULT_MODEL_REFLECT
+    model_summarize: str = gist.DEFAULT_MODEL_SUMMARIZE
+    system_prompt: str = gist.PROMPT_SYSTEM
+    prompt_template: Optional[str] = None  # defaults to PROMPT_VARIANTS or PROMPT_SINGLE
+    generate_at_once: bool = False  # all the diagrams in one completion, instead of one each
+    cascade_models: Optional[Tuple[str, ...]] = None  # used instead of model_generate if set
+    number_of_diagrams: int = 3
+    orientation: str = "LR"
+    token_budget: int = gist.DEFAULT_TOKEN_BUDGET
+    repeat_on_error: bool = True
+    max_tokens_to_sample: int = 2048
+    temperature: float = 0.15
+    top_p: float = 1
+    stream: bool = False
+    select: bool = True  # if False, the first valid diagram is kept
+    local_only: bool = False  # select by local score only, without any model call
+    top_k: int = 4  # diagrams kept for the model comparisons of the selection
+    refine_iterations: int = 1
+    multi_turn: bool = True
+    max_workers: int = 5  # parallel model calls within a stage of one document
+    theme: str = "default"
+
+
+class StageContext(NamedTuple):
+    """What a stage function gets besides its inputs"""
+    bedrock_runtime: object
+    config: PipelineConfig
+    response_cache: object
+    retry_policy: retry.RetryPolicy
+    emit: Callable[[str, object], None]  # emit(event, payload) reports progress to on_event
+
+
+class Stage(NamedTuple):
+    """One step of the pipeline
+
+    `function(context, **inputs)` receives a StageContext and the values named by `inputs`,
+    and returns a dictionary with (at least) the values named by `outputs`.
+    """
+    name: str
+    function: Callable[..., dict]
+    inputs: Tuple[str, ...]
+    outputs: Tuple[str, ...]
+    pool: str = LLM
+
+
+
+#----------------------------------------------------------- stages
+
+def stage_fetch(context, url):
+    dc_page = webpage.fetch_page(url)
+    if dc_page["text"].strip() == "":
+        raise ValueError("No text could be extracted from " + url)
+    return {"text": dc_page["text"], "title": dc_page["title"]}
+
+
+def stage_extract(context, text):
+    # the text given to the model stages: the text itself, or a summary if it is too long
+    dc_condensed = chunking.condense_text(
+        context.bedrock_runtime,
+        text=text,
+        token_budget=context.config.token_budget,
+        model_id=context.config.model_summarize,
+        max_workers=context.config.max_workers,
+        response_cache=context.response_cache,
+    )
+    return {"reference_text": dc_condensed["text"], "condensed": dc_condensed}
+
+
+def stage_prompt(context, reference_text):
+    config = context.config
+    template = config.prompt_template
+    if template is None:
+        template = gist.PROMPT_VARIANTS if config.generate_at_once else gist.PROMPT_SINGLE
+    return {
+        "prompt": gist.build_prompt(template, reference_text, config.orientation, config.number_of_diagrams)
+    }
+
+
+def stage_generate(context, prompt):
+    config = context.config
+    on_variant = lambda d, dc_output, error: context.emit(
+        "variant", {"variant": d, "output": dc_output, "error": error}
+    )
+    if config.generate_at_once is True:
+        ls_variants = gist.generate_diagrams_at_once(
+            context.bedrock_runtime,
+            prompt=prompt,
+            model_id=config.model_generate,
+            system_prompt=config.system_prompt,
+            number_of_diagrams=config.number_of_diagrams,
+            repeat_on_error=config.repeat_on_error,
+            max_tokens_to_sample=config.max_tokens_to_sample,
+            temperature=config.temperature,
+            top_p=config.top_p,
+            stream=config.stream,
+            response_cache=context.response_cache,
+            retry_policy=context.retry_policy,
+            on_variant=on_variant,
+            on_message=lambda message: context.emit("message", message),
+        )
+        return {"variants": ls_variants}
+    ls_variants = gist.generate_diagrams(
+        context.bedrock_runtime,
+        prompt=prompt,
+        model_id=config.model_generate,
+        system_prompt=config.system_prompt,
+        number_of_diagrams=config.number_of_diagrams,
+        max_workers=config.max_workers,
+        repeat_on_error=config.repeat_on_error,
+        max_tokens_to_sample=config.max_tokens_to_sample,
+        temperature=config.temperature,
+        top_p=config.top_p,
+        stream=config.stream,
+        response_cache=context.response_cache,
+        retry_policy=context.retry_policy,
+        ls_cascade_models=list(config.cascade_models) if config.cascade_models else None,
+        on_variant=on_variant,
+    )
+    return {"variants": ls_variants}
+
+
+def stage_validate(context, variants):
+    # the valid diagrams, or all of them if none is valid, so that there is still something to show
+    if len(variants) == 0:
+        raise RuntimeError("No diagram could be generated")
+    ls_valid = [dc_diagram for dc_diagram in variants if dc_diagram["valid"]]
+    return {"diagrams": ls_valid or list(variants)}
+
+
+def stage_select(context, reference_text, diagrams):
+    config = context.config
+    if config.select is False or len(diagrams) == 1:
+        return {
+            "selected": {**diagrams[0], "justification": "This is the only available diagram"},
+            "selection": None,
+        }
+    dc_selection = selection.select_best(
+        context.bedrock_runtime,
+        model_id=config.model_reflect,
+        system_prompt=config.system_prompt,
+        prompt_prefix=gist.PROMPT_TEXT_BLOCK.replace("{html_text}", reference_text),
+        text=reference_text,
+        ls_graphs=[dc_diagram["processed_graph"] for dc_diagram in diagrams],
+        max_survivors=config.top_k,
+        max_workers=config.max_workers,
+        response_cache=context.response_cache,
+        retry_policy=context.retry_policy,
+        local_only=config.local_only,
+    )
+    return {
+        "selected": {**diagrams[dc_selection["indx_selected"]], "justification": dc_selection["raw_output"]},
+        "selection": dc_selection,
+    }
+
+
+def stage_refine(context, reference_text, selected):
+    config = context.config
+    if config.refine_iterations <= 0:
+        return {"graph": selected["processed_graph"], "justification": selected["justification"], "refinement": None}
+    dc_refined = gist.refine_diagram(
+        context.bedrock_runtime,
+        text=reference_text,
+        diagram=selected["processed_graph"],
+        model_id=config.model_reflect,
+        system_prompt=config.system_prompt,
+        iterations=config.refine_iterations,
+        multi_turn=config.multi_turn,
+        response_cache=context.response_cache,
+        retry_policy=context.retry_policy,
+        on_iteration=lambda i, dc_iteration: context.emit("iteration", {"iteration": i, **dc_iteration}),
+    )
+    # a refinement that broke the diagram is not kept
+    if not mermaid.is_valid_graph(dc_refined["refined_diagram"]):
+        return {"graph": selected["processed_graph"], "justification": selected["justification"], "refinement": dc_refined}
+    return {"graph": dc_refined["refined_diagram"], "justification": dc_refined["justification"], "refinement": dc_refined}
+
+
+def stage_render(context, graph):
+    return {"svg": render.get_svg(graph, context.config.theme).decode("utf8")}
+
+
+def default_stages() -> List[Stage]:
+    return [
+        Stage("fetch", stage_fetch, ("url",), ("text", "title"), IO),
+        Stage("extract", stage_extract, ("text",), ("reference_text", "condensed"), LLM),
+        Stage("prompt", stage_prompt, ("reference_text",), ("prompt",), CPU),
+        Stage("generate", stage_generate, ("prompt",), ("variants",), LLM),
+        Stage("validate", stage_validate, ("variants",), ("diagrams",), CPU),
+        Stage("select", stage_select, ("reference_text", "diagrams"), ("selected", "selection"), LLM),
+        Stage("refine", stage_refine, ("reference_text", "selected"), ("graph", "justification", "refinement"), LLM),
+        Stage("render", stage_render, ("graph",), ("svg",), CPU),
+    ]
+
+
+
+#----------------------------------------------------------- scheduler
+
+class Pipeline:
+    """Stages of a pipeline, and the scheduler running them
+
+    Parameters
+    ----------
+    ls_stages :
+        The stages, defaults to default_stages(). Each value must be the output of at most
+        one stage, and the stages may not depend on each other in a cycle.
+    """
+
+    def __init__(self, ls_stages: Optional[List[Stage]] = None):
+        self.ls_stages = list(ls_stages) if ls_stages is not None else default_stages()
+        self.dc_producers = {}  # value name -> stage producing it
+        for stage in self.ls_stages:
+            for output in stage.outputs:
+                if output in self.dc_producers:
+                    raise ValueError(
+                        f"'{output}' is an output of both '{self.dc_producers[output].name}' and '{stage.name}'"
+                    )
+                self.dc_producers[output] = stage
+        # raises on cycles
+        ls_external = [
+            value for stage in self.ls_stages for value in stage.inputs if value not in self.dc_producers
+        ]
+        self.plan(ls_external, self.outputs())
+
+    def outputs(self) -> List[str]:
+        return [output for stage in self.ls_stages for output in stage.outputs]
+
+    def replace(self, stage: Stage) -> "Pipeline":
+        """A new pipeline with the stage of the same name replaced"""
+        if stage.name not in [other.name for other in self.ls_stages]:
+            raise ValueError(f"No stage named '{stage.name}'")
+        return Pipeline([stage if other.name == stage.name else other for other in self.ls_stages])
+
+    def plan(self, provided: Iterable[str], targets: Iterable[str]) -> List[Stage]:
+        """Stages needed to compute the targets from the provided values, in dependency order
+
+        Stages whose outputs are all provided are skipped. Raises ValueError if a value is
+        neither provided nor produced by a stage, or if the stages depend on each other in a cycle.
+        """
+        provided = set(provided)
+        ls_plan = []
+        planned = set()
+        visiting = set()
+
+        def need(value, needed_by):
+            if value in provided:
+                return
+            stage = self.dc_producers.get(value)
+            if stage is None:
+                raise ValueError(f"'{value}' is needed by {needed_by} but is neither given nor produced by a stage")
+            if stage.name in planned:
+                return
+            if stage.name in visiting:
+                raise ValueError(f"The stages depend on each other in a cycle through '{stage.name}'")
+            visiting.add(stage.name)
+            for input_value in stage.inputs:
+                need(input_value, f"stage '{stage.name}'")
+            visiting.discard(stage.name)
+            planned.add(stage.name)
+            ls_plan.append(stage)
+
+        for target in targets:
+            need(target, "the targets")
+        return ls_plan
+
+    def run_many(
+        self,
+        bedrock_runtime,
+        ls_inputs: Iterable[dict],
+        config: Optional[PipelineConfig] = None,
+        targets: Optional[Iterable[str]] = None,
+        max_documents: int = 2,
+        prefetch: int = 2,
+        io_workers: int = 4,
+        cpu_workers: int = 2,
+        response_cache=None,
+        retry_policy: Optional[retry.RetryPolicy] = None,
+        on_event: Optional[Callable[[int, Optional[str], str, object], None]] = None,
+        coalesce: bool = False,
+    ) -> Iterator[Tuple[int, dict, Optional[Exception]]]:
+        """Run the pipeline on several documents, yielding each one as soon as it is done
+
+        Parameters
+        ----------
+        ls_inputs :
+            The initial values of each document, e.g. {"url": ...}, or {"text": ..., "title": ...}
+            to skip the fetch, see document_inputs(). Read lazily, as documents are started.
+        targets :
+            Values to compute, defaults to the outputs of all the stages.
+        max_documents :
+            Documents in the model stages at the same time (the size of the "llm" pool).
+        prefetch :
+            Additional documents started ahead, whose fetch and other non-model stages run
+            while the model is busy with the others.
+        response_cache :
+            Optional response cache, see llm.converse(). None disables it.
+        on_event :
+            Optional callback, called in the consuming thread with the document index, the
+            stage name, the event and its payload. The events are "start" (no payload),
+            "done" (the outputs of the stage), "error" (the exception), and the progress
+            events of the stages: "variant" and "message" (generate), "iteration" (refine).
+            With `coalesce`, a "coalesced" event (with no stage) tells where the result of
+            the document comes from: "store" or "in-flight".
+        coalesce :
+            Whether to share the results of identical requests (see singleflight.py): once
+            its text is known, a document is served from the result store, or waits for an
+            identical document in flight, in this run or any other of the process.
+
+        Yields
+        ------
+        The index of each document in `ls_inputs`, its values (the inputs, the outputs of
+        its stages, and the "timings" of the stages in seconds), and the exception that
+        stopped it or None. Documents are yielded in order of completion.
+        """
+        config = config or PipelineConfig()
+        retry_policy = retry_policy or retry.RetryPolicy()
+        targets = list(targets) if targets is not None else self.outputs()
+        events = queue.Queue()  # (kind, index, stage, payload) from the workers
+        dc_pools = {
+            IO: ThreadPoolExecutor(max_workers=io_workers),
+            LLM: ThreadPoolExecutor(max_workers=max_documents),
+            CPU: ThreadPoolExecutor(max_workers=cpu_workers),
+        }
+        dc_active = {}  # document index -> its state
+        iter_inputs = enumerate(ls_inputs)
+        exhausted = False
+
+        def submit_ready(index):
+            dc_run = dc_active[index]
+            if dc_run["error"] is not None or dc_run["waiting"] is True or dc_run["shared"] is not None:
+                return
+            for stage in list(dc_run["pending"]):
+                if all(value in dc_run["values"] for value in stage.inputs):
+                    dc_run["pending"].remove(stage)
+                    dc_run["running"] += 1
+                    context = StageContext(
+                        bedrock_runtime=bedrock_runtime,
+                        config=config,
+                        response_cache=response_cache,
+                        retry_policy=retry_policy,
+                        emit=lambda event, payload, index=index, stage=stage: events.put(
+                            ("event", index, stage, (event, payload))
+                        ),
+                    )
+                    dc_stage_inputs = {value: dc_run["values"][value] for value in stage.inputs}
+                    dc_pools.get(stage.pool, dc_pools[LLM]).submit(
+                        _execute, stage, context, dc_stage_inputs,
+                        lambda payload, index=index, stage=stage: events.put(("done", index, stage, payload)),
+                    )
+
+        def join_flight(index):
+            # once the text of a document is known: reuse a stored result, follow an identical
+            # request in flight, or lead the flight of this one
+            dc_run = dc_active[index]
+            key = singleflight.request_key(dc_run["values"], config, targets)
+            if key is None:
+                return
+            dc_run["key"] = key
+            dc_stored = result_store.get(key)
+            if dc_stored is not None:
+                dc_run["shared"] = (dc_stored, None)
+                source = "store"
+            else:
+                flight, leader = flights.join(key)
+                if leader is True:
+                    dc_run["flight"] = flight
+                    return
+                dc_run["waiting"] = True
+                flight.add_done_callback(
+                    lambda dc_outputs, error, index=index: events.put(("shared", index, None, (dc_outputs, error)))
+                )
+                source = "in-flight"
+            if on_event is not None:
+                on_event(index, None, "coalesced", source)
+
+        def is_finished(dc_run):
+            # a failed document still waits for its running stages, but starts no other
+            if dc_run["shared"] is not None:
+                return True
+            return (
+                dc_run["waiting"] is False and dc_run["running"] == 0
+                and (dc_run["error"] is not None or len(dc_run["pending"]) == 0)
+            )
+
+        def finish(index):
+            # the result of a document, passed on to the identical requests that followed it
+            dc_run = dc_active.pop(index)
+            if dc_run["shared"] is not None:
+                dc_outputs, error = dc_run["shared"]
+                return index, {**dc_run["values"], **(dc_outputs or {})}, error
+            dc_values, error = dc_run["values"], dc_run["error"]
+            if dc_run["flight"] is not None:
+                dc_outputs = {name: value for name, value in dc_values.items() if name not in dc_run["inputs"]}
+                if error is None:
+                    try:
+                        result_store.put(dc_run["key"], dc_outputs)
+                    except (TypeError, ValueError):
+                        pass  # not JSON serializable (e.g. the outputs of a custom stage): only shared in flight
+                flights.land(dc_run["flight"], dc_outputs if error is None else None, error)
+            return index, dc_values, error
+
+        flights = singleflight.get_singleflight() if coalesce else None
+        result_store = singleflight.get_result_store() if coalesce else None
+        try:
+            while True:
+                # start documents until enough are in flight
+                while exhausted is False and len(dc_active) < max_documents + prefetch:
+                    try:
+                        index, dc_inputs = next(iter_inputs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    try:
+                        ls_plan = self.plan(dc_inputs, targets)
+                    except ValueError as e:
+                        yield index, dict(dc_inputs), e
+                        continue
+                    if len(ls_plan) == 0:
+                        yield index, {**dc_inputs, "timings": {}}, None
+                        continue
+                    dc_active[index] = {
+                        "inputs": dc_inputs,
+                        "values": {**dc_inputs, "timings": {}},
+                        "pending": ls_plan,
+                        "running": 0,
+                        "error": None,
+                        "key": None,  # request key, once the text is known (with coalesce)
+                        "flight": None,  # flight led by this document
+                        "waiting": False,  # for the flight of an identical document
+                        "shared": None,  # (outputs, error) of an identical document
+                    }
+                    if coalesce is True:
+                        join_flight(index)
+                    submit_ready(index)
+                    if is_finished(dc_active[index]):
+                        yield finish(index)
+                if len(dc_active) == 0:
+                    break
+
+                kind, index, stage, payload = events.get()
+                dc_run = dc_active.get(index)
+                if dc_run is None:
+                    continue  # late event of a document already served by an identical one
+                if kind == "event":
+                    if on_event is not None:
+                        on_event(index, stage.name, *payload)
+                    continue
+
+                if kind == "shared":
+                    dc_outputs, error = payload
+                    if isinstance(error, singleflight.FlightAborted):
+                        # the leader stopped: go on alone, leading a new flight or following one
+                        dc_run["waiting"] = False
+                        join_flight(index)
+                        submit_ready(index)
+                    else:
+                        dc_run["shared"] = (dc_outputs, error)
+                else:
+                    dc_run["running"] -= 1
+                    dc_outputs, duration, error = payload
+                    if error is not None:
+                        if dc_run["error"] is None:
+                            dc_run["error"] = error
+                        if on_event is not None:
+                            on_event(index, stage.name, "error", error)
+                    else:
+                        dc_run["values"].update(dc_outputs)
+                        dc_run["values"]["timings"][stage.name] = round(duration, 3)
+                        if on_event is not None:
+                            on_event(index, stage.name, "done", dc_outputs)
+                        if coalesce is True and dc_run["key"] is None:
+                            join_flight(index)
+                        submit_ready(index)
+                if is_finished(dc_run):
+                    yield finish(index)
+        finally:
+            # also reached if the consumer stops early: the stages not started are dropped,
+            # and the identical requests following this run go on alone
+            for dc_run in dc_active.values():
+                if dc_run["flight"] is not None:
+                    flights.land(dc_run["flight"], None, singleflight.FlightAborted())
+            for executor in dc_pools.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, bedrock_runtime, dc_inputs: dict, **kwargs) -> dict:
+        """Run the pipeline on one document and return its values, see run_many()
+
+        Raises the exception of the stage that failed, if any.
+        """
+        for index, dc_values, error in self.run_many(bedrock_runtime, [dc_inputs], **kwargs):
+            if error is not None:
+                raise error
+            return dc_values
+
+
+def _execute(stage: Stage, context: StageContext, dc_inputs: dict, report: Callable[[tuple], None]):
+    # runs one stage in a worker thread, and reports its (outputs, duration, error)
+    context.emit("start", None)
+    start = time.time()
+    try:
+        dc_outputs = stage.function(context, **dc_inputs)
+        ls_missing = [output for output in stage.outputs if output not in dc_outputs]
+        if len(ls_missing) > 0:
+            raise ValueError(f"Stage '{stage.name}' did not return {', '.join(ls_missing)}")
+    except Exception as e:
+        report((None, time.time() - start, e))
+        return
+    report((dc_outputs, time.time() - start, None))
+
+
+
+#----------------------------------------------------------- documents
+
+def document_inputs(url: Optional[str] = None, text: Optional[str] = None, title: str = "") -> dict:
+    """Initial values of a document given by its URL, or by its text (which skips the fetch)"""
+    if text is not None:
+        return {"url": url, "text": text, "title": title}
+    if url is None:
+        raise ValueError("Either a url or a text is needed")
+    return {"url": url}
+
+
+def gist_record(dc_values: dict) -> dict:
+    """JSON serializable summary of a completed document: its final diagram and how it was made
+
+    Returns
+    -------
+    A dictionary with the "url", "title", final "mermaid" code, whether it is "valid", the
+    "summary" of the text, the "justification" of the selection or of the refinement, the
+    number of "variants", whether the text was "condensed", the "timings" of the stages in
+    seconds, and the summed token "usage".
+    """
+    usage = {}
+    for dc_diagram in dc_values.get("variants", []):
+        usage = selection.add_usage(usage, dc_diagram["usage"])
+    for name in ("selection", "refinement"):
+        if dc_values.get(name) is not None:
+            usage = selection.add_usage(usage, dc_values[name]["usage"])
+    dc_timings = dict(dc_values.get("timings", {}))
+    dc_timings["total"] = round(sum(dc_timings.values()), 3)
+    return {
+        "url": dc_values.get("url"),
+        "title": dc_values.get("title", ""),
+        "mermaid": dc_values["graph"],
+        "valid": mermaid.is_valid_graph(dc_values["graph"]),
+        "summary": gist.extract_summary(dc_values["selected"].get("raw", "")),
+        "justification": dc_values["justification"].strip(),
+        "variants": len(dc_values.get("diagrams", [])),
+        "condensed": dc_values["condensed"]["condensed"] if dc_values.get("condensed") else False,
+        "timings": dc_timings,
+        "usage": usage,
+    }
+
+
+def make_gist(bedrock_runtime, url=None, text=None, config: Optional[PipelineConfig] = None, **kwargs) -> dict:
+    """Run the pipeline up to the final diagram for one document, and return its gist_record()
+
+    The response cache defaults to the one of the app (llm.get_response_cache()), so that
+    batch runs and the UI share their completions. Other keyword arguments are those of
+    Pipeline.run_many().
+    """
+    kwargs.setdefault("response_cache", llm.get_response_cache())
+    dc_values = Pipeline().run(
+        bedrock_runtime, document_inputs(url, text), config=config, targets=("graph", "justification"), **kwargs
+    )
+    return gist_record(dc_values)
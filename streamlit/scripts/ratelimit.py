@@ -0,0 +1,156 @@
+"""Process-wide rate limiting of the Bedrock calls, per model, against the RPM and TPM quotas"""
+# Python Built-Ins:
+import math
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+
+CHARS_PER_TOKEN = 4  # rough average for English text, see chunking.estimate_tokens()
+
+# (requests per minute, tokens per minute) by model id prefix. Conservative on-demand values,
+# to be aligned with the Service Quotas of the account; the longest matching prefix is used
+MODEL_QUOTAS = {
+    "anthropic.claude-3-haiku": (200, 400_000),
+    "anthropic.claude-3-5-haiku": (200, 400_000),
+    "anthropic.claude-3-sonnet": (100, 200_000),
+    "anthropic.claude-3-5-sonnet": (50, 200_000),
+    "amazon.nova": (100, 400_000),
+}
+DEFAULT_QUOTA = (50, 200_000)
+
+_limiters = {}  # model id -> RateLimiter shared by the whole process
+_limiters_lock = threading.Lock()
+
+
+def estimate_request_tokens(prompt: str, system_prompt: Optional[str], max_tokens: int) -> int:
+    """Tokens reserved for a request: the estimated input tokens plus the maximum output tokens"""
+    chars = len(prompt) + (len(system_prompt) if system_prompt else 0)
+    return math.ceil(chars / CHARS_PER_TOKEN) + max_tokens
+
+
+class TokenBucket:
+    """Bucket of `capacity` tokens, refilled continuously over one minute
+
+    Not thread-safe on its own, it is used under the lock of a RateLimiter.
+    """
+
+    def __init__(self, capacity: float):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / 60  # tokens per second
+        self.tokens = self.capacity
+        self._last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available (0 if they already are)"""
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def consume(self, amount: float):
+        # a negative amount gives tokens back; the level may go negative when the actual
+        # usage exceeds the reservation, delaying the next requests accordingly
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limiter of one model, with FIFO queueing
+
+    Callers get a ticket and are served strictly in arrival order, so a large request is
+    not starved by a stream of small ones, and sessions take turns instead of colliding.
+
+    Parameters
+    ----------
+    requests_per_minute, tokens_per_minute :
+        Quotas of the model. Input and output tokens both count against the token quota.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._finished = set()  # tickets done (served or given up) ahead of their turn
+
+    def acquire(self, tokens: int, timeout: Optional[float] = None) -> float:
+        """Wait for the turn of the caller and for quota for one request of `tokens` tokens
+
+        Returns the time waited in seconds. Raises TimeoutError if the quota is not
+        available within `timeout` seconds.
+        """
+        start = time.monotonic()
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            try:
+                while True:
+                    if ticket == self._serving:
+                        self.requests.refill()
+                        self.tokens.refill()
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                        if wait == 0:
+                            self.requests.consume(1)
+                            self.tokens.consume(min(tokens, self.tokens.capacity))
+                            return time.monotonic() - start
+                    else:
+                        wait = None  # woken up when the ticket being served changes
+                    if timeout is not None:
+                        remaining = timeout - (time.monotonic() - start)
+                        if remaining <= 0:
+                            raise TimeoutError("Rate limit quota not available in time")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                # served, or gave up: either way the callers behind move forward
+                self._done(ticket)
+
+    def _done(self, ticket: int):
+        # called with the lock held
+        self._finished.add(ticket)
+        while self._serving in self._finished:
+            self._finished.discard(self._serving)
+            self._serving += 1
+        self._condition.notify_all()
+
+    def settle(self, reserved_tokens: int, used_tokens: int):
+        """Correct the token bucket once the actual usage of a request is known"""
+        with self._condition:
+            self.tokens.consume(used_tokens - min(reserved_tokens, self.tokens.capacity))
+            self._condition.notify_all()
+
+    def report_throttling(self):
+        """Empty the request bucket after a throttling error, the quota is shared with others"""
+        with self._condition:
+            self.requests.refill()
+            self.requests.tokens = min(self.requests.tokens, 0)
+
+    def headroom(self) -> Dict[str, float]:
+        """Fraction (0 to 1) of the request and token quotas currently available, and the queue"""
+        with self._condition:
+            self.requests.refill()
+            self.tokens.refill()
+            return {
+                "requests": max(0.0, self.requests.tokens / self.requests.capacity),
+                "tokens": max(0.0, self.tokens.tokens / self.tokens.capacity),
+                "queued": self._next_ticket - self._serving,
+            }
+
+
+def get_quota(model_id: str) -> Tuple[int, int]:
+    """Return the (requests per minute, tokens per minute) quota of a model"""
+    ls_prefixes = [prefix for prefix in MODEL_QUOTAS if prefix in model_id]
+    if len(ls_prefixes) == 0:
+        return DEFAULT_QUOTA
+    return MODEL_QUOTAS[max(ls_prefixes, key=len)]
+
+
+def get_rate_limiter(model_id: str) -> RateLimiter:
+    """Return the process-wide rate limiter of a model, shared by all the sessions"""
+    with _limiters_lock:
+        if model_id not in _limiters:
+            _limiters[model_id] = RateLimiter(*get_quota(model_id))
+        return _limiters[model_id]
@@ -0,0 +1,655 @@
+"""Server-side SVG rendering of the Mermaid flowchart subset, without a browser or network
+
+The layout is a simplified layered (Sugiyama) layout: cycles are broken, nodes are
+assigned to ranks by longest path, long links go through dummy points, nodes are ordered
+within their rank by barycenter sweeps (keeping the members of a subgraph together), and
+positions are then relaxed towards their neighbours. Subgraphs are drawn as boxes around
+their members; their own "direction" statements are ignored.
+
+Rendered SVGs are cached on disk by graph and theme (see get_svg()), so that display,
+download and batch export reuse the same bytes.
+"""
+# Python Built-Ins:
+import html
+import math
+import re
+import textwrap
+from typing import Dict, List, Optional, Tuple, Union
+
+# Local Dependencies:
+import cache
+import mermaid
+
+
+RENDERER_VERSION = "2"  # part of the cache keys: bump it when the output changes
+
+FONT_FAMILY = "trebuchet ms, verdana, arial, sans-serif"
+FONT_SIZE = 14
+CHAR_WIDTH = 7.5  # average width of a character at FONT_SIZE
+LINE_HEIGHT = 18
+MAX_LABEL_CHARS = 28  # labels are wrapped above this length
+NODE_PADDING = (15, 10)  # horizontal, vertical
+NODE_GAP = 30  # between two nodes of the same rank
+RANK_GAP = 70  # between two ranks
+SUBGRAPH_PADDING = 15
+SUBGRAPH_TITLE_HEIGHT = 24
+DUMMY_SIZE = 8  # extent of the points long links go through
+MARGIN = 20
+ORDERING_SWEEPS = 4
+POSITIONING_SWEEPS = 4
+
+THEMES = {
+    "default": {
+        "background": "#ffffff", "fill": "#ECECFF", "stroke": "#9370DB", "text": "#333333",
+        "edge": "#333333", "cluster_fill": "#ffffde", "cluster_stroke": "#aaaa33",
+        "label_background": "#e8e8e8",
+    },
+    "neutral": {
+        "background": "#ffffff", "fill": "#eeeeee", "stroke": "#999999", "text": "#333333",
+        "edge": "#666666", "cluster_fill": "#f8f8f8", "cluster_stroke": "#bbbbbb",
+        "label_background": "#ffffff",
+    },
+    "dark": {
+        "background": "#333333", "fill": "#1f2020", "stroke": "#cccccc", "text": "#eeeeee",
+        "edge": "#d3d3d3", "cluster_fill": "#474949", "cluster_stroke": "#777777",
+        "label_background": "#585858",
+    },
+    "forest": {
+        "background": "#ffffff", "fill": "#cde498", "stroke": "#13540c", "text": "#333333",
+        "edge": "#13540c", "cluster_fill": "#cdffb2", "cluster_stroke": "#6eaa49",
+        "label_background": "#e8e8e8",
+    },
+}
+
+# style properties of classDef / style / linkStyle statements carried over to the SVG
+SHAPE_PROPERTIES = {
+    "fill", "stroke", "stroke-width", "stroke-dasharray", "opacity", "fill-opacity", "stroke-opacity",
+}
+TEXT_PROPERTIES = {"color": "fill", "font-weight": "font-weight", "font-style": "font-style"}
+
+_RE_BREAK = re.compile(r"<br\s*/?>", re.IGNORECASE)
+_RE_TAG = re.compile(r"<[^>]*>")
+_RE_ENTITY = re.compile(r"#(\w+);")
+
+_svg_cache = None
+
+
+class _Box:
+    """Position (center) and size of a laid out node, or of a dummy point of a long link"""
+    __slots__ = ("id", "width", "height", "x", "y", "lines", "shape", "chain")
+
+    def __init__(self, id, width, height, lines=(), shape=None, chain=()):
+        self.id = id
+        self.width = width
+        self.height = height
+        self.x = 0.0
+        self.y = 0.0
+        self.lines = lines
+        self.shape = shape
+        self.chain = chain  # indices of the subgraphs containing the node, outermost first
+
+
+def _entity(match) -> str:
+    # Mermaid entity codes: named (#quot;) or numeric (#35; for "#", #9829; for a heart)
+    name = match.group(1)
+    text = html.unescape(("&#" if name.isdigit() else "&") + name + ";")
+    return match.group(0) if text.startswith("&") and len(text) > 1 else text
+
+
+def label_lines(text: str) -> List[str]:
+    """Lines of a node or link label as displayed: line breaks kept, tags dropped, wrapped"""
+    text = _RE_BREAK.sub("\n", text)
+    text = _RE_TAG.sub("", text)
+    text = _RE_ENTITY.sub(_entity, text)
+    ls_lines = []
+    for line in text.split("\n"):
+        ls_lines.extend(textwrap.wrap(line.strip(), MAX_LABEL_CHARS) or [""])
+    while len(ls_lines) > 1 and ls_lines[-1] == "":
+        ls_lines.pop()
+    return ls_lines
+
+
+def text_size(ls_lines: List[str]) -> Tuple[float, float]:
+    return max(len(line) for line in ls_lines) * CHAR_WIDTH, len(ls_lines) * LINE_HEIGHT
+
+
+def node_size(shape: Optional[str], ls_lines: List[str]) -> Tuple[float, float]:
+    """Width and height of a node, from its label and shape"""
+    width, height = text_size(ls_lines)
+    width += 2 * NODE_PADDING[0]
+    height += 2 * NODE_PADDING[1]
+    if shape in ("circle", "double_circle"):
+        diameter = max(width, height) + (10 if shape == "double_circle" else 0)
+        return diameter, diameter
+    if shape == "rhombus":
+        return width + height, height + width / 3
+    if shape in ("hexagon", "parallelogram", "parallelogram_alt", "trapezoid", "trapezoid_alt"):
+        return width + height, height
+    if shape == "asymmetric":
+        return width + height / 2, height
+    if shape == "cylinder":
+        return width, height + 16
+    return width, height
+
+
+def parse_styles(styles: Optional[str]) -> Dict[str, str]:
+    """Style properties of a classDef / style / linkStyle statement, as a dictionary"""
+    dc_styles = {}
+    if not styles:
+        return dc_styles
+    # commas inside parentheses (e.g. rgb(...)) do not split
+    for prop in re.split(r",(?![^(]*\))", styles):
+        name, _, value = prop.partition(":")
+        name = name.strip().lower()
+        value = value.strip().rstrip(";")
+        if name and value and re.search(r"[<>\"';]", value) is None:
+            dc_styles[name] = value
+    return dc_styles
+
+
+def _style_attribute(dc_styles: Dict[str, str], dc_names) -> str:
+    ls_properties = [
+        (dc_names[name] if isinstance(dc_names, dict) else name) + ":" + value
+        for name, value in dc_styles.items() if name in dc_names
+    ]
+    return ' style="' + html.escape(";".join(ls_properties)) + '"' if ls_properties else ""
+
+
+#----------------------------------------------------------- layout
+
+
+def _subgraph_chain(graph: mermaid.Graph, index: Optional[int]) -> Tuple[int, ...]:
+    ls_chain = []
+    while index is not None:
+        ls_chain.append(index)
+        index = graph.subgraphs[index].parent
+    return tuple(reversed(ls_chain))
+
+
+def _break_cycles(ls_ids: List[str], dc_successors: Dict[str, List[str]]) -> set:
+    # (source, target) pairs of the back links found by an iterative depth-first search
+    back_edges = set()
+    state = {}  # node id -> 1 while on the stack, 2 once done
+    for root in ls_ids:
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(dc_successors[root]))]
+        while stack:
+            node_id, children = stack[-1]
+            for child in children:
+                if state.get(child) == 1:
+                    back_edges.add((node_id, child))
+                elif child not in state:
+                    state[child] = 1
+                    stack.append((child, iter(dc_successors[child])))
+                    break
+            else:
+                state[node_id] = 2
+                stack.pop()
+    return back_edges
+
+
+def _rank(ls_ids: List[str], ls_links: List[Tuple[str, str]]) -> Dict[str, int]:
+    # longest path ranking of an acyclic graph, in topological order (Kahn)
+    dc_successors = {node_id: [] for node_id in ls_ids}
+    dc_in_degree = {node_id: 0 for node_id in ls_ids}
+    for source, target in ls_links:
+        dc_successors[source].append(target)
+        dc_in_degree[target] += 1
+    dc_rank = {node_id: 0 for node_id in ls_ids}
+    ls_ready = [node_id for node_id in ls_ids if dc_in_degree[node_id] == 0]
+    while ls_ready:
+        node_id = ls_ready.pop()
+        for target in dc_successors[node_id]:
+            dc_rank[target] = max(dc_rank[target], dc_rank[node_id] + 1)
+            dc_in_degree[target] -= 1
+            if dc_in_degree[target] == 0:
+                ls_ready.append(target)
+    return dc_rank
+
+
+def _order_group(ls_boxes: List[_Box], dc_barycenter: Dict[str, float], depth: int = 0) -> List[_Box]:
+    # sort the boxes of a rank by barycenter, keeping the members of each subgraph together
+    dc_groups = {}
+    for box in ls_boxes:
+        group = box.chain[depth] if len(box.chain) > depth else ("node", box.id)
+        dc_groups.setdefault(group, []).append(box)
+    ls_groups = sorted(
+        dc_groups.items(),
+        key=lambda item: sum(dc_barycenter[box.id] for box in item[1]) / len(item[1])
+    )
+    ls_ordered = []
+    for group, ls_members in ls_groups:
+        if isinstance(group, tuple):
+            ls_ordered.extend(ls_members)
+        else:
+            ls_ordered.extend(_order_group(ls_members, dc_barycenter, depth + 1))
+    return ls_ordered
+
+
+def _separation(first: _Box, second: _Box, horizontal: bool) -> float:
+    # minimum distance between the centers of two neighbours of a rank
+    extent = (first.width + second.width) / 2 if horizontal else (first.height + second.height) / 2
+    # room for the boxes of the subgraphs that one of them is in and the other is not
+    common = 0
+    while common < min(len(first.chain), len(second.chain)) and first.chain[common] == second.chain[common]:
+        common += 1
+    boundaries = len(first.chain) + len(second.chain) - 2 * common
+    # ranks in columns: the titles of the subgraphs are in the way too
+    return extent + NODE_GAP + boundaries * (SUBGRAPH_PADDING + (0 if horizontal else SUBGRAPH_TITLE_HEIGHT))
+
+
+def _place_rank(ls_boxes: List[_Box], ls_desired: List[float], horizontal: bool) -> List[float]:
+    # positions as close as possible to the desired ones, in order and separated: the average
+    # of a forward packing and a backward packing keeps the separation of both
+    ls_forward = list(ls_desired)
+    for i in range(1, len(ls_boxes)):
+        ls_forward[i] = max(ls_desired[i], ls_forward[i - 1] + _separation(ls_boxes[i - 1], ls_boxes[i], horizontal))
+    ls_backward = list(ls_desired)
+    for i in range(len(ls_boxes) - 2, -1, -1):
+        ls_backward[i] = min(ls_desired[i], ls_backward[i + 1] - _separation(ls_boxes[i], ls_boxes[i + 1], horizontal))
+    return [(forward + backward) / 2 for forward, backward in zip(ls_forward, ls_backward)]
+
+
+def layout(graph: mermaid.Graph):
+    """Lay out a parsed graph
+
+    Returns
+    -------
+    The node boxes by id, the list of points of each edge (None for edges that are not
+    drawn, i.e. self links), and the width and height of the drawing.
+    """
+    direction = graph.direction or "TB"
+    horizontal = direction in ("TB", "TD", "BT")  # ranks are rows, ordered horizontally
+
+    dc_boxes = {}
+    for node in graph.nodes.values():
+        ls_lines = label_lines(node.label if node.label is not None else node.id)
+        width, height = node_size(node.shape, ls_lines)
+        dc_boxes[node.id] = _Box(node.id, width, height, ls_lines, node.shape, _subgraph_chain(graph, node.subgraph))
+    ls_ids = list(dc_boxes)
+
+    # rank the nodes, with the back links of cycles reversed
+    dc_successors = {node_id: [] for node_id in ls_ids}
+    for edge in graph.edges:
+        if edge.source != edge.target:
+            dc_successors[edge.source].append(edge.target)
+    back_edges = _break_cycles(ls_ids, dc_successors)
+    ls_links = []
+    for edge in graph.edges:
+        if edge.source == edge.target:
+            continue
+        reverse = (edge.source, edge.target) in back_edges
+        ls_links.append((edge.target, edge.source) if reverse else (edge.source, edge.target))
+    dc_rank = _rank(ls_ids, ls_links)
+
+    # long links go through one dummy point per rank they cross
+    ls_ranks = [[] for _ in range(max(dc_rank.values(), default=0) + 1)]
+    for node_id in ls_ids:
+        ls_ranks[dc_rank[node_id]].append(dc_boxes[node_id])
+    ls_paths = []  # ids of the boxes of each edge, None for self links
+    dc_up = {box_id: [] for box_id in ls_ids}  # neighbours in the previous rank
+    dc_down = {box_id: [] for box_id in ls_ids}  # neighbours in the next rank
+    for i, edge in enumerate(graph.edges):
+        if edge.source == edge.target:
+            ls_paths.append(None)
+            continue
+        reverse = (edge.source, edge.target) in back_edges
+        source, target = (edge.target, edge.source) if reverse else (edge.source, edge.target)
+        ls_path = [source]
+        for rank in range(dc_rank[source] + 1, dc_rank[target]):
+            dummy = _Box(f"\0{i}:{rank}", DUMMY_SIZE, DUMMY_SIZE, chain=_common_chain(dc_boxes[source], dc_boxes[target]))
+            dc_boxes[dummy.id] = dummy
+            dc_up[dummy.id] = []
+            dc_down[dummy.id] = []
+            ls_ranks[rank].append(dummy)
+            ls_path.append(dummy.id)
+        ls_path.append(target)
+        for upper, lower in zip(ls_path, ls_path[1:]):
+            dc_down[upper].append(lower)
+            dc_up[lower].append(upper)
+        ls_paths.append(list(reversed(ls_path)) if reverse else ls_path)
+
+    # order each rank by the barycenter of its neighbours, sweeping down then up
+    dc_position = {}
+    for rank in ls_ranks:
+        for position, box in enumerate(rank):
+            dc_position[box.id] = position
+    for sweep in range(ORDERING_SWEEPS):
+        downwards = sweep % 2 == 0
+        ls_sweep = range(1, len(ls_ranks)) if downwards else range(len(ls_ranks) - 2, -1, -1)
+        dc_neighbours = dc_up if downwards else dc_down
+        for r in ls_sweep:
+            dc_barycenter = {}
+            for box in ls_ranks[r]:
+                ls_neighbours = dc_neighbours[box.id]
+                dc_barycenter[box.id] = (
+                    sum(dc_position[n] for n in ls_neighbours) / len(ls_neighbours)
+                    if ls_neighbours else dc_position[box.id]
+                )
+            ls_ranks[r] = _order_group(ls_ranks[r], dc_barycenter)
+            for position, box in enumerate(ls_ranks[r]):
+                dc_position[box.id] = position
+
+    # positions within the ranks: packed, then relaxed towards the neighbours
+    dc_coordinate = {}
+    for rank in ls_ranks:
+        for box, coordinate in zip(rank, _place_rank(rank, [0.0] * len(rank), horizontal)):
+            dc_coordinate[box.id] = coordinate
+    for sweep in range(POSITIONING_SWEEPS):
+        downwards = sweep % 2 == 0
+        ls_sweep = range(1, len(ls_ranks)) if downwards else range(len(ls_ranks) - 2, -1, -1)
+        dc_neighbours = dc_up if downwards else dc_down
+        for r in ls_sweep:
+            ls_desired = []
+            for box in ls_ranks[r]:
+                ls_neighbours = dc_neighbours[box.id]
+                ls_desired.append(
+                    sum(dc_coordinate[n] for n in ls_neighbours) / len(ls_neighbours)
+                    if ls_neighbours else dc_coordinate[box.id]
+                )
+            for box, coordinate in zip(ls_ranks[r], _place_rank(ls_ranks[r], ls_desired, horizontal)):
+                dc_coordinate[box.id] = coordinate
+
+    # positions of the ranks, with room for the titles of the subgraphs
+    ls_rank_coordinates = []
+    current = 0.0
+    for rank in ls_ranks:
+        extent = max((box.height if horizontal else box.width for box in rank), default=0)
+        ls_rank_coordinates.append(current + extent / 2)
+        current += extent + RANK_GAP
+    for r, rank in enumerate(ls_ranks):
+        for box in rank:
+            if horizontal:
+                box.x, box.y = dc_coordinate[box.id], ls_rank_coordinates[r]
+            else:
+                box.x, box.y = ls_rank_coordinates[r], dc_coordinate[box.id]
+
+    # reversed directions, then translation to the margins
+    if direction in ("BT", "RL"):
+        for box in dc_boxes.values():
+            if direction == "BT":
+                box.y = -box.y
+            else:
+                box.x = -box.x
+    ls_clusters = cluster_boxes(graph, dc_boxes)
+    min_x = min([box.x - box.width / 2 for box in dc_boxes.values()] + [c[0] for c in ls_clusters if c], default=0)
+    min_y = min([box.y - box.height / 2 for box in dc_boxes.values()] + [c[1] for c in ls_clusters if c], default=0)
+    for box in dc_boxes.values():
+        box.x += MARGIN - min_x
+        box.y += MARGIN - min_y
+    max_x = max([box.x + box.width / 2 for box in dc_boxes.values()], default=0)
+    max_y = max([box.y + box.height / 2 for box in dc_boxes.values()], default=0)
+    for c in ls_clusters:
+        if c:
+            max_x = max(max_x, c[2] + MARGIN - min_x)
+            max_y = max(max_y, c[3] + MARGIN - min_y)
+
+    ls_edge_points = []
+    for ls_path in ls_paths:
+        if ls_path is None:
+            ls_edge_points.append(None)
+            continue
+        ls_points = [(dc_boxes[box_id].x, dc_boxes[box_id].y) for box_id in ls_path]
+        ls_points[0] = _clip(dc_boxes[ls_path[0]], ls_points[1])
+        ls_points[-1] = _clip(dc_boxes[ls_path[-1]], ls_points[-2])
+        ls_edge_points.append(ls_points)
+    return dc_boxes, ls_edge_points, max_x + MARGIN, max_y + MARGIN
+
+
+def _common_chain(first: _Box, second: _Box) -> Tuple[int, ...]:
+    common = 0
+    while common < min(len(first.chain), len(second.chain)) and first.chain[common] == second.chain[common]:
+        common += 1
+    return first.chain[:common]
+
+
+def cluster_boxes(graph: mermaid.Graph, dc_boxes: Dict[str, _Box]) -> List[Optional[Tuple[float, float, float, float]]]:
+    """Bounding box (x0, y0, x1, y1) of each subgraph around its members, None if empty"""
+    ls_clusters = [None] * len(graph.subgraphs)
+    for i in range(len(graph.subgraphs) - 1, -1, -1):  # children are after their parents
+        subgraph = graph.subgraphs[i]
+        ls_extents = [
+            (box.x - box.width / 2, box.y - box.height / 2, box.x + box.width / 2, box.y + box.height / 2)
+            for box in (dc_boxes[node_id] for node_id in subgraph.nodes)
+        ]
+        ls_extents += [ls_clusters[child] for child in subgraph.children if ls_clusters[child] is not None]
+        if len(ls_extents) == 0:
+            continue
+        ls_clusters[i] = (
+            min(extent[0] for extent in ls_extents) - SUBGRAPH_PADDING,
+            min(extent[1] for extent in ls_extents) - SUBGRAPH_PADDING - SUBGRAPH_TITLE_HEIGHT,
+            max(extent[2] for extent in ls_extents) + SUBGRAPH_PADDING,
+            max(extent[3] for extent in ls_extents) + SUBGRAPH_PADDING,
+        )
+    return ls_clusters
+
+
+def _clip(box: _Box, toward: Tuple[float, float]) -> Tuple[float, float]:
+    # point where the segment from the center of a box toward a point leaves the box
+    dx, dy = toward[0] - box.x, toward[1] - box.y
+    if dx == 0 and dy == 0:
+        return box.x, box.y
+    half_width, half_height = box.width / 2, box.height / 2
+    if box.shape in ("circle", "double_circle"):
+        scale = half_width / math.hypot(dx, dy)
+    elif box.shape == "rhombus":
+        scale = 1 / (abs(dx) / half_width + abs(dy) / half_height)
+    else:
+        scale = min(half_width / abs(dx) if dx else math.inf, half_height / abs(dy) if dy else math.inf)
+    scale = min(scale, 1.0)
+    return box.x + dx * scale, box.y + dy * scale
+
+
+#----------------------------------------------------------- drawing
+
+
+def _fmt(value: float) -> str:
+    return str(round(value, 1)).rstrip("0").rstrip(".") if value % 1 else str(int(value))
+
+
+def _points(ls_points) -> str:
+    return " ".join(_fmt(x) + "," + _fmt(y) for x, y in ls_points)
+
+
+def _text(ls_lines: List[str], x: float, y: float, color: str, extra_style: str = "") -> str:
+    # lines centered on (x, y)
+    top = y - (len(ls_lines) - 1) * LINE_HEIGHT / 2
+    ls_spans = [
+        f'<tspan x="{_fmt(x)}" y="{_fmt(top + i * LINE_HEIGHT)}">{html.escape(line)}</tspan>'
+        for i, line in enumerate(ls_lines)
+    ]
+    style = extra_style or f' fill="{color}"'
+    return f'<text text-anchor="middle" dominant-baseline="central"{style}>' + "".join(ls_spans) + "</text>"
+
+
+def _shape(box: _Box, style: str) -> str:
+    x, y, w, h = box.x, box.y, box.width, box.height
+    left, top, right, bottom = x - w / 2, y - h / 2, x + w / 2, y + h / 2
+    shape = box.shape or "rectangle"
+    if shape in ("circle", "double_circle"):
+        svg = f'<circle cx="{_fmt(x)}" cy="{_fmt(y)}" r="{_fmt(w / 2)}"{style}/>'
+        if shape == "double_circle":
+            svg += f'<circle cx="{_fmt(x)}" cy="{_fmt(y)}" r="{_fmt(w / 2 - 5)}"{style}/>'
+        return svg
+    if shape == "rhombus":
+        return f'<polygon points="{_points([(x, top), (right, y), (x, bottom), (left, y)])}"{style}/>'
+    if shape == "hexagon":
+        inset = h / 2
+        ls_points = [(left + inset, top), (right - inset, top), (right, y), (right - inset, bottom), (left + inset, bottom), (left, y)]
+        return f'<polygon points="{_points(ls_points)}"{style}/>'
+    if shape in ("parallelogram", "parallelogram_alt", "trapezoid", "trapezoid_alt"):
+        inset = h / 2
+        dc_points = {
+            "parallelogram": [(left + inset, top), (right, top), (right - inset, bottom), (left, bottom)],
+            "parallelogram_alt": [(left, top), (right - inset, top), (right, bottom), (left + inset, bottom)],
+            "trapezoid": [(left + inset, top), (right - inset, top), (right, bottom), (left, bottom)],
+            "trapezoid_alt": [(left, top), (right, top), (right - inset, bottom), (left + inset, bottom)],
+        }
+        return f'<polygon points="{_points(dc_points[shape])}"{style}/>'
+    if shape == "asymmetric":
+        ls_points = [(left, top), (right, top), (right, bottom), (left, bottom), (left + h / 2, y)]
+        return f'<polygon points="{_points(ls_points)}"{style}/>'
+    if shape == "cylinder":
+        ry = 8
+        path = (
+            f"M{_fmt(left)},{_fmt(top + ry)} a{_fmt(w / 2)},{ry} 0 0,0 {_fmt(w)},0 "
+            f"a{_fmt(w / 2)},{ry} 0 0,0 {_fmt(-w)},0 l0,{_fmt(h - 2 * ry)} "
+            f"a{_fmt(w / 2)},{ry} 0 0,0 {_fmt(w)},0 l0,{_fmt(-(h - 2 * ry))}"
+        )
+        return f'<path d="{path}"{style}/>'
+    rx = {"round": 5, "stadium": h / 2}.get(shape, 0)
+    svg = f'<rect x="{_fmt(left)}" y="{_fmt(top)}" width="{_fmt(w)}" height="{_fmt(h)}" rx="{_fmt(rx)}"{style}/>'
+    if shape == "subroutine":
+        svg += f'<path d="M{_fmt(left + 8)},{_fmt(top)} v{_fmt(h)} M{_fmt(right - 8)},{_fmt(top)} v{_fmt(h)}"{style}/>'
+    return svg
+
+
+def _markers(colors: dict) -> str:
+    color = colors["edge"]
+    return (
+        "<defs>"
+        f'<marker id="arrow" viewBox="0 0 10 10" refX="9" refY="5" markerWidth="8" markerHeight="8" orient="auto-start-reverse">'
+        f'<path d="M0,0 L10,5 L0,10 z" fill="{color}"/></marker>'
+        f'<marker id="circle" viewBox="0 0 10 10" refX="5" refY="5" markerWidth="8" markerHeight="8" orient="auto">'
+        f'<circle cx="5" cy="5" r="4" fill="{color}"/></marker>'
+        f'<marker id="cross" viewBox="0 0 10 10" refX="5" refY="5" markerWidth="8" markerHeight="8" orient="auto">'
+        f'<path d="M1,1 L9,9 M9,1 L1,9" stroke="{color}" stroke-width="2"/></marker>'
+        "</defs>"
+    )
+
+
+def _link_styles(graph: mermaid.Graph) -> List[Dict[str, str]]:
+    ls_styles = [{} for _ in graph.edges]
+    for indices, styles in graph.link_styles:
+        dc_styles = parse_styles(styles)
+        ls_indices = range(len(graph.edges)) if indices == "default" else [int(i) for i in indices.split(",")]
+        for i in ls_indices:
+            if 0 <= i < len(ls_styles):
+                ls_styles[i].update(dc_styles)
+    return ls_styles
+
+
+def _midpoint(ls_points: List[Tuple[float, float]]) -> Tuple[float, float]:
+    # point halfway along a polyline
+    ls_lengths = [math.hypot(b[0] - a[0], b[1] - a[1]) for a, b in zip(ls_points, ls_points[1:])]
+    remaining = sum(ls_lengths) / 2
+    for (a, b), length in zip(zip(ls_points, ls_points[1:]), ls_lengths):
+        if remaining <= length and length > 0:
+            ratio = remaining / length
+            return a[0] + (b[0] - a[0]) * ratio, a[1] + (b[1] - a[1]) * ratio
+        remaining -= length
+    return ls_points[-1]
+
+
+def render_svg(graph: Union[str, mermaid.Graph], theme: str = "default") -> str:
+    """Render a Mermaid flowchart to SVG, in process
+
+    Parameters
+    ----------
+    graph :
+        Mermaid code, or a parsed Graph (see mermaid.parse()).
+    theme :
+        "default", "neutral", "dark" or "forest". Unknown themes fall back to "default".
+
+    Returns
+    -------
+    The SVG document. Raises ValueError if the graph is not valid.
+    """
+    parsed = mermaid.parse(graph) if isinstance(graph, str) else graph
+    if not parsed.is_valid():
+        raise ValueError("Cannot render an invalid graph: " + "; ".join(str(error) for error in parsed.errors))
+    colors = THEMES.get(theme, THEMES["default"])
+    dc_boxes, ls_edge_points, width, height = layout(parsed)
+
+    ls_svg = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{_fmt(width)}" height="{_fmt(height)}" '
+        f'viewBox="0 0 {_fmt(width)} {_fmt(height)}" font-family="{FONT_FAMILY}" font-size="{FONT_SIZE}">',
+        _markers(colors),
+        f'<rect width="100%" height="100%" fill="{colors["background"]}"/>',
+    ]
+
+    for i, cluster in enumerate(cluster_boxes(parsed, dc_boxes)):
+        if cluster is None:
+            continue
+        subgraph = parsed.subgraphs[i]
+        dc_styles = {"fill": colors["cluster_fill"], "stroke": colors["cluster_stroke"]}
+        dc_styles.update(parse_styles(parsed.styles.get(subgraph.id)) if subgraph.id else {})
+        x0, y0, x1, y1 = cluster
+        ls_svg.append(
+            f'<rect x="{_fmt(x0)}" y="{_fmt(y0)}" width="{_fmt(x1 - x0)}" height="{_fmt(y1 - y0)}"'
+            + _style_attribute(dc_styles, SHAPE_PROPERTIES) + "/>"
+        )
+        ls_title = label_lines(subgraph.title or subgraph.id or "")[:1]
+        ls_svg.append(_text(ls_title, (x0 + x1) / 2, y0 + SUBGRAPH_TITLE_HEIGHT / 2 + 2, colors["text"]))
+
+    ls_labels = []  # drawn after all the links, so that links do not cross them
+    for edge, ls_points, dc_link_style in zip(parsed.edges, ls_edge_points, _link_styles(parsed)):
+        if ls_points is None or edge.arrow.startswith("~"):
+            continue  # self links, and invisible links
+        dc_styles = {"stroke": colors["edge"], "stroke-width": "1.5", "fill": "none"}
+        if edge.arrow.lstrip("<xo").startswith("="):
+            dc_styles["stroke-width"] = "3"
+        elif "." in edge.arrow:
+            dc_styles["stroke-dasharray"] = "3"
+        dc_styles.update(dc_link_style)
+        dc_styles["fill"] = "none"
+        markers = ""
+        dc_marker = {">": "arrow", "o": "circle", "x": "cross", "<": "arrow"}
+        if edge.arrow[-1] in ">ox":
+            markers += f' marker-end="url(#{dc_marker[edge.arrow[-1]]})"'
+        if edge.arrow[0] in "<ox":
+            markers += f' marker-start="url(#{dc_marker[edge.arrow[0]]})"'
+        ls_svg.append(f'<polyline points="{_points(ls_points)}"' + _style_attribute(dc_styles, SHAPE_PROPERTIES) + markers + "/>")
+        if edge.text:
+            ls_lines = label_lines(edge.text)
+            text_width, text_height = text_size(ls_lines)
+            x, y = _midpoint(ls_points)
+            ls_labels.append(
+                f'<rect x="{_fmt(x - text_width / 2 - 2)}" y="{_fmt(y - text_height / 2)}" '
+                f'width="{_fmt(text_width + 4)}" height="{_fmt(text_height)}" fill="{colors["label_background"]}"/>'
+                + _text(ls_lines, x, y, colors["text"])
+            )
+    ls_svg.extend(ls_labels)
+
+    for node_id in parsed.nodes:
+        box = dc_boxes[node_id]
+        dc_styles = {"fill": colors["fill"], "stroke": colors["stroke"], "stroke-width": "1"}
+        class_name = parsed.classes.get(node_id)
+        if class_name is not None:
+            dc_styles.update(parse_styles(parsed.class_defs.get(class_name)))
+        dc_styles.update(parse_styles(parsed.styles.get(node_id)))
+        ls_svg.append(_shape(box, _style_attribute(dc_styles, SHAPE_PROPERTIES)))
+        dc_text_styles = {"color": colors["text"], **{k: v for k, v in dc_styles.items() if k in TEXT_PROPERTIES}}
+        ls_svg.append(_text(box.lines, box.x, box.y, colors["text"], _style_attribute(dc_text_styles, TEXT_PROPERTIES)))
+
+    ls_svg.append("</svg>")
+    return "\n".join(ls_svg)
+
+
+#----------------------------------------------------------- rendered artifact cache
+
+
+def get_svg_cache() -> cache.DiskCache:
+    """Return the process-wide cache of rendered SVGs"""
+    global _svg_cache
+    if _svg_cache is None:
+        _svg_cache = cache.DiskCache("rendered_svg", max_size_bytes=100 * 1024 * 1024)
+    return _svg_cache
+
+
+def get_svg(graph: str, theme: str = "default", svg_cache: Optional[cache.DiskCache] = None) -> bytes:
+    """Return the SVG of a graph with a theme, rendered once and then read from the cache
+
+    The bytes are the same for display, download and batch export. Raises ValueError if
+    the graph is not valid.
+    """
+    svg_cache = svg_cache or get_svg_cache()
+    key = cache.hash_key("svg", RENDERER_VERSION, theme, graph)
+    entry = svg_cache.get(key)
+    if entry is not None:
+        return entry.value
+    svg = render_svg(graph, theme).encode("utf8")
+    svg_cache.put(key, svg, metadata={"theme": theme, "renderer": RENDERER_VERSION})
+    return svg
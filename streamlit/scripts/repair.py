@@ -0,0 +1,300 @@
+"""Repair of Mermaid diagrams that fail validation, cheaper than regenerating them from scratch
+
+fix_locally() deterministically fixes the common mistakes without calling a model, and
+fix_with_llm() is the last resort for the errors it can not fix.
+"""
+# Python Built-Ins:
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Local Dependencies:
+import llm
+import mermaid
+
+
+# closing bracket matched against the opening one, when looking for the end of a label
+_BRACKET_PAIRS = {"[": "]", "(": ")", "{": "}"}
+_RE_ID = re.compile(r"[A-Za-z0-9_](?:\w|-(?=\w))*")
+_RE_FENCE = re.compile(r"^\s*```")
+_RE_HEADER = re.compile(r"^\s*(graph|flowchart)\b")
+_RE_STYLE_STATEMENT = re.compile(r"^(classDef\s+[\w,\s-]+?|style\s+[\w-]+|linkStyle\s+[\w,\s]+?)\s+(\S.*)$")
+_RE_SUBGRAPH_ID_TITLE = re.compile(r"^([A-Za-z0-9_][\w-]*)\s*\[(.*)\]$")
+# links, as in mermaid.py: without text (e.g. -->), or with text between an opener and an arrow
+_RE_LINK = re.compile(r"(?:-{2,}[->xo]|={2,}[=>xo]|-?\.+-[>xo]?|~{3,})")
+_RE_LINK_START = re.compile(r"--|==|-\.")
+_RE_LINK_END = {
+    "--": re.compile(r"\s*(?:-{2,}[>xo]|-{3,})"),
+    "==": re.compile(r"\s*(?:={2,}[>xo]|={3,})"),
+    "-.": re.compile(r"\s*(?:\.+-[>xo]?)"),
+}
+
+PROMPT_FIX_DIAGRAM = """
+Here is a Mermaid diagram that does not compile:
+
+<diagram>
+{diagram}
+</diagram>
+
+Here are the syntax errors found in it:
+
+<errors>
+{errors}
+</errors>
+
+Fix the syntax errors without changing the content or the structure of the diagram.
+Include the corrected Mermaid code inside <mermaid></mermaid> XML tags and don't write anything after the </mermaid> tag.
+"""
+
+
+def fix_with_llm(
+    bedrock_runtime,
+    model_id: str,
+    graph: str,
+    ls_errors: List[mermaid.MermaidError],
+    response_cache=None,
+):
+    """Ask a model to fix the syntax errors of a diagram, given only the diagram and the errors
+
+    The prompt does not include the source text, so the call is much shorter than a full
+    regeneration.
+
+    Returns
+    -------
+    A dictionary with the fixed "graph" (empty if none was returned), and the "text",
+    "usage" and "latency" of the response, as for llm.converse().
+    """
+    prompt = PROMPT_FIX_DIAGRAM.format(
+        diagram=graph,
+        errors="\n".join(str(error) for error in ls_errors)
+    )
+    dc_response = llm.converse(
+        bedrock_runtime,
+        model_id=model_id,
+        prompt=prompt,
+        temperature=0.1,  # be more factual
+        max_tokens=2048,
+        top_p=1,
+        response_cache=response_cache,
+    )
+    ls_graphs = re.findall(r"<mermaid>(.*?)</mermaid>", dc_response["text"], re.DOTALL)
+    return {**dc_response, "graph": ls_graphs[0] if len(ls_graphs) > 0 else ""}
+
+
+def _quote(text: str) -> str:
+    # wraps a label in double quotes, escaping the quotes it contains
+    return '"' + text.strip().replace('"', "#quot;") + '"'
+
+
+def _needs_quotes(text: str) -> bool:
+    stripped = text.strip()
+    if len(stripped) >= 2 and stripped[0] == stripped[-1] == '"' and '"' not in stripped[1:-1]:
+        return False
+    return any(char in mermaid.FORBIDDEN_LABEL_CHARS for char in stripped)
+
+
+def _find_closer(statement: str, pos: int, opener: str, closers) -> Optional[Tuple[int, str]]:
+    # returns (position, closer) of the closer of a label starting at pos, skipping over
+    # brackets of the same kind nested inside the label, e.g. A[list [x] of items]
+    opening = opener[0] if opener[0] in _BRACKET_PAIRS else None
+    depth = 0
+    in_quotes = False
+    while pos < len(statement):
+        char = statement[pos]
+        if char == '"':
+            in_quotes = not in_quotes
+        elif in_quotes is False:
+            if depth == 0:
+                for closer in closers:
+                    if statement.startswith(closer, pos):
+                        return pos, closer
+            if opening is not None and char == opening:
+                depth += 1
+            elif opening is not None and char == _BRACKET_PAIRS[opening] and depth > 0:
+                depth -= 1
+        pos += 1
+    return None
+
+
+def _fix_node_statement(statement: str, dc_shapes: Dict[str, str], ls_fixes: List[str]) -> str:
+    # quotes labels containing special characters, and removes the shape of a node id
+    # that was already defined with a different shape or label
+    ls_parts = []
+    pos = 0
+    while pos < len(statement):
+        char = statement[pos]
+
+        if char == "|":
+            # link text
+            end = statement.find("|", pos + 1)
+            if end == -1:
+                ls_parts.append(statement[pos:])
+                break
+            text = statement[pos + 1:end]
+            if _needs_quotes(text):
+                text = _quote(text)
+                ls_fixes.append("quoted link text " + text)
+            ls_parts.append("|" + text + "|")
+            pos = end + 1
+            continue
+
+        match = _RE_LINK.match(statement, pos)
+        if match is not None:
+            ls_parts.append(match.group(0))
+            pos = match.end()
+            continue
+
+        match = _RE_LINK_START.match(statement, pos)
+        if match is not None:
+            # link text, e.g. A -- text --> B, which is not a node id followed by a shape
+            end = _RE_LINK_END[match.group(0)].search(statement, match.end())
+            if end is None:
+                ls_parts.append(statement[pos:])
+                break
+            text = statement[match.end():end.start()]
+            if _needs_quotes(text):
+                text = " " + _quote(text)
+                ls_fixes.append("quoted link text" + text)
+            ls_parts.append(match.group(0) + text + end.group(0))
+            pos = end.end()
+            continue
+
+        match = _RE_ID.match(statement, pos)
+        if match is None or (pos > 0 and (statement[pos - 1].isalnum() or statement[pos - 1] == "_")):
+            ls_parts.append(char)
+            pos += 1
+            continue
+        node_id = match.group(0)
+        pos = match.end()
+        ls_parts.append(node_id)
+
+        shape_pos = pos
+        while shape_pos < len(statement) and statement[shape_pos] == " ":
+            shape_pos += 1
+        for opener, shapes in mermaid.SHAPES:
+            if not statement.startswith(opener, shape_pos):
+                continue
+            found = _find_closer(
+                statement, shape_pos + len(opener), opener, [closer for closer, _ in shapes]
+            )
+            if found is None:
+                break
+            end, closer = found
+            text = statement[shape_pos + len(opener):end]
+            if _needs_quotes(text):
+                text = _quote(text)
+                ls_fixes.append(f"quoted the label of node {node_id}")
+            shape = opener + text + closer
+            pos = end + len(closer)
+            if node_id in dc_shapes and dc_shapes[node_id] != shape:
+                ls_fixes.append(f"removed the conflicting redefinition of node {node_id}")
+            else:
+                dc_shapes[node_id] = shape
+                ls_parts.append(shape)
+            break
+    return "".join(ls_parts)
+
+
+def _fix_subgraph(statement: str, ls_fixes: List[str]) -> str:
+    rest = statement[len("subgraph"):].strip()
+    if rest == "" or rest == '""':
+        ls_fixes.append("gave a title to an untitled subgraph")
+        return 'subgraph " "'
+    match = _RE_SUBGRAPH_ID_TITLE.match(rest)
+    if match is not None:
+        if _needs_quotes(match.group(2)):
+            ls_fixes.append(f"quoted the title of subgraph {match.group(1)}")
+            return "subgraph " + match.group(1) + "[" + _quote(match.group(2)) + "]"
+        return statement
+    if _needs_quotes(rest):
+        ls_fixes.append("quoted the title of subgraph " + rest)
+        return "subgraph " + _quote(rest)
+    return statement
+
+
+def _fix_styles(statement: str, ls_fixes: List[str]) -> Optional[str]:
+    # repairs "property=value" and quoted values; returns None if the statement should be
+    # dropped (styles are cosmetic, losing one is better than losing the diagram)
+    match = _RE_STYLE_STATEMENT.match(statement)
+    if match is None:
+        ls_fixes.append("removed invalid style statement: " + statement)
+        return None
+    ls_properties = []
+    for prop in re.split(r",(?![^(]*\))", match.group(2).rstrip(",; ")):
+        prop = prop.strip()
+        if ":" not in prop and "=" in prop:
+            prop = prop.replace("=", ":", 1)
+        name, _, value = prop.partition(":")
+        ls_properties.append(name.strip() + ":" + value.strip().strip("'\""))
+    fixed = match.group(1) + " " + ",".join(ls_properties)
+    if len(mermaid.validate_graph("graph TD\n" + fixed)) > 0:
+        ls_fixes.append("removed invalid style statement: " + statement)
+        return None
+    if fixed != statement:
+        ls_fixes.append("fixed style statement: " + statement)
+    return fixed
+
+
+def fix_locally(graph: str):
+    """Deterministically fix the mistakes LLMs commonly make in Mermaid diagrams
+
+    No model is called. The following is fixed:
+    - markdown fences and any text before the graph header are removed
+    - labels, link texts and subgraph titles containing special characters are quoted
+    - a node id redefined with a different shape or label keeps its first definition
+    - unterminated subgraphs are closed, and unmatched "end" statements are removed
+    - "property=value" styles and quoted style values are rewritten, invalid style
+      statements are removed
+
+    Returns
+    -------
+    A dictionary with the fixed "graph", the list of "fixes" applied, and the remaining
+    "errors" (list of mermaid.MermaidError) found when validating the fixed graph.
+    """
+    ls_fixes = []
+    ls_lines = []
+    dc_shapes = {}  # node id -> shape of its first definition
+    open_subgraphs = 0
+    header_found = False
+
+    for line in graph.splitlines():
+        if _RE_FENCE.match(line):
+            ls_fixes.append("removed markdown fence")
+            continue
+        if header_found is False:
+            if _RE_HEADER.match(line):
+                header_found = True
+                ls_lines.append(line)
+            elif line.strip() != "":
+                ls_fixes.append("removed text before the graph header: " + line.strip())
+            continue
+        if line.strip() == "" or line.strip().startswith("%%"):
+            ls_lines.append(line)
+            continue
+
+        indent = line[:len(line) - len(line.lstrip())]
+        ls_statements = []
+        for _, statement in mermaid.split_statements(line):
+            keyword = statement.split(maxsplit=1)[0]
+            if keyword == "subgraph":
+                open_subgraphs += 1
+                statement = _fix_subgraph(statement, ls_fixes)
+            elif keyword == "end":
+                if open_subgraphs == 0:
+                    ls_fixes.append("removed 'end' without a matching subgraph")
+                    continue
+                open_subgraphs -= 1
+            elif keyword in ("classDef", "style", "linkStyle"):
+                statement = _fix_styles(statement, ls_fixes)
+            elif keyword not in ("direction", "class", "click", "accTitle", "accTitle:", "accDescr", "accDescr:"):
+                statement = _fix_node_statement(statement, dc_shapes, ls_fixes)
+            if statement is not None:
+                ls_statements.append(statement)
+        if len(ls_statements) > 0:
+            ls_lines.append(indent + "; ".join(ls_statements))
+
+    if open_subgraphs > 0:
+        ls_fixes.append(f"closed {open_subgraphs} unterminated subgraph(s)")
+        ls_lines.extend(["end"] * open_subgraphs)
+
+    fixed = "\n".join(ls_lines) if header_found else graph
+    return {"graph": fixed, "fixes": ls_fixes, "errors": mermaid.validate_graph(fixed)}
@@ -0,0 +1,161 @@
+"""Bounded retries with exponential backoff, a per-run budget and failure classification"""
+# Python Built-Ins:
+import random
+import socket
+import time
+from typing import Optional
+from urllib.error import URLError
+
+# External Dependencies:
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+
+# kinds of failures
+THROTTLING = "throttling"  # quota exceeded: wait (longer) and try again
+NETWORK = "network"  # transient transport or service failure: wait and try again
+INVALID = "invalid"  # the completion was received but is not usable: repair it, don't wait
+FATAL = "fatal"  # anything else (e.g. access denied, validation error): don't retry
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceQuotaExceededException",
+    "ModelNotReadyException",
+}
+TRANSIENT_ERROR_CODES = {
+    "InternalServerException",
+    "ServiceUnavailableException",
+    "ModelTimeoutException",
+    "ModelStreamErrorException",
+    "RequestTimeout",
+}
+
+
+def token_budget(calls: float, input_tokens: int, max_tokens: int) -> int:
+    """Token budget of a run worth `calls` full calls, each with `input_tokens` and the maximum output"""
+    return int(calls * (input_tokens + max_tokens))
+
+
+class RetryBudgetExceeded(Exception):
+    """Raised when a run has used all its attempts, time or tokens"""
+
+
+def classify_error(error: Exception) -> str:
+    """Return the kind of failure (THROTTLING, NETWORK or FATAL) of an exception"""
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code", "")
+        # errors in the middle of an event stream are named after their event, e.g. "throttlingException"
+        code = code[:1].upper() + code[1:]
+        if code in THROTTLING_ERROR_CODES:
+            return THROTTLING
+        if code in TRANSIENT_ERROR_CODES:
+            return NETWORK
+        return FATAL
+    if isinstance(error, (ConnectionError, HTTPClientError, URLError, socket.timeout, TimeoutError)):
+        return NETWORK
+    return FATAL
+
+
+class RetryPolicy:
+    """Limits and backoff shared by all the LLM calls of a run
+
+    Parameters
+    ----------
+    max_attempts :
+        Maximum number of attempts (LLM calls) of a run, including the first one.
+    base_delay, max_delay :
+        Exponential backoff parameters, in seconds. The n-th wait is drawn uniformly between
+        0 and min(max_delay, base_delay * 2**(n-1)) ("full jitter").
+    throttling_factor :
+        Multiplier of the backoff after a throttling error, so that quotas can recover.
+    time_budget :
+        Optional maximum duration of a run in seconds, after which no new attempt is made.
+    token_budget :
+        Optional maximum number of tokens (input + output) a run may use.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        throttling_factor: float = 3.0,
+        time_budget: Optional[float] = 300.0,
+        token_budget: Optional[int] = None,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttling_factor = throttling_factor
+        self.time_budget = time_budget
+        self.token_budget = token_budget
+
+    def backoff(self, retry_number: int, kind: str = NETWORK) -> float:
+        """Seconds to wait before the given retry (1 for the first retry)"""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (retry_number - 1))
+        if kind == THROTTLING:
+            ceiling = min(self.max_delay, ceiling * self.throttling_factor)
+        return random.uniform(0, ceiling)
+
+    def start(self) -> "RetryRun":
+        """Start a new run, with its own attempt counter and budget"""
+        return RetryRun(self)
+
+
+class RetryRun:
+    """Book-keeping of the attempts of one run (e.g. one diagram variant) under a RetryPolicy"""
+
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self.attempts = 0
+        self.tokens_used = 0
+        self.start_time = time.time()
+        self.ls_failures = []  # (attempt, kind, message)
+
+    def elapsed(self) -> float:
+        return time.time() - self.start_time
+
+    def exhausted(self) -> bool:
+        """True if no further attempt is allowed by the policy"""
+        policy = self.policy
+        if self.attempts >= policy.max_attempts:
+            return True
+        if policy.time_budget is not None and self.elapsed() >= policy.time_budget:
+            return True
+        if policy.token_budget is not None and self.tokens_used >= policy.token_budget:
+            return True
+        return False
+
+    def record_failure(self, kind: str, message: str):
+        self.ls_failures.append((self.attempts, kind, message))
+
+    def call(self, fn, *args, **kwargs):
+        """Call `fn` as one attempt, retrying throttling and network failures with backoff
+
+        The token usage of the result (a dictionary with a "usage" entry, as returned by
+        llm.converse) is counted against the token budget. Raises RetryBudgetExceeded if the
+        run is already exhausted, or the original exception if the failure is fatal or the
+        run gets exhausted while retrying.
+        """
+        retry_number = 0
+        while True:
+            if self.exhausted():
+                raise RetryBudgetExceeded(
+                    f"Gave up after {self.attempts} attempts and {round(self.elapsed(), 1)} sec"
+                )
+            self.attempts += 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                self.record_failure(kind, str(e))
+                if kind == FATAL or self.exhausted():
+                    raise
+                retry_number += 1
+                time.sleep(self.policy.backoff(retry_number, kind))
+                continue
+
+            if isinstance(result, dict):
+                usage = result.get("usage") or {}
+                self.tokens_used += usage.get("inputTokens", 0) + usage.get("outputTokens", 0)
+            return result
@@ -0,0 +1,182 @@
+"""Cheap local quality scores of Mermaid diagrams, computed without calling a model
+
+Two scores are combined:
+- a structural score, from the parsed diagram (size, subgraphs, shape and style diversity,
+  labeled links, isolated nodes, depth)
+- a term overlap score between the labels of the diagram and the source text, computed for
+  all the candidates at once with NumPy
+"""
+# Python Built-Ins:
+import re
+from collections import Counter
+from typing import Dict, List, Set, Union
+
+# External Dependencies:
+import numpy as np
+
+# Local Dependencies:
+import mermaid
+
+
+_RE_WORD = re.compile(r"[a-z0-9]{3,}")
+STOPWORDS = {
+    "the", "and", "for", "are", "but", "not", "you", "all", "any", "can", "had", "her", "was",
+    "one", "our", "out", "has", "him", "his", "how", "its", "may", "new", "now", "own", "she",
+    "too", "use", "who", "why", "yes", "with", "this", "that", "from", "they", "have", "been",
+    "were", "what", "when", "which", "will", "into", "than", "then", "them", "their", "there",
+    "these", "those", "such", "also", "each", "more", "most", "other", "some", "only", "over",
+}
+
+# nodes and links of a diagram that is neither too simplistic nor too complicated
+TARGET_NODES = (8, 25)
+TARGET_LINKS = (8, 35)
+TARGET_DEPTH = (3, 8)
+TOP_TEXT_TERMS = 50  # number of most frequent terms of the text a diagram should cover
+
+# weights of the features in the structural score (they sum to 1)
+WEIGHTS = {
+    "size": 0.25,
+    "subgraphs": 0.1,
+    "shapes": 0.1,
+    "styles": 0.1,
+    "labeled_links": 0.15,
+    "connected": 0.15,
+    "depth": 0.15,
+}
+OVERLAP_WEIGHT = 0.5  # weight of the term overlap in the final score, vs the structure
+
+
+def terms(text: str) -> List[str]:
+    """Lower-case words of at least 3 characters of a text, without stop words"""
+    return [word for word in _RE_WORD.findall(text.lower()) if word not in STOPWORDS]
+
+
+def label_terms(graph: mermaid.Graph) -> Set[str]:
+    """Terms of the node labels, link texts and subgraph titles of a parsed diagram"""
+    ls_texts = [node.label or node.id for node in graph.nodes.values()]
+    ls_texts += [edge.text for edge in graph.edges if edge.text]
+    ls_texts += [subgraph.title for subgraph in graph.subgraphs]
+    return set(terms(" ".join(ls_texts)))
+
+
+def _band(value: float, low: float, high: float) -> float:
+    # 1 inside [low, high], decreasing linearly to 0 at 0 and at 2 * high
+    if value < low:
+        return value / low
+    if value > high:
+        return max(0.0, 1 - (value - high) / high)
+    return 1.0
+
+
+def depth(graph: mermaid.Graph) -> int:
+    """Number of levels of the longest chain of links (cycles are not followed)"""
+    dc_children = {node_id: [] for node_id in graph.nodes}
+    for edge in graph.edges:
+        dc_children.setdefault(edge.source, []).append(edge.target)
+    dc_depth = {}
+
+    def visit(node_id, ls_path):
+        if node_id in dc_depth:
+            return dc_depth[node_id]
+        ls_path.add(node_id)
+        longest = 0
+        for child in dc_children.get(node_id, []):
+            if child not in ls_path:
+                longest = max(longest, visit(child, ls_path))
+        ls_path.discard(node_id)
+        dc_depth[node_id] = longest + 1
+        return longest + 1
+
+    return max((visit(node_id, set()) for node_id in dc_children), default=0)
+
+
+def structural_features(graph: mermaid.Graph) -> Dict[str, float]:
+    """Raw structural features of a parsed diagram (see mermaid.parse())"""
+    ls_nodes = list(graph.nodes.values())
+    ls_edges = graph.edges
+    connected = {edge.source for edge in ls_edges} | {edge.target for edge in ls_edges}
+    return {
+        "nodes": len(ls_nodes),
+        "links": len(ls_edges),
+        "subgraphs": len(graph.subgraphs),
+        "shapes": len({node.shape or "rectangle" for node in ls_nodes}),
+        "styles": len(graph.class_defs) + len(graph.styles) + len(graph.link_styles),
+        "labeled_links": sum(1 for edge in ls_edges if edge.text) / len(ls_edges) if ls_edges else 0.0,
+        "isolated_nodes": sum(1 for node in ls_nodes if node.id not in connected),
+        "depth": depth(graph),
+    }
+
+
+def structural_score(dc_features: Dict[str, float]) -> float:
+    """Score between 0 and 1 of the structural features of a diagram"""
+    nodes = dc_features["nodes"]
+    dc_components = {
+        "size": (_band(nodes, *TARGET_NODES) + _band(dc_features["links"], *TARGET_LINKS)) / 2,
+        "subgraphs": min(dc_features["subgraphs"], 2) / 2,
+        "shapes": min(dc_features["shapes"], 4) / 4,
+        "styles": min(dc_features["styles"], 3) / 3,
+        "labeled_links": dc_features["labeled_links"],
+        "connected": 1 - dc_features["isolated_nodes"] / nodes if nodes else 0.0,
+        "depth": _band(dc_features["depth"], *TARGET_DEPTH),
+    }
+    return sum(WEIGHTS[name] * value for name, value in dc_components.items())
+
+
+def overlap_scores(ls_graphs: List[mermaid.Graph], text: str) -> np.ndarray:
+    """Term overlap between each parsed diagram and the source text, between 0 and 1
+
+    Computed for all the diagrams at once on a (diagrams x vocabulary) matrix: the harmonic
+    mean of the precision (share of the label terms that appear in the text) and of the
+    recall (share of the weight of the most frequent text terms covered by the labels).
+    """
+    text_counts = Counter(terms(text))
+    ls_label_terms = [label_terms(graph) for graph in ls_graphs]
+    vocabulary = sorted(set(text_counts).union(*ls_label_terms))
+    if len(ls_graphs) == 0 or len(vocabulary) == 0:
+        return np.zeros(len(ls_graphs))
+    dc_index = {term: i for i, term in enumerate(vocabulary)}
+
+    labels = np.zeros((len(ls_graphs), len(vocabulary)))
+    for row, graph_terms in enumerate(ls_label_terms):
+        labels[row, [dc_index[term] for term in graph_terms]] = 1
+
+    in_text = np.zeros(len(vocabulary))
+    in_text[[dc_index[term] for term in text_counts]] = 1
+    top_weights = np.zeros(len(vocabulary))
+    for term, count in text_counts.most_common(TOP_TEXT_TERMS):
+        top_weights[dc_index[term]] = np.log1p(count)
+
+    label_totals = labels.sum(axis=1)
+    precision = np.divide(labels @ in_text, label_totals, out=np.zeros(len(ls_graphs)), where=label_totals > 0)
+    recall = labels @ top_weights / top_weights.sum() if top_weights.sum() > 0 else np.zeros(len(ls_graphs))
+    total = precision + recall
+    return np.divide(2 * precision * recall, total, out=np.zeros(len(ls_graphs)), where=total > 0)
+
+
+def score_diagrams(ls_graphs: List[Union[str, mermaid.Graph]], text: str) -> List[dict]:
+    """Score several candidate diagrams (Mermaid code or parsed Graph) against the source text
+
+    Returns
+    -------
+    One dictionary per diagram, with the "score" (between 0 and 1, higher is better), the
+    "structure" and "overlap" scores it combines, and the raw structural "features".
+    """
+    ls_parsed = [mermaid.parse(graph) if isinstance(graph, str) else graph for graph in ls_graphs]
+    overlaps = overlap_scores(ls_parsed, text)
+    ls_scores = []
+    for graph, overlap in zip(ls_parsed, overlaps):
+        dc_features = structural_features(graph)
+        structure = structural_score(dc_features)
+        ls_scores.append({
+            "score": (1 - OVERLAP_WEIGHT) * structure + OVERLAP_WEIGHT * float(overlap),
+            "structure": structure,
+            "overlap": float(overlap),
+            "features": dc_features,
+        })
+    return ls_scores
+
+
+def top_k(ls_scores: List[dict], k: int) -> List[int]:
+    """Indices of the k best scored diagrams, in their original order"""
+    ls_ranked = sorted(range(len(ls_scores)), key=lambda i: ls_scores[i]["score"], reverse=True)
+    return sorted(ls_ranked[:k])
@@ -0,0 +1,181 @@
+"""Selection of the best diagram among many, with local pruning and concurrent brackets"""
+# Python Built-Ins:
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+# Local Dependencies:
+import llm
+import retry
+import scoring
+
+
+PROMPT_SELECT = """
+
+    Think step by step and select the most informative and visually pleasing Mermaid diagram among the following {num_of_diagrams}.
+    The candidate Mermaid diagrams are included inside XML tags, along with their corresponding index number.
+    The most informative Mermaid diagram should be the one that includes the most details from the text and displays it in an easy to understand way.
+    Someone who would only view the selected Mermaid diagram, should understand the main concepts of the text, without having to read it.
+    Explain which of the Mermaid diagrams is the most informative and provide its index inside <selected_index></selected_index> XML tags.
+    """
+
+
+def parse_index(response_text: str, num_candidates: int) -> Optional[int]:
+    """Return the index given in the <selected_index> tags, or None if it is missing or invalid
+
+    Tolerates extra text around the number (e.g. "Diagram 2" or "2."). If the tags are
+    missing, the last "diagram N" mention of the response is used instead.
+    """
+    ls_indices = re.findall(r"<selected_index>(.*?)</selected_index>", response_text, re.DOTALL)
+    if len(ls_indices) > 0:
+        ls_numbers = re.findall(r"\d+", ls_indices[-1])
+    else:
+        ls_numbers = re.findall(r"diagram\s*(\d+)", response_text, re.IGNORECASE)[-1:]
+    if len(ls_numbers) == 0:
+        return None
+    index = int(ls_numbers[0])
+    return index if 0 <= index < num_candidates else None
+
+
+def add_usage(usage: dict, other: dict) -> dict:
+    """Sum of two token usage dictionaries"""
+    return {key: usage.get(key, 0) + other.get(key, 0) for key in set(usage) | set(other)}
+
+
+def compare(
+    bedrock_runtime,
+    model_id: str,
+    system_prompt: str,
+    prompt_prefix: str,
+    ls_graphs: List[str],
+    ls_scores: List[float],
+    response_cache=None,
+    retry_policy: Optional[retry.RetryPolicy] = None,
+):
+    """Ask the model to pick the best of a small bracket of diagrams
+
+    Falls back to the candidate with the best local score if the model does not return a
+    valid index. Returns a dictionary with the local "index" of the winner, the
+    "raw_output" of the model, the "usage" and whether the "fallback" was used.
+    """
+    prompt = prompt_prefix + PROMPT_SELECT.format(num_of_diagrams=len(ls_graphs))
+    for i, graph in enumerate(ls_graphs):
+        prompt += ("\n\n<diagram " + str(i) + ">\n")
+        prompt += graph
+        prompt += ("\n</diagram " + str(i) + ">\n")
+
+    dc_response = (retry_policy or retry.RetryPolicy()).start().call(
+        llm.converse,
+        bedrock_runtime,
+        model_id=model_id,
+        prompt=prompt,
+        system_prompt=system_prompt,
+        temperature=0.1,  # be more factual
+        max_tokens=2048,
+        top_p=1,
+        response_cache=response_cache,
+        prompt_caching=True,
+    )
+    index = parse_index(dc_response["text"], len(ls_graphs))
+    fallback = index is None
+    if fallback:
+        index = max(range(len(ls_graphs)), key=lambda i: ls_scores[i])
+    return {
+        "index": index,
+        "raw_output": dc_response["text"],
+        "usage": dc_response["usage"],
+        "fallback": fallback,
+    }
+
+
+def select_best(
+    bedrock_runtime,
+    model_id: str,
+    system_prompt: str,
+    prompt_prefix: str,
+    text: str,
+    ls_graphs: List[str],
+    max_survivors: int = 4,
+    bracket_size: int = 2,
+    max_workers: int = 5,
+    response_cache=None,
+    retry_policy: Optional[retry.RetryPolicy] = None,
+    local_only: bool = False,
+):
+    """Select the best diagram with a tournament
+
+    1. Candidates are ranked by their local score (scoring.score_diagrams()), and only the
+       best `max_survivors` are kept, so the model never sees more than a few diagrams.
+       With `local_only`, the best scored diagram is selected without calling the model.
+    2. The survivors are split into brackets of `bracket_size` diagrams, and all the
+       brackets of a round are judged concurrently. Winners go to the next round, until a
+       single diagram is left.
+
+    Every comparison starts with the same `prompt_prefix` (the document block), so the
+    comparisons share the prompt cache. Worker threads do not touch any Streamlit state.
+
+    Returns
+    -------
+    A dictionary with the index of the selected diagram in `ls_graphs` ("indx_selected"),
+    the "raw_output" of the last comparison, the summed "usage", the number of "rounds" and
+    of model "comparisons", the number of candidates "pruned" locally, how many
+    comparisons had to "fallback" to the local score, and the local "scores".
+    """
+    ls_local = scoring.score_diagrams(ls_graphs, text)
+    ls_scores = [dc_score["score"] for dc_score in ls_local]
+    ls_survivors = scoring.top_k(ls_local, 1 if local_only else max_survivors)
+    dc_output = {
+        "indx_selected": ls_survivors[0],
+        "raw_output": "This is the only available diagram",
+        "usage": {},
+        "rounds": 0,
+        "comparisons": 0,
+        "pruned": len(ls_graphs) - len(ls_survivors),
+        "fallback": 0,
+        "scores": ls_local,
+    }
+    if local_only:
+        dc_best = ls_local[ls_survivors[0]]
+        dc_output["raw_output"] = (
+            "Selected by the local score: " + str(round(dc_best["score"], 2)) +
+            " (structure " + str(round(dc_best["structure"], 2)) +
+            ", term overlap with the text " + str(round(dc_best["overlap"], 2)) + ")"
+        )
+        return dc_output
+
+    bracket_size = max(bracket_size, 2)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(ls_survivors) > 1:
+            ls_brackets = [
+                ls_survivors[i:i + bracket_size] for i in range(0, len(ls_survivors), bracket_size)
+            ]
+            ls_futures = [
+                executor.submit(
+                    compare,
+                    bedrock_runtime,
+                    model_id,
+                    system_prompt,
+                    prompt_prefix,
+                    [ls_graphs[i] for i in bracket],
+                    [ls_scores[i] for i in bracket],
+                    response_cache,
+                    retry_policy,
+                ) if len(bracket) > 1 else None  # a lone candidate goes through
+                for bracket in ls_brackets
+            ]
+            ls_winners = []
+            for bracket, future in zip(ls_brackets, ls_futures):
+                if future is None:
+                    ls_winners.append(bracket[0])
+                    continue
+                dc_comparison = future.result()
+                ls_winners.append(bracket[dc_comparison["index"]])
+                dc_output["raw_output"] = dc_comparison["raw_output"]
+                dc_output["usage"] = add_usage(dc_output["usage"], dc_comparison["usage"])
+                dc_output["comparisons"] += 1
+                dc_output["fallback"] += int(dc_comparison["fallback"])
+            ls_survivors = ls_winners
+            dc_output["rounds"] += 1
+
+    dc_output["indx_selected"] = ls_survivors[0]
+    return dc_output
@@ -1,5 +1,7 @@
 pip install --no-cache-dir -r requirements.txt
 pip install --upgrade boto3
+# self-hosted Mermaid bundle, served by the app to the diagram viewer (see viewer.py)
+curl -sSfL https://cdn.jsdelivr.net/npm/mermaid@10.9.1/dist/mermaid.min.js -o mermaid_viewer/mermaid.min.js
 if grep -q '^NAME="Ubuntu"' /etc/os-release; then
     sudo apt-get install -y iproute2
     sudo apt-get install -y jq
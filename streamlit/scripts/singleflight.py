@@ -0,0 +1,149 @@
+"""Coalescing of identical gist requests, within a run and across sessions
+
+Two users, or one user in two tabs, asking for the gist of the same text with the same
+settings get a single computation: the first request leads a "flight", the identical
+requests arriving while it runs wait for its result instead of calling the model again,
+and completed results are kept in a shared store for the later ones. Requests are
+identified by the hash of their normalized text, prompt, models and parameters (see
+request_key()). The pipeline scheduler does the coalescing, see pipeline.Pipeline.run_many().
+"""
+# Python Built-Ins:
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Local Dependencies:
+import cache
+
+
+KEY_VERSION = "1"  # part of the keys: bump it when the pipeline results change
+TEXT_VALUES = ("text", "reference_text")  # values identifying the document, the first available one is used
+IGNORED_FIELDS = ("max_workers",)  # configuration fields that do not change the results
+
+
+class FlightAborted(Exception):
+    """The leading request stopped before completing, e.g. cancelled: the followers run on their own"""
+    pass
+
+
+def normalize_text(text: str) -> str:
+    """The text with its whitespace collapsed, so that copies differing only by layout match"""
+    return " ".join(text.split())
+
+
+def request_key(dc_values: dict, config, targets: Iterable[str]) -> Optional[str]:
+    """Key identifying the request of a document, or None until its text is known
+
+    Parameters
+    ----------
+    dc_values :
+        Values of the document so far: its text (see TEXT_VALUES), and optionally an edited
+        "prompt", which replaces the prompt template in the key.
+    config :
+        The pipeline.PipelineConfig of the run, whose fields are the models and parameters.
+    targets :
+        The values requested, since two requests for different values do not share results.
+    """
+    for name in TEXT_VALUES:
+        if dc_values.get(name) is not None:
+            break
+    else:
+        return None
+    dc_config = {field: value for field, value in config._asdict().items() if field not in IGNORED_FIELDS}
+    prompt = dc_values.get("prompt")
+    return cache.hash_key(
+        "gist-request",
+        KEY_VERSION,
+        name,
+        normalize_text(dc_values[name]),
+        normalize_text(prompt) if prompt is not None else None,
+        dc_config,
+        sorted(targets),
+    )
+
+
+class Flight:
+    """One computation, shared by all the identical requests that joined it while it ran"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.followers = 0
+        self.values = None
+        self.error = None
+        self._done = False
+        self._ls_callbacks = []
+        self._lock = threading.Lock()
+
+    def add_done_callback(self, callback: Callable[[Optional[dict], Optional[Exception]], None]):
+        """Call `callback(values, error)` once the flight lands, right away if it already has"""
+        with self._lock:
+            if not self._done:
+                self._ls_callbacks.append(callback)
+                return
+        callback(self.values, self.error)
+
+    def _land(self, values: Optional[dict], error: Optional[Exception]):
+        with self._lock:
+            self.values = values
+            self.error = error
+            self._done = True
+            ls_callbacks, self._ls_callbacks = self._ls_callbacks, []
+        for callback in ls_callbacks:
+            callback(values, error)
+
+
+class SingleFlight:
+    """Registry of the flights in progress, by request key"""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """Return the flight of a request, and True if the caller leads it (and must land it)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                return flight, False
+            flight = Flight(key)
+            self._flights[key] = flight
+            return flight, True
+
+    def land(self, flight: Flight, values: Optional[dict] = None, error: Optional[Exception] = None):
+        """Complete a flight with the result of its leader, passing it on to the followers"""
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight._land(values, error)
+
+    def in_flight(self) -> List[str]:
+        with self._lock:
+            return list(self._flights)
+
+
+_singleflight = None
+_result_store = None
+_lock = threading.Lock()
+
+
+def get_singleflight() -> SingleFlight:
+    """Return the process-wide registry of flights, shared by all the sessions"""
+    global _singleflight
+    with _lock:
+        if _singleflight is None:
+            _singleflight = SingleFlight()
+    return _singleflight
+
+
+def get_result_store() -> cache.TieredCache:
+    """Return the process-wide store of completed results (memory LRU + 200 MB on disk, 1 day TTL)"""
+    global _result_store
+    with _lock:
+        if _result_store is None:
+            _result_store = cache.TieredCache(
+                "gist_results",
+                max_memory_entries=64,
+                max_size_bytes=200 * 1024 * 1024,
+                ttl=24 * 3600,
+            )
+    return _result_store
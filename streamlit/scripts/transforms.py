@@ -0,0 +1,123 @@
+"""View transforms of generated diagrams, applied locally instead of regenerating them"""
+# Python Built-Ins:
+import copy
+import functools
+import re
+from typing import Optional
+
+# Local Dependencies:
+import mermaid
+
+
+_RE_HEADER = re.compile(r"^([ \t]*(?:graph|flowchart))(?:[ \t]+[A-Za-z]+)?(?=[\s;]|$)", re.MULTILINE)
+
+
+def set_direction(graph: mermaid.Graph, direction: str) -> mermaid.Graph:
+    """Return a copy of the graph with another orientation ("LR", "RL", "TD", "BT" or "TB")"""
+    if direction not in mermaid.DIRECTIONS:
+        raise ValueError(f"Unknown direction '{direction}'")
+    output = copy.deepcopy(graph)
+    output.direction = direction
+    return output
+
+
+def collapse_subgraphs(graph: mermaid.Graph) -> mermaid.Graph:
+    """Return a copy of the graph where every top-level subgraph is replaced by a single node
+
+    The node takes the title of the subgraph. Links from or to any node of the subgraph
+    (including nested subgraphs) are redirected to it, links inside the subgraph are
+    dropped, and duplicated links are merged. Link styles are dropped, since they refer to
+    link indices that change.
+    """
+    output = mermaid.Graph(graph.keyword, graph.direction)
+    dc_replacement = {}  # node id -> id of the node of its collapsed subgraph
+    ls_top_subgraphs = [i for i, subgraph in enumerate(graph.subgraphs) if subgraph.parent is None]
+
+    for i in ls_top_subgraphs:
+        subgraph = graph.subgraphs[i]
+        collapsed_id = subgraph.id or f"subgraph_{i}"
+        ls_pending = [i]
+        while ls_pending:
+            current = graph.subgraphs[ls_pending.pop()]
+            for node_id in current.nodes:
+                dc_replacement[node_id] = collapsed_id
+            ls_pending.extend(current.children)
+
+    collapsed = set()
+    for node in graph.nodes.values():
+        if node.id in dc_replacement:
+            collapsed_id = dc_replacement[node.id]
+            if collapsed_id not in collapsed:
+                collapsed.add(collapsed_id)
+                subgraph = graph.subgraphs[_top_subgraph(graph, node.subgraph)]
+                output.nodes[collapsed_id] = mermaid.Node(collapsed_id, "subroutine", subgraph.title)
+        else:
+            output.nodes[node.id] = mermaid.Node(node.id, node.shape, node.label)
+    # subgraphs without any node of their own still become a node
+    for i in ls_top_subgraphs:
+        subgraph = graph.subgraphs[i]
+        collapsed_id = subgraph.id or f"subgraph_{i}"
+        if collapsed_id not in output.nodes:
+            output.nodes[collapsed_id] = mermaid.Node(collapsed_id, "subroutine", subgraph.title)
+
+    seen = set()
+    for edge in graph.edges:
+        source = dc_replacement.get(edge.source, edge.source)
+        target = dc_replacement.get(edge.target, edge.target)
+        if source == target and (edge.source in dc_replacement or edge.target in dc_replacement):
+            continue  # inside a collapsed subgraph
+        collapsed_edge = mermaid.Edge(source, target, edge.arrow, edge.text)
+        if collapsed_edge not in seen:
+            seen.add(collapsed_edge)
+            output.edges.append(collapsed_edge)
+
+    output.class_defs = dict(graph.class_defs)
+    output.classes = {
+        node_id: name for node_id, name in graph.classes.items() if node_id in output.nodes
+    }
+    output.styles = {
+        node_id: styles for node_id, styles in graph.styles.items() if node_id in output.nodes
+    }
+    output.raw_statements = [
+        statement for statement in graph.raw_statements
+        if not statement.startswith("click") or statement.split()[1] in output.nodes
+    ]
+    return output
+
+
+def _top_subgraph(graph: mermaid.Graph, index: int) -> int:
+    # index of the top-level subgraph containing the given subgraph
+    while graph.subgraphs[index].parent is not None:
+        index = graph.subgraphs[index].parent
+    return index
+
+
+@functools.lru_cache(maxsize=256)
+def apply_view(graph: str, direction: Optional[str] = None, collapse: bool = False) -> str:
+    """Return the Mermaid code of a diagram seen with another orientation and/or with its
+    subgraphs collapsed, without calling a model
+
+    Invalid graphs are returned unchanged, and so are graphs the view does not change: only
+    collapsing re-serializes the code, a new orientation just rewrites the header. Results
+    are memoized, so switching back and forth between views is instant.
+    """
+    parsed = mermaid.parse(graph)
+    if not parsed.is_valid():
+        return graph
+    if direction is not None and _same_direction(parsed.direction, direction):
+        direction = None
+    if direction is None and collapse is False:
+        return graph
+    if collapse is False:
+        # only the header changes: the code is kept as written, comments and layout included
+        return _RE_HEADER.sub(lambda match: match.group(1) + " " + direction, graph, count=1)
+    parsed = collapse_subgraphs(parsed)
+    if direction is not None:
+        parsed = set_direction(parsed, direction)
+    return parsed.to_mermaid()
+
+
+def _same_direction(current: Optional[str], direction: str) -> bool:
+    # TD is an alias of TB, the default when the header has none
+    aliases = {None: "TB", "TD": "TB"}
+    return aliases.get(current, current) == aliases.get(direction, direction)
@@ -0,0 +1,75 @@
+"""Rendering of Mermaid diagrams in the browser, with a self-hosted Mermaid bundle
+
+All the diagrams of a view are rendered in a single component, which loads the Mermaid
+bundle once from the app (see setup.sh) and memoizes the rendered SVGs by graph hash, so
+that reruns do not load, initialize or lay out anything again.
+"""
+# Python Built-Ins:
+import hashlib
+import os
+from typing import List, Optional
+
+# External Dependencies:
+import streamlit.components.v1 as components
+
+
+MERMAID_VERSION = "10.9.1"
+FRONTEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mermaid_viewer")
+BUNDLE_FILE = "mermaid.min.js"  # downloaded into FRONTEND_DIR by setup.sh
+CDN_URL = f"https://cdn.jsdelivr.net/npm/mermaid@{MERMAID_VERSION}/dist/mermaid.min.js"
+MAX_CACHED_SVGS = 100  # rendered SVGs kept in the local storage of the browser
+
+# files of the component directory are served by the app with their actual content type
+# (unlike the static folder, which serves scripts as text/plain) and are cached by the browser
+_component = components.declare_component("mermaid_viewer", path=FRONTEND_DIR)
+
+
+def graph_key(graph: str, theme: str) -> str:
+    """Key of the rendered SVG of a graph with a theme"""
+    return hashlib.sha256((MERMAID_VERSION + "\n" + theme + "\n" + graph).encode("utf8")).hexdigest()[:32]
+
+
+def bundle_url() -> str:
+    """URL of the Mermaid bundle, relative to the component, or the CDN if it is not installed"""
+    if os.path.exists(os.path.join(FRONTEND_DIR, BUNDLE_FILE)):
+        return BUNDLE_FILE
+    return CDN_URL
+
+
+def render_diagrams(
+    ls_graphs: List[str],
+    theme: str = "default",
+    ls_titles: Optional[List[str]] = None,
+    height: int = 500,
+    key: Optional[str] = None,
+):
+    """Render several Mermaid diagrams in one component
+
+    Parameters
+    ----------
+    ls_graphs :
+        Mermaid code of the diagrams.
+    theme :
+        Mermaid theme ("default", "neutral", "dark" or "forest").
+    ls_titles :
+        Optional title displayed above each diagram.
+    height :
+        Maximum height of each diagram in pixels, larger diagrams scroll.
+    key :
+        Optional Streamlit widget key, needed when the same diagrams are rendered twice.
+    """
+    if ls_titles is None:
+        ls_titles = [None] * len(ls_graphs)
+    ls_diagrams = [
+        {"key": graph_key(graph, theme), "code": graph, "title": title}
+        for graph, title in zip(ls_graphs, ls_titles)
+    ]
+    _component(
+        diagrams=ls_diagrams,
+        theme=theme,
+        height=height,
+        bundle_url=bundle_url(),
+        max_cached=MAX_CACHED_SVGS,
+        key=key,
+        default=None,
+    )
@@ -0,0 +1,101 @@
+"""Fetching webpages and extracting their text, with a persistent cache of the results"""
+# Python Built-Ins:
+import hashlib
+from typing import Optional
+from urllib.error import HTTPError
+from urllib.request import urlopen, Request
+
+# External Dependencies:
+from bs4 import BeautifulSoup
+
+# Local Dependencies:
+import cache
+
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36"
+
+_page_cache = None
+
+
+def get_page_cache() -> cache.DiskCache:
+    """Return the process-wide cache of fetched pages (1 day TTL, 200 MB cap)"""
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = cache.DiskCache("pages", max_size_bytes=200 * 1024 * 1024, ttl=24 * 3600)
+    return _page_cache
+
+
+def extract_text(rawpage: bytes):
+    """Parse an html page and return its (text, title), without scripts, styles and metadata"""
+    soup = BeautifulSoup(rawpage, features="html.parser")
+    # kill all script and style elements
+    for script in soup(["script", "style", "meta"]):
+        script.extract()    # rip it out
+    # get text
+    text = soup.get_text()
+    title = soup.title.text if soup.title is not None else ""
+    return text, title
+
+
+def fetch_page(url: str, page_cache: Optional[cache.DiskCache] = None):
+    """Return the text and title of a webpage, reusing the cached copy whenever possible
+
+    Fresh cache entries are served without any network access. Expired entries are
+    revalidated with If-None-Match/If-Modified-Since, and a "304 Not Modified" answer reuses
+    the cached text. Pages are only parsed again when their content actually changed.
+
+    Parameters
+    ----------
+    url :
+        Address of the webpage.
+    page_cache :
+        Optional cache to use, defaults to get_page_cache().
+
+    Returns
+    -------
+    A dictionary with the page "text" and "title", and "cache_status" which is one of "hit",
+    "revalidated", "unchanged" (downloaded again but same content) or "miss".
+    """
+    if page_cache is None:
+        page_cache = get_page_cache()
+    key = cache.hash_key("page", url)
+    entry = page_cache.get(key, include_expired=True)
+
+    if entry is not None and not page_cache.is_expired(entry):
+        return {**entry.metadata["extracted"], "cache_status": "hit"}
+
+    headers = {"User-Agent": USER_AGENT}
+    if entry is not None:
+        if entry.metadata.get("etag"):
+            headers["If-None-Match"] = entry.metadata["etag"]
+        if entry.metadata.get("last_modified"):
+            headers["If-Modified-Since"] = entry.metadata["last_modified"]
+
+    try:
+        response = urlopen(Request(url, headers=headers))
+    except HTTPError as e:
+        if e.code == 304 and entry is not None:
+            page_cache.touch(key)
+            return {**entry.metadata["extracted"], "cache_status": "revalidated"}
+        raise
+    rawpage = response.read()
+    content_hash = hashlib.sha256(rawpage).hexdigest()
+
+    if entry is not None and entry.metadata.get("content_hash") == content_hash:
+        # same bytes as before, skip parsing
+        extracted = entry.metadata["extracted"]
+        cache_status = "unchanged"
+    else:
+        text, title = extract_text(rawpage)
+        extracted = {"text": text, "title": title}
+        cache_status = "miss"
+
+    metadata = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "content_hash": content_hash,
+        "extracted": extracted,
+    }
+    page_cache.put(key, rawpage, metadata)
+    return {**extracted, "cache_status": cache_status}